@@ -0,0 +1,21 @@
+from __future__ import annotations
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "0004_recipient_in_flight"
+down_revision = "993e4599a6b4"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    if op.get_bind().dialect.name == "postgresql":
+        # ADD VALUE cannot be used in the transaction that adds it
+        with op.get_context().autocommit_block():
+            op.execute("ALTER TYPE recipientstatus ADD VALUE IF NOT EXISTS 'in_flight' AFTER 'pending'")
+
+
+def downgrade() -> None:
+    # PostgreSQL cannot drop an enum value; hand claimed rows back instead
+    op.execute("UPDATE recipients SET status = 'pending' WHERE status = 'in_flight'")
@@ -0,0 +1,18 @@
+from __future__ import annotations
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "0005_recipient_attributes"
+down_revision = "0004_recipient_in_flight"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column("recipients", sa.Column("attributes", sa.JSON(), nullable=True))
+
+
+def downgrade() -> None:
+    op.drop_column("recipients", "attributes")
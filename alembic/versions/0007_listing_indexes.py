@@ -0,0 +1,36 @@
+from __future__ import annotations
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "0007_listing_indexes"
+down_revision = "0006_suppressions"
+branch_labels = None
+depends_on = None
+
+_INDEXES = (
+    ("ix_recipients_campaign_status_id", "recipients", ["campaign_id", "status", "id"]),
+    ("ix_recipients_campaign_id", "recipients", ["campaign_id", "id"]),
+    ("ix_sent_emails_campaign_status_id", "sent_emails", ["campaign_id", "status", "id"]),
+    ("ix_sent_emails_campaign_id", "sent_emails", ["campaign_id", "id"]),
+    ("ix_sent_emails_recipient_id", "sent_emails", ["recipient_id"]),
+)
+
+
+def upgrade() -> None:
+    if op.get_bind().dialect.name == "postgresql":
+        # build without locking writes on large tables; CONCURRENTLY cannot run in a transaction
+        with op.get_context().autocommit_block():
+            for name, table, columns in _INDEXES:
+                op.create_index(name, table, columns, postgresql_concurrently=True, if_not_exists=True)
+            op.drop_index("ix_recipients_campaign_status", table_name="recipients", postgresql_concurrently=True)
+    else:
+        for name, table, columns in _INDEXES:
+            op.create_index(name, table, columns)
+        op.drop_index("ix_recipients_campaign_status", table_name="recipients")
+
+
+def downgrade() -> None:
+    op.create_index("ix_recipients_campaign_status", "recipients", ["campaign_id", "status"])
+    for name, table, _ in reversed(_INDEXES):
+        op.drop_index(name, table_name=table)
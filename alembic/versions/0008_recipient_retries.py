@@ -0,0 +1,20 @@
+from __future__ import annotations
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "0008_recipient_retries"
+down_revision = "0007_listing_indexes"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column("recipients", sa.Column("attempts", sa.Integer(), nullable=False, server_default="0"))
+    op.add_column("recipients", sa.Column("retry_at", sa.DateTime(timezone=True), nullable=True))
+
+
+def downgrade() -> None:
+    op.drop_column("recipients", "retry_at")
+    op.drop_column("recipients", "attempts")
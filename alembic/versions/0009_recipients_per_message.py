@@ -0,0 +1,20 @@
+from __future__ import annotations
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "0009_recipients_per_message"
+down_revision = "0008_recipient_retries"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column(
+        "campaigns", sa.Column("recipients_per_message", sa.Integer(), nullable=False, server_default="1")
+    )
+
+
+def downgrade() -> None:
+    op.drop_column("campaigns", "recipients_per_message")
@@ -0,0 +1,26 @@
+from __future__ import annotations
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "0011_recipient_email_index"
+down_revision = "0010_user_send_weight"
+branch_labels = None
+depends_on = None
+
+_NAME = "ix_recipients_campaign_email"
+_COLUMNS = ["campaign_id", sa.text("lower(to_email)")]
+
+
+def upgrade() -> None:
+    if op.get_bind().dialect.name == "postgresql":
+        # build without locking writes on a large table; CONCURRENTLY cannot run in a transaction
+        with op.get_context().autocommit_block():
+            op.create_index(_NAME, "recipients", _COLUMNS, postgresql_concurrently=True, if_not_exists=True)
+    else:
+        op.create_index(_NAME, "recipients", _COLUMNS)
+
+
+def downgrade() -> None:
+    op.drop_index(_NAME, table_name="recipients")
@@ -0,0 +1,18 @@
+from __future__ import annotations
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "0012_user_is_admin"
+down_revision = "0011_recipient_email_index"
+branch_labels = None
+depends_on = None
+
+def upgrade() -> None:
+    # admins are granted explicitly: python -m app.auth admin <email>
+    op.add_column("users", sa.Column("is_admin", sa.Boolean(), nullable=False, server_default=sa.false()))
+
+
+def downgrade() -> None:
+    op.drop_column("users", "is_admin")
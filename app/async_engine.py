@@ -0,0 +1,458 @@
+"""Event-loop delivery engine, selected with SEND_ENGINE=async.
+
+Run with ``python -m app.async_engine``. Every running campaign gets its own
+coroutine that paces sends at ``limit_window_seconds / limit_count`` per
+recipient (slowed by the SMTP account's adaptive rate factor after
+throttling) and keeps up to ASYNC_ENGINE_CONNECTIONS_PER_CAMPAIGN SMTP
+conversations open, so one process can hold thousands of conversations
+across campaigns. Recipients are claimed about a poll interval's worth at a
+time and, without merge fields, share SMTP transactions of up to
+``recipients_per_message`` like the Celery path. Database work is short and
+runs in the default thread pool; each claimed batch's results are journaled
+in Redis at once and written in bulk by the engine's own ``ResultSink``
+flush. While only
+deferred recipients are left a campaign's coroutine sleeps until the
+earliest is due, keeping its pacing and any circuit pause.
+
+Pacing lives in the process, so only one engine sends at a time: the
+first to take a Redis lock runs, any other waits as a standby until the
+lock expires.
+"""
+from __future__ import annotations
+
+import asyncio
+import math
+import uuid
+from collections import Counter
+from dataclasses import dataclass
+from typing import Optional
+
+import aiosmtplib
+from sqlalchemy import select
+
+from .circuit import CircuitOpenError
+from .config import settings
+from .crypto import get_smtp_credentials
+from .db import SessionLocal
+from .delivery import (
+    DEFERRED,
+    RELEASED,
+    DeliveryResult,
+    claim_recipients,
+    complete_if_done,
+    has_unfinished,
+    next_retry_in,
+)
+from .async_sender import AsyncSMTPSession, is_hard_bounce, is_throttle, is_transient
+from .email_sender import MessageTemplate
+from .logs import configure_logging, get_logger
+from .metrics import MESSAGES, serve as serve_metrics, timed
+from .models import Campaign, CampaignStatus, Recipient, RecipientStatus
+from .progress import publish_progress
+from .redis_client import get_redis
+from .result_sink import ResultSink, journaled_claims, make_sink, push_results_async
+from .scheduler import record_pacing_async
+from .suppression import email_key, suppressed
+from .tasks import _envelopes
+
+log = get_logger(__name__)
+
+_LOCK_KEY = "async_engine:lock"
+# most recipients one claim takes, however fast the campaign
+_MAX_CLAIM = 200
+
+# KEYS[1] engine lock; ARGV[1] this engine's token, ARGV[2] ttl ms.
+# Takes the lock when free and renews it while this engine still holds it,
+# in one step so a lock another engine took meanwhile is never extended.
+_LOCK_SCRIPT = """
+local holder = redis.call('GET', KEYS[1])
+if not holder then
+  redis.call('SET', KEYS[1], ARGV[1], 'PX', ARGV[2])
+  return 1
+end
+if holder == ARGV[1] then
+  redis.call('PEXPIRE', KEYS[1], ARGV[2])
+  return 1
+end
+return 0
+"""
+
+# KEYS[1] engine lock; ARGV[1] this engine's token. Deletes the lock only if still held.
+_UNLOCK_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+  return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+# an idle campaign looks again at least this often, to notice a pause or new work
+_IDLE_RECHECK_SECONDS = 30.0
+
+
+@dataclass(frozen=True)
+class CampaignSnapshot:
+    id: int
+    user_id: int
+    smtp_host: str
+    smtp_port: int
+    smtp_username: str
+    smtp_password: str
+    use_starttls: bool
+    use_ssl: bool
+    from_email: str
+    from_name: Optional[str]
+    subject: str
+    body: str
+    recipients_per_message: int
+    interval: float
+
+
+def _running_campaign_ids() -> list[int]:
+    with SessionLocal() as db:
+        return list(db.execute(select(Campaign.id).where(Campaign.status == CampaignStatus.running)).scalars())
+
+
+def _load_campaign(campaign_id: int) -> Optional[CampaignSnapshot]:
+    with SessionLocal() as db:
+        campaign = db.get(Campaign, campaign_id)
+        if campaign is None or campaign.status != CampaignStatus.running:
+            return None
+        with timed("decrypt"):
+            username, password = get_smtp_credentials(
+                campaign.id, campaign.smtp_username_enc, campaign.smtp_password_enc
+            )
+        return CampaignSnapshot(
+            id=campaign.id,
+            user_id=campaign.user_id,
+            smtp_host=campaign.smtp_host,
+            smtp_port=campaign.smtp_port,
+            smtp_username=username,
+            smtp_password=password,
+            use_starttls=campaign.smtp_tls,
+            use_ssl=campaign.smtp_ssl,
+            from_email=campaign.from_email or username,
+            from_name=campaign.from_name,
+            subject=campaign.subject,
+            body=campaign.body,
+            recipients_per_message=campaign.recipients_per_message,
+            interval=campaign.limit_window_seconds / max(1, campaign.limit_count),
+        )
+
+
+def _claim_batch(campaign: CampaignSnapshot, budget: int) -> Optional[tuple[list[Recipient], list[Recipient]]]:
+    """Claim up to ``budget`` recipients, split into those to send and suppressed ones.
+
+    None once the campaign is no longer running.
+    """
+    with SessionLocal(expire_on_commit=False) as db:
+        status = db.execute(select(Campaign.status).where(Campaign.id == campaign.id)).scalar_one_or_none()
+        if status != CampaignStatus.running:
+            return None
+        with timed("claim"):
+            claimed = claim_recipients(
+                db, campaign.id, budget, settings.recipient_lease_seconds, journaled=journaled_claims
+            )
+        if not claimed:
+            return [], []
+        with timed("suppress"):
+            blocked = suppressed(campaign.user_id, [r.to_email for r in claimed], db)
+    to_send = [r for r in claimed if not blocked or email_key(r.to_email) not in blocked]
+    skipped = [r for r in claimed if blocked and email_key(r.to_email) in blocked]
+    return to_send, skipped
+
+
+def _failure(campaign_id: int, recipient: Recipient, e: Exception) -> DeliveryResult:
+    err = str(e)
+    if is_transient(e) and recipient.attempts + 1 < settings.send_max_attempts:
+        log.info("email_deferred", campaign_id=campaign_id, recipient_id=recipient.id, error=err)
+        return DeliveryResult.deferred(recipient, err)
+    log.warning("email_failed", campaign_id=campaign_id, recipient_id=recipient.id, error=err)
+    return DeliveryResult.failed(recipient, err, bounced=is_hard_bounce(e))
+
+
+def _complete_if_done(campaign_id: int) -> None:
+    with SessionLocal() as db:
+        if complete_if_done(db, campaign_id):
+            publish_progress(campaign_id, status=CampaignStatus.completed.value)
+
+
+def _idle_wait(campaign_id: int) -> Optional[float]:
+    """Seconds to wait before claiming again, or None once nothing is left to send."""
+    with SessionLocal() as db:
+        if not has_unfinished(db, campaign_id):
+            return None
+        # None here: in flight elsewhere, or due already; look again shortly
+        wait = next_retry_in(db, campaign_id)
+    return min(wait if wait is not None else settings.async_engine_poll_seconds, _IDLE_RECHECK_SECONDS)
+
+
+class _CampaignSessions:
+    """Up to ``limit`` reusable SMTP sessions for one campaign."""
+
+    def __init__(self, campaign: CampaignSnapshot, limit: int) -> None:
+        self.campaign = campaign
+        self.limit = max(1, limit)
+        self._idle: asyncio.Queue[AsyncSMTPSession] = asyncio.Queue()
+        self._all: list[AsyncSMTPSession] = []
+
+    async def acquire(self) -> AsyncSMTPSession:
+        if self._idle.empty() and len(self._all) < self.limit:
+            session = AsyncSMTPSession(
+                smtp_host=self.campaign.smtp_host,
+                smtp_port=self.campaign.smtp_port,
+                smtp_username=self.campaign.smtp_username,
+                smtp_password=self.campaign.smtp_password,
+                use_starttls=self.campaign.use_starttls,
+                use_ssl=self.campaign.use_ssl,
+                max_messages=settings.smtp_max_messages_per_connection,
+            )
+            self._all.append(session)
+            return session
+        return await self._idle.get()
+
+    def release(self, session: AsyncSMTPSession) -> None:
+        self._idle.put_nowait(session)
+
+    async def close(self) -> None:
+        await asyncio.gather(*(s.close() for s in self._all), return_exceptions=True)
+        self._all.clear()
+
+
+class AsyncEngine:
+    def __init__(
+        self,
+        max_connections: int,
+        connections_per_campaign: int,
+        poll_interval: float,
+        sink: ResultSink,
+    ) -> None:
+        self.connections_per_campaign = connections_per_campaign
+        self.poll_interval = poll_interval
+        self.sink = sink
+        self._slots = asyncio.Semaphore(max(1, max_connections))
+        self._campaigns: dict[int, asyncio.Task[None]] = {}
+        # adaptive rate factor of each campaign's SMTP account, as last reported
+        self._pacing: dict[int, float] = {}
+        # loop time until which a campaign waits for its SMTP server's circuit
+        self._paused_until: dict[int, float] = {}
+        self._lock_token = uuid.uuid4().hex
+        self._lock = sink.client.register_script(_LOCK_SCRIPT)
+        self._unlock = sink.client.register_script(_UNLOCK_SCRIPT)
+
+    def _hold_lock(self) -> bool:
+        # outlives a few missed polls, never a dead engine for long
+        ttl_ms = int(max(30.0, self.poll_interval * 5) * 1000)
+        return bool(self._lock(keys=[_LOCK_KEY], args=[self._lock_token, ttl_ms]))
+
+    def _release_lock(self) -> None:
+        self._unlock(keys=[_LOCK_KEY], args=[self._lock_token])
+
+    async def run(self) -> None:
+        if not await asyncio.to_thread(self._hold_lock):
+            log.info("async_engine_standby")
+            while not await asyncio.to_thread(self._hold_lock):
+                await asyncio.sleep(self.poll_interval)
+        log.info("async_engine_started")
+        flusher = asyncio.create_task(self._flush_results())
+        try:
+            while True:
+                if not await asyncio.to_thread(self._hold_lock):
+                    log.error("async_engine_lock_lost")
+                    raise SystemExit("async engine lock lost to another process")
+                for campaign_id in await asyncio.to_thread(_running_campaign_ids):
+                    task = self._campaigns.get(campaign_id)
+                    if task is None or task.done():
+                        self._campaigns[campaign_id] = asyncio.create_task(self._run_campaign(campaign_id))
+                await asyncio.sleep(self.poll_interval)
+        finally:
+            # start no further sends: the engine that holds the lock now paces these campaigns
+            for task in self._campaigns.values():
+                task.cancel()
+            await asyncio.gather(*self._campaigns.values(), return_exceptions=True)
+            flusher.cancel()
+            self.sink.close()
+            await asyncio.to_thread(self._release_lock)
+
+    async def _flush_results(self) -> None:
+        while True:
+            try:
+                await asyncio.to_thread(self.sink.flush_due)
+            except Exception as e:  # noqa: BLE001
+                # the batch stays journaled and is retried on the next pass
+                log.error("result_flush_failed", error=str(e))
+            await asyncio.sleep(min(0.2, self.sink.interval_seconds))
+
+    async def _run_campaign(self, campaign_id: int) -> None:
+        campaign = await asyncio.to_thread(_load_campaign, campaign_id)
+        if campaign is None:
+            return
+        log.info("campaign_picked_up", campaign_id=campaign_id, interval=round(campaign.interval, 3))
+        loop = asyncio.get_running_loop()
+        sessions = _CampaignSessions(campaign, self.connections_per_campaign)
+        template = MessageTemplate(campaign.from_email, campaign.from_name, campaign.subject, campaign.body)
+        # identical content may go to several recipients per SMTP transaction
+        envelope = max(1, campaign.recipients_per_message) if not template.fields else 1
+        in_flight: set[asyncio.Task[None]] = set()
+        # results recorded since the last flush; they may be buffered even once in_flight is empty
+        unflushed = False
+        try:
+            while True:
+                paused = self._paused_until.get(campaign_id, 0.0) - loop.time()
+                if paused > 0:
+                    await asyncio.sleep(paused)
+                # about one poll's worth of sends, so claims never wait long on their lease
+                rate = self._pacing.get(campaign_id, 1.0) / campaign.interval
+                budget = max(envelope, min(_MAX_CLAIM, math.ceil(rate * self.poll_interval)))
+                batch = await asyncio.to_thread(_claim_batch, campaign, budget)
+                if batch is None:
+                    break
+                to_send, skipped = batch
+                if not to_send and not skipped:
+                    if unflushed:
+                        await asyncio.gather(*in_flight, return_exceptions=True)
+                        # apply these results now so the recipients stop counting as unfinished
+                        await asyncio.to_thread(self.sink.flush)
+                        unflushed = False
+                    wait = await asyncio.to_thread(_idle_wait, campaign_id)
+                    if wait is None:
+                        break
+                    # only deferred (or elsewhere in flight) recipients are left
+                    await asyncio.sleep(wait)
+                    continue
+                sends: list[asyncio.Task[tuple[list[DeliveryResult], int]]] = []
+                released: list[DeliveryResult] = []
+                handled: set[int] = set()
+                try:
+                    for group in _envelopes(to_send, envelope):
+                        handled.update(r.id for r in group)
+                        paused = self._paused_until.get(campaign_id, 0.0) - loop.time()
+                        if paused > 0:
+                            # the server's circuit opened; hand the rest of the batch back untried
+                            released.extend(
+                                DeliveryResult.released(r, "circuit open before this attempt", after=paused)
+                                for r in group
+                            )
+                            continue
+                        tick = loop.time()
+                        sends.append(asyncio.create_task(self._send_group(campaign, template, sessions, group)))
+                        # pace on send start so network latency never eats into the rate;
+                        # suppressed recipients spend none of it
+                        interval = campaign.interval * len(group) / self._pacing.get(campaign_id, 1.0)
+                        await asyncio.sleep(max(0.0, interval - (loop.time() - tick)))
+                finally:
+                    # stopped mid-batch: the unsent rest is due again at once, for whoever sends next
+                    released.extend(
+                        DeliveryResult.released(r, "engine stopped before this attempt", after=0.0)
+                        for r in to_send
+                        if r.id not in handled
+                    )
+                    task = asyncio.create_task(self._record(campaign, sends, skipped, released))
+                    in_flight.add(task)
+                    task.add_done_callback(in_flight.discard)
+                    unflushed = True
+            if in_flight:
+                await asyncio.gather(*in_flight, return_exceptions=True)
+            # apply this campaign's last results now rather than on the next interval
+            await asyncio.to_thread(self.sink.flush)
+            await asyncio.to_thread(_complete_if_done, campaign_id)
+        finally:
+            # sends already started finish and are journaled; no new one starts
+            if in_flight:
+                await asyncio.gather(*in_flight, return_exceptions=True)
+            self._pacing.pop(campaign_id, None)
+            self._paused_until.pop(campaign_id, None)
+            await sessions.close()
+
+    async def _send_group(
+        self,
+        campaign: CampaignSnapshot,
+        template: MessageTemplate,
+        sessions: _CampaignSessions,
+        group: list[Recipient],
+    ) -> tuple[list[DeliveryResult], int]:
+        """Send one SMTP transaction; return its results and the messages resent on a new connection."""
+        results: list[DeliveryResult] = []
+        throttled = False
+        async with self._slots:
+            session = await sessions.acquire()
+            try:
+                if len(group) == 1:
+                    recipient = group[0]
+                    message_id, smtp_response = await session.send_template(
+                        template, recipient.to_email, recipient.to_name, recipient.attributes
+                    )
+                    refused: dict = {}
+                else:
+                    message_id, refused = await session.send_shared(template, [r.to_email for r in group])
+                    smtp_response = "250 OK"
+            except CircuitOpenError as e:
+                # nothing was attempted; the campaign waits for the server's next probe
+                self._paused_until[campaign.id] = asyncio.get_running_loop().time() + e.retry_after
+                return [DeliveryResult.released(r, str(e), after=e.retry_after) for r in group], 0
+            except Exception as e:  # noqa: BLE001
+                throttled = is_throttle(e)
+                results = [_failure(campaign.id, r, e) for r in group]
+            else:
+                for recipient in group:
+                    reply = refused.get(recipient.to_email)
+                    if reply is None:
+                        results.append(DeliveryResult.sent(recipient, message_id, smtp_response))
+                        continue
+                    e = aiosmtplib.SMTPRecipientRefused(reply[0], reply[1], recipient.to_email)
+                    throttled = throttled or is_throttle(e)
+                    results.append(_failure(campaign.id, recipient, e))
+            finally:
+                retried = session.retries
+                session.retries = 0
+                sessions.release(session)
+        self._pacing[campaign.id] = await record_pacing_async(
+            campaign.smtp_host, campaign.smtp_port, campaign.smtp_username, throttled
+        )
+        return results, retried
+
+    async def _record(
+        self,
+        campaign: CampaignSnapshot,
+        sends: list[asyncio.Task[tuple[list[DeliveryResult], int]]],
+        skipped: list[Recipient],
+        released: list[DeliveryResult],
+    ) -> None:
+        """Journal one claimed batch's results together once all its sends are done."""
+        results = [DeliveryResult.failed(r, "suppressed") for r in skipped] + released
+        retried = 0
+        for group_results, group_retried in await asyncio.gather(*sends):
+            results.extend(group_results)
+            retried += group_retried
+        try:
+            await push_results_async(results)
+        except Exception as e:  # noqa: BLE001
+            # the claims' lease expires and the recipients are sent again
+            log.error("result_journal_failed", campaign_id=campaign.id, count=len(results), error=str(e))
+            return
+        outcomes = Counter("deferred" if r.status in (DEFERRED, RELEASED) else r.status for r in results)
+        outcomes[RecipientStatus.failed.value] -= len(skipped)
+        outcomes["suppressed"] = len(skipped)
+        for outcome, count in outcomes.items():
+            if count:
+                MESSAGES.labels(campaign.smtp_host, outcome).inc(count)
+        if retried:
+            MESSAGES.labels(campaign.smtp_host, "retried").inc(retried)
+
+
+async def main() -> None:
+    configure_logging()
+    if settings.send_engine != "async":
+        # the scheduler grants Celery tasks for these campaigns; sending here too would double the rate
+        log.warning("async_engine_disabled", send_engine=settings.send_engine)
+        return
+    serve_metrics(settings.worker_metrics_port)
+    engine = AsyncEngine(
+        max_connections=settings.async_engine_max_connections,
+        connections_per_campaign=settings.async_engine_connections_per_campaign,
+        poll_interval=settings.async_engine_poll_seconds,
+        sink=make_sink(get_redis()),
+    )
+    await engine.run()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,280 @@
+from __future__ import annotations
+
+import asyncio
+from contextlib import nullcontext
+from typing import Any, Mapping, Optional, Tuple
+
+import aiosmtplib
+
+from .circuit import guard_async
+from .email_sender import MessageTemplate, TransientSMTPError, get_ssl_context, is_throttle_reply
+from .metrics import timed
+
+
+async def open_smtp_connection_async(
+    smtp_host: str,
+    smtp_port: int,
+    smtp_username: str,
+    smtp_password: str,
+    use_starttls: bool,
+    use_ssl: bool = False,
+    timeout: int = 30,
+    timed_stages: bool = True,
+) -> aiosmtplib.SMTP:
+    """Async counterpart of ``open_smtp_connection``: same SSL/STARTTLS/plain modes.
+
+    ``timed_stages=False`` keeps connections that carry no mail (credential
+    checks) out of the send-stage histogram.
+    """
+    stage = timed if timed_stages else lambda _: nullcontext()
+    client = aiosmtplib.SMTP(
+        hostname=smtp_host,
+        port=smtp_port,
+        use_tls=use_ssl,
+        # STARTTLS is issued below so its handshake is timed on its own
+        start_tls=False,
+        tls_context=get_ssl_context(),
+        timeout=timeout,
+    )
+    with stage("connect"):
+        await client.connect()
+    try:
+        if use_starttls and not use_ssl:
+            with stage("tls"):
+                await client.starttls(tls_context=get_ssl_context())
+        with stage("auth"):
+            await client.login(smtp_username, smtp_password)
+    except BaseException:
+        client.close()
+        raise
+    return client
+
+
+def reply_code(exc: BaseException) -> Optional[int]:
+    """aiosmtplib counterpart of ``email_sender.reply_code``."""
+    if isinstance(exc, aiosmtplib.SMTPRecipientsRefused):
+        return max((r.code for r in exc.recipients), default=None)
+    if isinstance(exc, aiosmtplib.SMTPResponseException):
+        return exc.code
+    return None
+
+
+def is_hard_bounce(exc: BaseException) -> bool:
+    """aiosmtplib counterpart of ``email_sender.is_hard_bounce``."""
+    if isinstance(exc, aiosmtplib.SMTPRecipientsRefused):
+        return bool(exc.recipients) and all(r.code >= 500 for r in exc.recipients)
+    if isinstance(exc, aiosmtplib.SMTPRecipientRefused):
+        return exc.code >= 500
+    return False
+
+
+def is_throttle(exc: BaseException) -> bool:
+    """aiosmtplib counterpart of ``email_sender.is_throttle``."""
+    if isinstance(exc, aiosmtplib.SMTPRecipientsRefused):
+        return any(is_throttle_reply(r.code, r.message) for r in exc.recipients)
+    if isinstance(exc, aiosmtplib.SMTPRecipientRefused):
+        return is_throttle_reply(exc.code, exc.message)
+    code = reply_code(exc)
+    return code is not None and 400 <= code < 500
+
+
+def is_transient(exc: BaseException) -> bool:
+    code = reply_code(exc)
+    if code is not None:
+        return 400 <= code < 500
+    return isinstance(
+        exc,
+        (
+            TransientSMTPError,
+            aiosmtplib.SMTPServerDisconnected,
+            aiosmtplib.SMTPConnectError,
+            aiosmtplib.SMTPTimeoutError,
+            asyncio.TimeoutError,
+            OSError,
+        ),
+    )
+
+
+def is_connection_failure(exc: BaseException) -> bool:
+    """aiosmtplib counterpart of ``email_sender.is_connection_failure``."""
+    return isinstance(
+        exc,
+        (
+            TransientSMTPError,
+            aiosmtplib.SMTPServerDisconnected,
+            aiosmtplib.SMTPConnectError,
+            aiosmtplib.SMTPTimeoutError,
+            aiosmtplib.SMTPHeloError,
+            aiosmtplib.SMTPAuthenticationError,
+            asyncio.TimeoutError,
+            OSError,
+        ),
+    )
+
+
+async def _reset_async(client: aiosmtplib.SMTP) -> bool:
+    """Async counterpart of ``email_sender._reset``."""
+    if not client.is_connected:
+        return False
+    try:
+        await client.rset()
+    except (aiosmtplib.SMTPException, OSError):
+        return False
+    return True
+
+
+async def close_quietly_async(client: aiosmtplib.SMTP) -> None:
+    try:
+        await client.quit()
+    except (aiosmtplib.SMTPException, OSError):
+        client.close()
+
+
+class AsyncSMTPSession:
+    """Async counterpart of ``SMTPSession`` for the event-loop engine."""
+
+    def __init__(
+        self,
+        smtp_host: str,
+        smtp_port: int,
+        smtp_username: str,
+        smtp_password: str,
+        use_starttls: bool,
+        use_ssl: bool = False,
+        max_messages: int = 100,
+    ) -> None:
+        self.smtp_host = smtp_host
+        self.smtp_port = smtp_port
+        self.smtp_username = smtp_username
+        self.smtp_password = smtp_password
+        self.use_starttls = use_starttls
+        self.use_ssl = use_ssl
+        self.max_messages = max(1, max_messages)
+        self._client: Optional[aiosmtplib.SMTP] = None
+        self._sent_on_connection = 0
+        self._fresh = True
+        self.retries = 0
+
+    async def _connect(self) -> aiosmtplib.SMTP:
+        async with guard_async(self.smtp_host, self.smtp_port, self.smtp_username):
+            self._client = await open_smtp_connection_async(
+                smtp_host=self.smtp_host,
+                smtp_port=self.smtp_port,
+                smtp_username=self.smtp_username,
+                smtp_password=self.smtp_password,
+                use_starttls=self.use_starttls,
+                use_ssl=self.use_ssl,
+            )
+        self._sent_on_connection = 0
+        self._fresh = True
+        return self._client
+
+    async def _drop(self) -> None:
+        if self._client is not None:
+            await close_quietly_async(self._client)
+        self._client = None
+        self._sent_on_connection = 0
+
+    async def send(
+        self,
+        from_email: str,
+        from_name: Optional[str],
+        to_email: str,
+        subject: str,
+        body: str,
+    ) -> Tuple[Optional[str], Optional[str]]:
+        return await self.send_template(MessageTemplate(from_email, from_name, subject, body), to_email)
+
+    async def send_template(
+        self,
+        template: MessageTemplate,
+        to_email: str,
+        to_name: Optional[str] = None,
+        attributes: Optional[Mapping[str, Any]] = None,
+    ) -> Tuple[Optional[str], Optional[str]]:
+        if self._client is not None and self._sent_on_connection >= self.max_messages:
+            await self._drop()
+        with timed("render"):
+            message_id, msg = template.render(to_email, to_name, attributes)
+
+        client = self._client or await self._connect()
+        try:
+            errors = await self._deliver(client, template.from_email, [to_email], msg)
+        except aiosmtplib.SMTPServerDisconnected:
+            if self._fresh:
+                raise
+            # The provider closed an idle connection; retry once on a fresh one
+            self.retries += 1
+            errors = await self._deliver(await self._connect(), template.from_email, [to_email], msg)
+        return message_id, str(errors) if errors else "250 OK"
+
+    async def send_shared(self, template: MessageTemplate, to_emails: list[str]) -> Tuple[str, dict]:
+        """Async counterpart of ``SMTPSession.send_shared``: refused addresses map to ``(code, reply)``."""
+        if self._client is not None and self._sent_on_connection >= self.max_messages:
+            await self._drop()
+        with timed("render"):
+            message_id, msg = template.render_shared()
+
+        client = self._client or await self._connect()
+        try:
+            errors = await self._deliver(client, template.from_email, to_emails, msg)
+        except aiosmtplib.SMTPServerDisconnected:
+            if self._fresh:
+                raise
+            self.retries += 1
+            errors = await self._deliver(await self._connect(), template.from_email, to_emails, msg)
+        return message_id, {addr: (resp.code, resp.message) for addr, resp in errors.items()}
+
+    async def _deliver(self, client: aiosmtplib.SMTP, from_email: str, to_addrs: list[str], msg: bytes) -> dict:
+        try:
+            with timed("data"):
+                errors, _ = await client.sendmail(from_email, to_addrs, msg)
+        except (aiosmtplib.SMTPRecipientsRefused, aiosmtplib.SMTPSenderRefused, aiosmtplib.SMTPDataError):
+            # Message-level rejection; keep the connection only if the server
+            # confirms the transaction is reset
+            if await _reset_async(client):
+                self._sent_on_connection += 1
+                self._fresh = False
+            else:
+                await self._drop()
+            raise
+        except BaseException:
+            await self._drop()
+            raise
+        self._sent_on_connection += 1
+        self._fresh = False
+        return errors
+
+    async def close(self) -> None:
+        await self._drop()
+
+    async def __aenter__(self) -> AsyncSMTPSession:
+        return self
+
+    async def __aexit__(self, *exc_info: object) -> None:
+        await self.close()
+
+
+async def send_email_smtp_async(
+    smtp_host: str,
+    smtp_port: int,
+    smtp_username: str,
+    smtp_password: str,
+    use_starttls: bool,
+    from_email: str,
+    from_name: Optional[str],
+    to_email: str,
+    subject: str,
+    body: str,
+    use_ssl: bool = False,
+) -> Tuple[Optional[str], Optional[str]]:
+    async with AsyncSMTPSession(
+        smtp_host=smtp_host,
+        smtp_port=smtp_port,
+        smtp_username=smtp_username,
+        smtp_password=smtp_password,
+        use_starttls=use_starttls,
+        use_ssl=use_ssl,
+        max_messages=1,
+    ) as session:
+        return await session.send(from_email, from_name, to_email, subject, body)
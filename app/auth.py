@@ -0,0 +1,323 @@
+"""API key authentication.
+
+Requests carry a key as ``Authorization: Bearer eak_...`` or ``X-API-Key``.
+Only its SHA-256 is stored. Each API process caches key lookups for
+API_KEY_CACHE_TTL_SECONDS, so an authenticated request costs no query;
+unknown keys are remembered briefly in a small cache of their own, so a
+flood of made-up keys cannot evict the real ones. A revoked key is dropped from every process's cache at
+once through Redis pub/sub. ``last_used_at`` is only recorded in memory
+per request and written for all used keys in a single UPDATE every
+API_KEY_LAST_USED_FLUSH_SECONDS.
+
+Without API_AUTH_REQUIRED, requests without a key act as the default user.
+Operator endpoints (``require_admin``) are only open to requests made with a
+key of a user with ``is_admin`` set; ``python -m app.auth admin`` sets it.
+
+    python -m app.auth create a@aiemailnewsletter.com deploy --days 90
+    python -m app.auth list a@aiemailnewsletter.com
+    python -m app.auth revoke 7
+    python -m app.auth admin ops@aiemailnewsletter.com [--off]
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import hashlib
+import json
+import secrets
+import time
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+
+import redis
+from fastapi import Depends, HTTPException
+from fastapi.security import APIKeyHeader, HTTPAuthorizationCredentials, HTTPBearer
+from sqlalchemy import bindparam, or_, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from .cache import TTLCache
+from .config import settings
+from .db import AsyncSessionLocal, SessionLocal
+from .logs import get_logger
+from .models import ApiKey, User
+from .redis_client import get_async_redis, get_redis
+
+log = get_logger(__name__)
+
+KEY_PREFIX = "eak_"
+DEFAULT_USER_EMAIL = "a@aiemailnewsletter.com"
+
+_REVOKED_CHANNEL = "auth:api-keys:revoked"
+
+_bearer = HTTPBearer(auto_error=False)
+_header = APIKeyHeader(name="X-API-Key", auto_error=False)
+
+
+@dataclass(frozen=True)
+class Principal:
+    """Who a request acts for; ``api_key_id`` is None for the keyless default user."""
+
+    user_id: int
+    api_key_id: Optional[int] = None
+    is_admin: bool = False
+
+
+@dataclass(frozen=True)
+class _KeyRecord:
+    key_id: int
+    user_id: int
+    is_admin: bool = False
+    # epoch seconds
+    expires_at: Optional[float] = None
+
+
+class _UnknownKey(Exception):
+    """The key does not exist, is revoked or belongs to a deactivated user."""
+
+
+_keys: TTLCache[_KeyRecord] = TTLCache(
+    ttl_seconds=settings.api_key_cache_ttl_seconds, maxsize=settings.api_key_cache_size
+)
+# hashes of unknown keys; bounded separately so misses never displace valid keys
+_misses: TTLCache[bool] = TTLCache(ttl_seconds=10.0, maxsize=1024)
+_default_user: TTLCache[Principal] = TTLCache(ttl_seconds=3600.0, maxsize=1)
+# key id -> epoch seconds of its latest use, waiting for the next flush
+_last_used: dict[int, float] = {}
+
+
+def hash_key(key: str) -> str:
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+
+def generate_key() -> tuple[str, str]:
+    """A new key and the hash to store for it; the key itself is shown once and never kept."""
+    key = KEY_PREFIX + secrets.token_urlsafe(32)
+    return key, hash_key(key)
+
+
+def _epoch(value: Optional[datetime]) -> Optional[float]:
+    if value is None:
+        return None
+    # SQLite hands back naive datetimes; they are stored in UTC
+    return (value if value.tzinfo else value.replace(tzinfo=timezone.utc)).timestamp()
+
+
+async def _lookup(key_hash: str) -> _KeyRecord:
+    # raises instead of returning a sentinel so that the miss is not cached in ``_keys``
+    async with AsyncSessionLocal() as db:
+        row = (await db.execute(
+            select(ApiKey.id, ApiKey.user_id, ApiKey.expires_at, User.is_admin)
+            .join(User, User.id == ApiKey.user_id)
+            .where(ApiKey.key_hash == key_hash, ApiKey.is_active.is_(True), User.is_active.is_(True))
+        )).one_or_none()
+    if row is None:
+        raise _UnknownKey
+    return _KeyRecord(
+        key_id=row.id, user_id=row.user_id, is_admin=row.is_admin, expires_at=_epoch(row.expires_at)
+    )
+
+
+async def get_default_user(db: AsyncSession) -> User:
+    """Get or create default user for campaigns"""
+    user = (await db.execute(select(User).where(User.email == DEFAULT_USER_EMAIL))).scalar_one_or_none()
+
+    if user is None:
+        user = User(email=DEFAULT_USER_EMAIL, name="Admin User", is_active=True)
+        db.add(user)
+        await db.commit()
+
+    return user
+
+
+async def _load_default_principal() -> Principal:
+    async with AsyncSessionLocal() as db:
+        # a keyless request is anonymous: never an admin, whatever the default user's flag says
+        return Principal(user_id=(await get_default_user(db)).id)
+
+
+async def current_user(
+    bearer: Optional[HTTPAuthorizationCredentials] = Depends(_bearer),
+    header_key: Optional[str] = Depends(_header),
+) -> Principal:
+    """FastAPI dependency resolving the caller; 401 for a bad key, or for none when one is required."""
+    key = header_key or (bearer.credentials if bearer is not None else None)
+    if not key:
+        if settings.api_auth_required:
+            raise HTTPException(
+                status_code=401, detail="API key required", headers={"WWW-Authenticate": "Bearer"}
+            )
+        return await _default_user.get_or_compute_async("default", _load_default_principal)
+
+    key_hash = hash_key(key)
+    invalid = HTTPException(
+        status_code=401, detail="Invalid or expired API key", headers={"WWW-Authenticate": "Bearer"}
+    )
+    if _misses.get(key_hash):
+        raise invalid
+    try:
+        record = await _keys.get_or_compute_async(key_hash, lambda: _lookup(key_hash))
+    except _UnknownKey:
+        _misses.set(key_hash, True)
+        raise invalid from None
+    now = time.time()
+    if record.expires_at is not None and record.expires_at <= now:
+        raise invalid
+    _last_used[record.key_id] = now
+    return Principal(user_id=record.user_id, api_key_id=record.key_id, is_admin=record.is_admin)
+
+
+async def require_admin(principal: Principal = Depends(current_user)) -> Principal:
+    """FastAPI dependency for operator endpoints; 403 unless an admin user's key was presented."""
+    if principal.api_key_id is None or not principal.is_admin:
+        raise HTTPException(status_code=403, detail="Admin access required")
+    return principal
+
+
+async def require_api_key(principal: Principal = Depends(current_user)) -> Principal:
+    """FastAPI dependency for endpoints the keyless default user may not use; 401 without a key."""
+    if principal.api_key_id is None:
+        raise HTTPException(
+            status_code=401, detail="An API key is required for this endpoint", headers={"WWW-Authenticate": "Bearer"}
+        )
+    return principal
+
+
+async def flush_last_used() -> int:
+    """Write the pending ``last_used_at`` stamps in one statement; returns how many keys were updated."""
+    if not _last_used:
+        return 0
+    pending = dict(_last_used)
+    _last_used.clear()
+    table = ApiKey.__table__
+    stmt = (
+        update(table)
+        .where(
+            table.c.id == bindparam("b_id"),
+            # another process may already have stored a later use
+            or_(table.c.last_used_at.is_(None), table.c.last_used_at < bindparam("b_ts")),
+        )
+        .values(last_used_at=bindparam("b_ts"))
+    )
+    rows = [
+        {"b_id": key_id, "b_ts": datetime.fromtimestamp(ts, tz=timezone.utc)} for key_id, ts in pending.items()
+    ]
+    try:
+        async with AsyncSessionLocal() as db:
+            await db.execute(stmt, rows)
+            await db.commit()
+    except Exception:
+        # keep the stamps for the next flush unless newer ones arrived meanwhile
+        for key_id, ts in pending.items():
+            _last_used[key_id] = max(ts, _last_used.get(key_id, 0.0))
+        raise
+    return len(rows)
+
+
+async def _flush_forever() -> None:
+    while True:
+        await asyncio.sleep(settings.api_key_last_used_flush_seconds)
+        try:
+            await flush_last_used()
+        except Exception as e:
+            log.warning("api_key_last_used_flush_failed", error=str(e))
+
+
+async def _listen_for_revocations() -> None:
+    while True:
+        pubsub = get_async_redis().pubsub()
+        try:
+            await pubsub.subscribe(_REVOKED_CHANNEL)
+            # anything revoked while we were not listening may still be cached
+            _keys.clear()
+            while True:
+                message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=30.0)
+                if message is not None:
+                    _keys.invalidate(json.loads(message["data"])["key_hash"])
+        except redis.RedisError as e:
+            log.warning("api_key_revocations_unavailable", error=str(e))
+        finally:
+            try:
+                await pubsub.aclose()
+            except redis.RedisError:
+                pass
+        await asyncio.sleep(5.0)
+
+
+_background: list[asyncio.Task] = []
+
+
+async def start_background() -> None:
+    """Start the ``last_used_at`` flusher and the revocation listener of this API process."""
+    _background.append(asyncio.create_task(_flush_forever()))
+    _background.append(asyncio.create_task(_listen_for_revocations()))
+
+
+async def stop_background() -> None:
+    for task in _background:
+        task.cancel()
+    await asyncio.gather(*_background, return_exceptions=True)
+    _background.clear()
+    try:
+        await flush_last_used()
+    except Exception as e:
+        log.warning("api_key_last_used_flush_failed", error=str(e))
+
+
+def announce_revoked(key_hash: str) -> None:
+    """Tell every API process to forget a key; blocking, like the other Redis publishers."""
+    _keys.invalidate(key_hash)
+    try:
+        get_redis().publish(_REVOKED_CHANNEL, json.dumps({"key_hash": key_hash}))
+    except redis.RedisError as e:
+        # other processes drop it when their cache entry expires
+        log.warning("api_key_revocation_publish_failed", error=str(e))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(prog="python -m app.auth", description=__doc__.split("\n\n")[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+    create = commands.add_parser("create", help="issue a key for a user and print it once")
+    create.add_argument("email")
+    create.add_argument("name")
+    create.add_argument("--days", type=int, default=None, help="expire the key after this many days")
+    listing = commands.add_parser("list", help="list a user's keys")
+    listing.add_argument("email")
+    revoke = commands.add_parser("revoke", help="revoke a key by id")
+    revoke.add_argument("key_id", type=int)
+    admin = commands.add_parser("admin", help="let a user call operator endpoints")
+    admin.add_argument("email")
+    admin.add_argument("--off", action="store_true", help="take the permission away instead")
+    args = parser.parse_args()
+
+    with SessionLocal() as db:
+        if args.command == "revoke":
+            api_key = db.get(ApiKey, args.key_id)
+            if api_key is None:
+                raise SystemExit(f"no API key {args.key_id}")
+            api_key.is_active = False
+            db.commit()
+            announce_revoked(api_key.key_hash)
+            return
+
+        user = db.execute(select(User).where(User.email == args.email)).scalar_one_or_none()
+        if user is None:
+            raise SystemExit(f"no user {args.email}")
+        if args.command == "admin":
+            # cached key lookups pick the change up within API_KEY_CACHE_TTL_SECONDS
+            user.is_admin = not args.off
+            db.commit()
+        elif args.command == "create":
+            key, key_hash = generate_key()
+            expires_at = datetime.now(timezone.utc) + timedelta(days=args.days) if args.days else None
+            db.add(ApiKey(user_id=user.id, key_name=args.name, key_hash=key_hash, expires_at=expires_at))
+            db.commit()
+            print(key)
+        else:
+            for k in db.scalars(select(ApiKey).where(ApiKey.user_id == user.id).order_by(ApiKey.id)):
+                state = "active" if k.is_active else "revoked"
+                print(f"{k.id:>6}  {k.key_name:<24}{state:<9}last used {k.last_used_at or 'never'}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+from __future__ import annotations
+
+import asyncio
+import threading
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Generic, Hashable, Optional, TypeVar
+
+V = TypeVar("V")
+
+
+class _Call(Generic[V]):
+    def __init__(self) -> None:
+        self.done = threading.Event()
+        self.value: Optional[V] = None
+        self.error: Optional[BaseException] = None
+
+
+class TTLCache(Generic[V]):
+    """Thread-safe in-process cache with per-entry TTL and LRU bounding.
+
+    Concurrent misses for the same key share one call to ``compute``: the
+    first caller runs it and the others wait for its result. The ``_async``
+    variant does the same for coroutines on one event loop.
+    """
+
+    def __init__(self, ttl_seconds: float, maxsize: int = 1024) -> None:
+        self.ttl_seconds = ttl_seconds
+        self.maxsize = maxsize
+        self._entries: OrderedDict[Hashable, tuple[float, V]] = OrderedDict()
+        self._inflight: dict[Hashable, _Call[V]] = {}
+        self._inflight_async: dict[Hashable, asyncio.Future[V]] = {}
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Optional[V]:
+        with self._lock:
+            return self._get_locked(key, time.monotonic())
+
+    def set(self, key: Hashable, value: V) -> None:
+        with self._lock:
+            self._set_locked(key, value, time.monotonic())
+
+    def get_or_compute(self, key: Hashable, compute: Callable[[], V]) -> V:
+        with self._lock:
+            hit = self._get_locked(key, time.monotonic())
+            if hit is not None:
+                return hit
+            call = self._inflight.get(key)
+            leader = call is None
+            if leader:
+                call = self._inflight[key] = _Call()
+        assert call is not None
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.value  # type: ignore[return-value]
+
+        try:
+            call.value = compute()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+                if call.error is None:
+                    self._set_locked(key, call.value, time.monotonic())  # type: ignore[arg-type]
+            call.done.set()
+        return call.value
+
+    async def get_or_compute_async(self, key: Hashable, compute: Callable[[], Awaitable[V]]) -> V:
+        hit = self.get(key)
+        if hit is not None:
+            return hit
+        loop = asyncio.get_running_loop()
+        pending = self._inflight_async.get(key)
+        if pending is not None and pending.get_loop() is loop:
+            return await asyncio.shield(pending)
+
+        future: asyncio.Future[V] = loop.create_future()
+        self._inflight_async[key] = future
+        try:
+            value = await compute()
+        except BaseException as e:
+            future.set_exception(e)
+            # nobody may be waiting; keep asyncio from logging it as unretrieved
+            future.exception()
+            raise
+        finally:
+            self._inflight_async.pop(key, None)
+        self.set(key, value)
+        future.set_result(value)
+        return value
+
+    def invalidate(self, key: Hashable) -> None:
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def _get_locked(self, key: Hashable, now: float) -> Optional[V]:
+        hit = self._entries.get(key)
+        if hit is None:
+            return None
+        if hit[0] <= now:
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return hit[1]
+
+    def _set_locked(self, key: Hashable, value: V, now: float) -> None:
+        self._entries[key] = (now + self.ttl_seconds, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
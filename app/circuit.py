@@ -0,0 +1,257 @@
+"""Circuit breakers for SMTP servers, shared by every sender through Redis.
+
+Connecting, TLS and EHLO failures count against the host and port; AUTH
+failures count against the host, port and username, so one customer's
+wrong password never blocks a shared provider for everyone else. After
+CIRCUIT_FAILURE_THRESHOLD failures less than CIRCUIT_FAILURE_WINDOW_SECONDS
+apart a circuit opens: connecting fails at once with ``CircuitOpenError``
+instead of waiting out a 30-second timeout. Once the open period has passed
+one caller gets to probe with a real connection; success closes the circuit,
+failure reopens it for twice as long, up to CIRCUIT_OPEN_MAX_SECONDS.
+"""
+from __future__ import annotations
+
+import hashlib
+import smtplib
+from contextlib import asynccontextmanager, contextmanager
+from functools import lru_cache
+from typing import AsyncIterator, Iterator, Optional
+
+import aiosmtplib
+import redis
+
+from .config import settings
+from .email_sender import TransientSMTPError
+from .logs import get_logger
+from .redis_client import get_async_redis, get_redis
+
+log = get_logger(__name__)
+
+CLOSED, PROBE, OPEN = 0, 1, 2
+
+# KEYS[1] circuit hash (failures, opened_until ms, opens), KEYS[2] probe lock
+# ARGV[1] probe lock ttl ms
+# Returns {state, n}: CLOSED with n failures so far, PROBE, or OPEN with n ms
+# until the next probe may start.
+_ALLOW_SCRIPT = """
+local t = redis.call('TIME')
+local now_ms = tonumber(t[1]) * 1000 + math.floor(tonumber(t[2]) / 1000)
+local c = redis.call('HMGET', KEYS[1], 'failures', 'opened_until')
+local opened_until = tonumber(c[2] or '0')
+if opened_until == 0 then
+  return {0, tonumber(c[1] or '0')}
+end
+if now_ms < opened_until then
+  return {2, opened_until - now_ms}
+end
+if redis.call('SET', KEYS[2], '1', 'NX', 'PX', ARGV[1]) then
+  return {1, 0}
+end
+return {2, math.max(1, redis.call('PTTL', KEYS[2]))}
+"""
+
+# KEYS[1] circuit hash, KEYS[2] probe lock
+# ARGV[1] "1" for a success, ARGV[2] failure threshold, ARGV[3] failure window ms,
+# ARGV[4] first open period ms, ARGV[5] longest open period ms
+# Returns the ms the circuit is now open for, 0 while it is closed.
+_RECORD_SCRIPT = """
+if ARGV[1] == '1' then
+  redis.call('DEL', KEYS[1], KEYS[2])
+  return 0
+end
+local t = redis.call('TIME')
+local now_ms = tonumber(t[1]) * 1000 + math.floor(tonumber(t[2]) / 1000)
+local c = redis.call('HMGET', KEYS[1], 'failures', 'opened_until', 'opens')
+local opened_until = tonumber(c[2] or '0')
+if now_ms < opened_until then
+  -- an attempt that started before the circuit opened
+  return opened_until - now_ms
+end
+local failures = tonumber(c[1] or '0') + 1
+if opened_until > 0 or failures >= tonumber(ARGV[2]) then
+  local opens = tonumber(c[3] or '0') + 1
+  local open_ms = math.min(tonumber(ARGV[5]), tonumber(ARGV[4]) * 2 ^ (opens - 1))
+  redis.call('HSET', KEYS[1], 'failures', 0, 'opened_until', now_ms + open_ms, 'opens', opens)
+  redis.call('PEXPIRE', KEYS[1], open_ms + tonumber(ARGV[5]))
+  redis.call('DEL', KEYS[2])
+  return open_ms
+end
+redis.call('HSET', KEYS[1], 'failures', failures)
+redis.call('PEXPIRE', KEYS[1], ARGV[3])
+return 0
+"""
+
+_AUTH_ERRORS = (smtplib.SMTPAuthenticationError, aiosmtplib.SMTPAuthenticationError)
+
+
+class CircuitOpenError(TransientSMTPError):
+    """Connecting was skipped because the server's circuit is open."""
+
+    def __init__(self, target: str, retry_after: float) -> None:
+        super().__init__(f"SMTP server {target} is failing; next connection attempt in {retry_after:.0f}s")
+        self.retry_after = retry_after
+
+
+def circuit_key(smtp_host: str, smtp_port: int, smtp_username: Optional[str] = None) -> str:
+    target = f"{smtp_host.lower()}:{smtp_port}"
+    if smtp_username is None:
+        return f"circuit:smtp:{target}"
+    digest = hashlib.sha256(f"{target}:{smtp_username}".encode("utf-8")).hexdigest()[:16]
+    return f"circuit:smtp-auth:{digest}"
+
+
+def _probe_key(key: str) -> str:
+    return key + ":probe"
+
+
+def _record_args(ok: bool) -> list:
+    return [
+        "1" if ok else "0",
+        settings.circuit_failure_threshold,
+        int(settings.circuit_failure_window_seconds * 1000),
+        int(settings.circuit_open_seconds * 1000),
+        int(settings.circuit_open_max_seconds * 1000),
+    ]
+
+
+def _probe_ttl_ms() -> int:
+    # outlives one connection attempt so a slow probe is not joined by a second
+    return 35_000
+
+
+@lru_cache(maxsize=1)
+def _scripts():  # noqa: ANN202
+    client = get_redis()
+    return client.register_script(_ALLOW_SCRIPT), client.register_script(_RECORD_SCRIPT)
+
+
+@lru_cache(maxsize=1)
+def _scripts_async():  # noqa: ANN202
+    client = get_async_redis()
+    return client.register_script(_ALLOW_SCRIPT), client.register_script(_RECORD_SCRIPT)
+
+
+class _Attempt:
+    """The circuits one connection attempt is checked against and reports to."""
+
+    def __init__(self, smtp_host: str, smtp_port: int, smtp_username: str) -> None:
+        self.target = f"{smtp_host}:{smtp_port}"
+        self.host_key = circuit_key(smtp_host, smtp_port)
+        self.auth_key = circuit_key(smtp_host, smtp_port, smtp_username)
+        # circuits that must hear about a success: probing or with failures counted
+        self.dirty: list[str] = []
+        # probe locks this attempt holds
+        self.probes: list[str] = []
+
+    def check(self, key: str, state: int, n: int) -> None:
+        if state == OPEN:
+            raise CircuitOpenError(self.target, n / 1000.0)
+        if state == PROBE:
+            self.probes.append(_probe_key(key))
+        if state == PROBE or n:
+            self.dirty.append(key)
+
+    def failed_key(self, exc: BaseException) -> str:
+        return self.auth_key if isinstance(exc, _AUTH_ERRORS) else self.host_key
+
+    def log_opened(self, exc: BaseException, open_ms: int) -> None:
+        if open_ms:
+            log.warning("smtp_circuit_open", target=self.target, seconds=open_ms / 1000.0, error=str(exc))
+
+
+def _release_probes(attempt: _Attempt) -> None:
+    # no probe result for these circuits after all (the other circuit is open
+    # or failed, or the attempt was interrupted); the next caller may probe at once
+    if attempt.probes:
+        try:
+            get_redis().delete(*attempt.probes)
+        except redis.RedisError as e:
+            log.warning("circuit_record_failed", target=attempt.target, error=str(e))
+
+
+async def _release_probes_async(attempt: _Attempt) -> None:
+    if attempt.probes:
+        try:
+            await get_async_redis().delete(*attempt.probes)
+        except redis.RedisError as e:
+            log.warning("circuit_record_failed", target=attempt.target, error=str(e))
+
+
+@contextmanager
+def guard(smtp_host: str, smtp_port: int, smtp_username: str) -> Iterator[None]:
+    """Wrap opening an SMTP connection; raises ``CircuitOpenError`` while the server is failing.
+
+    Redis trouble never blocks sending: the breaker then lets everything through.
+    """
+    if not settings.circuit_enabled:
+        yield
+        return
+    attempt = _Attempt(smtp_host, smtp_port, smtp_username)
+    allow, record = _scripts()
+    try:
+        for key in (attempt.host_key, attempt.auth_key):
+            state, n = allow(keys=[key, _probe_key(key)], args=[_probe_ttl_ms()])
+            attempt.check(key, state, n)
+    except CircuitOpenError:
+        _release_probes(attempt)
+        raise
+    except redis.RedisError as e:
+        log.warning("circuit_check_failed", target=attempt.target, error=str(e))
+        attempt.dirty.clear()
+    try:
+        yield
+    except Exception as e:
+        key = attempt.failed_key(e)
+        try:
+            attempt.log_opened(e, record(keys=[key, _probe_key(key)], args=_record_args(False)))
+        except redis.RedisError as re:
+            log.warning("circuit_record_failed", target=attempt.target, error=str(re))
+        # a probe of the other circuit proved nothing about it
+        _release_probes(attempt)
+        raise
+    except BaseException:
+        _release_probes(attempt)
+        raise
+    try:
+        for key in attempt.dirty:
+            record(keys=[key, _probe_key(key)], args=_record_args(True))
+    except redis.RedisError as e:
+        log.warning("circuit_record_failed", target=attempt.target, error=str(e))
+
+
+@asynccontextmanager
+async def guard_async(smtp_host: str, smtp_port: int, smtp_username: str) -> AsyncIterator[None]:
+    if not settings.circuit_enabled:
+        yield
+        return
+    attempt = _Attempt(smtp_host, smtp_port, smtp_username)
+    allow, record = _scripts_async()
+    try:
+        for key in (attempt.host_key, attempt.auth_key):
+            state, n = await allow(keys=[key, _probe_key(key)], args=[_probe_ttl_ms()])
+            attempt.check(key, state, n)
+    except CircuitOpenError:
+        await _release_probes_async(attempt)
+        raise
+    except redis.RedisError as e:
+        log.warning("circuit_check_failed", target=attempt.target, error=str(e))
+        attempt.dirty.clear()
+    try:
+        yield
+    except Exception as e:
+        key = attempt.failed_key(e)
+        try:
+            attempt.log_opened(e, await record(keys=[key, _probe_key(key)], args=_record_args(False)))
+        except redis.RedisError as re:
+            log.warning("circuit_record_failed", target=attempt.target, error=str(re))
+        # a probe of the other circuit proved nothing about it
+        await _release_probes_async(attempt)
+        raise
+    except BaseException:
+        await _release_probes_async(attempt)
+        raise
+    try:
+        for key in attempt.dirty:
+            await record(keys=[key, _probe_key(key)], args=_record_args(True))
+    except redis.RedisError as e:
+        log.warning("circuit_record_failed", target=attempt.target, error=str(e))
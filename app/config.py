@@ -8,6 +8,119 @@ class Settings(BaseSettings):
     encryption_key: str = Field(alias="ENCRYPTION_KEY")
     smtp_default_from: str | None = Field(default=None, alias="SMTP_DEFAULT_FROM")
 
+    # Structured logs: LOG_FORMAT is "json" or "text"
+    log_level: str = Field(default="INFO", alias="LOG_LEVEL")
+    log_format: str = Field(default="json", alias="LOG_FORMAT")
+    # Prometheus ports, apart from the public API port; 0 disables
+    api_metrics_port: int = Field(default=9102, alias="API_METRICS_PORT")
+    worker_metrics_port: int = Field(default=9100, alias="WORKER_METRICS_PORT")
+    scheduler_metrics_port: int = Field(default=9101, alias="SCHEDULER_METRICS_PORT")
+
+    # "celery" (send_next_email chain) or "async" (python -m app.async_engine;
+    # one engine sends at a time, further ones wait as standbys)
+    send_engine: str = Field(default="celery", alias="SEND_ENGINE")
+    async_engine_max_connections: int = Field(default=2000, alias="ASYNC_ENGINE_MAX_CONNECTIONS")
+    async_engine_connections_per_campaign: int = Field(default=4, alias="ASYNC_ENGINE_CONNECTIONS_PER_CAMPAIGN")
+    async_engine_poll_seconds: float = Field(default=2.0, alias="ASYNC_ENGINE_POLL_SECONDS")
+
+    # Batched dispatch: most recipients one send_next_email task drains over one SMTP session
+    send_batch_size: int = Field(default=1, alias="SEND_BATCH_SIZE")
+    # A claimed (in_flight) recipient is handed to another sender after this long
+    recipient_lease_seconds: int = Field(default=600, alias="RECIPIENT_LEASE_SECONDS")
+    smtp_max_messages_per_connection: int = Field(default=100, alias="SMTP_MAX_MESSAGES_PER_CONNECTION")
+
+    # Transient failures (4xx, dropped connections) are retried with exponential
+    # backoff; a recipient fails for good after SEND_MAX_ATTEMPTS attempts
+    send_max_attempts: int = Field(default=5, alias="SEND_MAX_ATTEMPTS")
+    retry_backoff_seconds: float = Field(default=60.0, alias="RETRY_BACKOFF_SECONDS")
+    retry_backoff_max_seconds: float = Field(default=3600.0, alias="RETRY_BACKOFF_MAX_SECONDS")
+
+    # AIMD pacing per SMTP account: a throttling reply multiplies its rate by
+    # ADAPTIVE_RATE_DECREASE (at most once per cooldown, never below the floor);
+    # each second of unthrottled sending adds ADAPTIVE_RATE_INCREASE_PER_SECOND
+    # of the campaign's configured rate back
+    adaptive_rate_enabled: bool = Field(default=True, alias="ADAPTIVE_RATE_ENABLED")
+    adaptive_rate_decrease: float = Field(default=0.5, alias="ADAPTIVE_RATE_DECREASE")
+    adaptive_rate_increase_per_second: float = Field(default=0.01, alias="ADAPTIVE_RATE_INCREASE_PER_SECOND")
+    adaptive_rate_floor: float = Field(default=0.02, alias="ADAPTIVE_RATE_FLOOR")
+    adaptive_rate_cooldown_seconds: float = Field(default=5.0, alias="ADAPTIVE_RATE_COOLDOWN_SECONDS")
+
+    # Circuit breaker per SMTP server (and per account for AUTH failures): after
+    # CIRCUIT_FAILURE_THRESHOLD connect failures less than the window apart,
+    # connecting fails fast for CIRCUIT_OPEN_SECONDS, doubling up to the max
+    # while the periodic probe connection keeps failing
+    circuit_enabled: bool = Field(default=True, alias="CIRCUIT_ENABLED")
+    circuit_failure_threshold: int = Field(default=5, alias="CIRCUIT_FAILURE_THRESHOLD")
+    circuit_failure_window_seconds: float = Field(default=60.0, alias="CIRCUIT_FAILURE_WINDOW_SECONDS")
+    circuit_open_seconds: float = Field(default=30.0, alias="CIRCUIT_OPEN_SECONDS")
+    circuit_open_max_seconds: float = Field(default=600.0, alias="CIRCUIT_OPEN_MAX_SECONDS")
+
+    # Write-behind delivery results: flushed per this many results or this often
+    result_flush_batch_size: int = Field(default=500, alias="RESULT_FLUSH_BATCH_SIZE")
+    result_flush_interval_seconds: float = Field(default=1.0, alias="RESULT_FLUSH_INTERVAL_SECONDS")
+
+    # Rows per COPY / executemany batch in POST /campaigns/{id}/recipients/bulk
+    ingest_batch_size: int = Field(default=5000, alias="INGEST_BATCH_SIZE")
+
+    # GET /campaigns/{id}/status results are shared for this long per API process
+    status_cache_ttl_seconds: float = Field(default=1.0, alias="STATUS_CACHE_TTL_SECONDS")
+
+    # Minimum spacing of pushed updates on GET /campaigns/{id}/events
+    progress_stream_interval_seconds: float = Field(default=0.5, alias="PROGRESS_STREAM_INTERVAL_SECONDS")
+
+    # Celery worker pool: slots per worker process, and how many worker
+    # processes run (the scheduler sizes its fair-share cap from both)
+    worker_concurrency: int = Field(default=8, alias="WORKER_CONCURRENCY")
+    worker_count: int = Field(default=1, alias="WORKER_COUNT")
+
+    # Central scheduler (python -m app.scheduler) for the Celery engine
+    scheduler_tick_seconds: float = Field(default=0.05, alias="SCHEDULER_TICK_SECONDS")
+    scheduler_refresh_seconds: float = Field(default=2.0, alias="SCHEDULER_REFRESH_SECONDS")
+    scheduler_lease_seconds: int = Field(default=300, alias="SCHEDULER_LEASE_SECONDS")
+    scheduler_senders_per_campaign: int = Field(default=1, alias="SCHEDULER_SENDERS_PER_CAMPAIGN")
+    # Fair share between users: at most SCHEDULER_MAX_IN_FLIGHT send tasks at once
+    # (unset = WORKER_COUNT x WORKER_CONCURRENCY; 0 = no cap, grants are only
+    # ordered fairly), split by users.send_weight; a user may borrow idle capacity
+    # up to SCHEDULER_TENANT_MAX_SHARE of the total
+    scheduler_max_in_flight: int | None = Field(default=None, alias="SCHEDULER_MAX_IN_FLIGHT")
+    scheduler_tenant_max_share: float = Field(default=0.5, alias="SCHEDULER_TENANT_MAX_SHARE")
+    # Send tasks are spread over this many queues (send.0, send.1, ...), see app.routing
+    send_queue_shards: int = Field(default=1, alias="SEND_QUEUE_SHARDS")
+    # GET /queues/ results are shared for this long per API process
+    queue_stats_cache_ttl_seconds: float = Field(default=15.0, alias="QUEUE_STATS_CACHE_TTL_SECONDS")
+    # Optional shared limit per SMTP account across all of its campaigns
+    smtp_account_limit_count: int | None = Field(default=None, alias="SMTP_ACCOUNT_LIMIT_COUNT")
+    smtp_account_limit_window_seconds: int = Field(default=60, alias="SMTP_ACCOUNT_LIMIT_WINDOW_SECONDS")
+
+    # Per-process suppression index: new entries are picked up this often,
+    # and the whole index is rebuilt (dropping removed entries) this often
+    suppression_refresh_seconds: float = Field(default=5.0, alias="SUPPRESSION_REFRESH_SECONDS")
+    suppression_reload_seconds: float = Field(default=900.0, alias="SUPPRESSION_RELOAD_SECONDS")
+
+    # POST /smtp/verify: concurrent checks per API process, how long a request
+    # may wait for one to free up (503 after), and how long results are reused
+    smtp_verify_concurrency: int = Field(default=32, alias="SMTP_VERIFY_CONCURRENCY")
+    smtp_verify_queue_seconds: float = Field(default=5.0, alias="SMTP_VERIFY_QUEUE_SECONDS")
+    smtp_verify_cache_ttl_seconds: float = Field(default=30.0, alias="SMTP_VERIFY_CACHE_TTL_SECONDS")
+
+    # API keys: required on every request (otherwise keyless requests act as
+    # the default user), how long each API process trusts a cached lookup, and
+    # how often last_used_at is written back
+    api_auth_required: bool = Field(default=False, alias="API_AUTH_REQUIRED")
+    api_key_cache_ttl_seconds: float = Field(default=60.0, alias="API_KEY_CACHE_TTL_SECONDS")
+    api_key_cache_size: int = Field(default=10000, alias="API_KEY_CACHE_SIZE")
+    api_key_last_used_flush_seconds: float = Field(default=30.0, alias="API_KEY_LAST_USED_FLUSH_SECONDS")
+
+    # Decrypted SMTP credentials kept per worker process
+    credentials_cache_ttl_seconds: float = Field(default=300.0, alias="CREDENTIALS_CACHE_TTL_SECONDS")
+    credentials_cache_size: int = Field(default=1024, alias="CREDENTIALS_CACHE_SIZE")
+
+    # Worker-level pool of authenticated SMTP connections
+    smtp_pool_enabled: bool = Field(default=True, alias="SMTP_POOL_ENABLED")
+    smtp_pool_max_per_host: int = Field(default=4, alias="SMTP_POOL_MAX_PER_HOST")
+    smtp_pool_idle_timeout_seconds: float = Field(default=60.0, alias="SMTP_POOL_IDLE_TIMEOUT_SECONDS")
+    smtp_pool_noop_after_seconds: float = Field(default=5.0, alias="SMTP_POOL_NOOP_AFTER_SECONDS")
+
     class Config:
         env_file = ".env"
         env_file_encoding = "utf-8"
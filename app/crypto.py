@@ -1,11 +1,28 @@
-from cryptography.fernet import Fernet
+"""Encryption of stored SMTP credentials.
 
+To rotate the key, put the new key first in ENCRYPTION_KEY and keep the old
+one after it, deploy, then re-encrypt every campaign's credentials under the
+new key and drop the old one:
+
+    python -m app.crypto rotate
+"""
+import argparse
+import hashlib
+from functools import lru_cache
+
+from cryptography.fernet import Fernet, MultiFernet
+
+from .cache import TTLCache
 from .config import settings
 
 
-def _get_fernet() -> Fernet:
-    # ENCRYPTION_KEY must be a base64 urlsafe key of length 32 bytes
-    return Fernet(settings.encryption_key.encode())
+@lru_cache(maxsize=1)
+def _get_fernet() -> MultiFernet:
+    # ENCRYPTION_KEY must be a base64 urlsafe key of length 32 bytes. For key
+    # rotation it may list several comma-separated keys: the first encrypts,
+    # all of them decrypt.
+    keys = [k.strip() for k in settings.encryption_key.split(",") if k.strip()]
+    return MultiFernet([Fernet(k.encode()) for k in keys])
 
 
 def encrypt_str(value: str) -> str:
@@ -20,3 +37,70 @@ def decrypt_str(token: str) -> str:
     return value.decode("utf-8")
 
 
+def rotate_str(token: str) -> str:
+    """Re-encrypt a token under the primary key."""
+    return _get_fernet().rotate(token.encode("utf-8")).decode("utf-8")
+
+
+# campaign id -> (digest of both ciphertexts, (username, password))
+_credentials: TTLCache[tuple[str, tuple[str, str]]] = TTLCache(
+    ttl_seconds=settings.credentials_cache_ttl_seconds,
+    maxsize=settings.credentials_cache_size,
+)
+
+
+def get_smtp_credentials(campaign_id: int, username_enc: str, password_enc: str) -> tuple[str, str]:
+    """Decrypted SMTP username and password, cached per campaign.
+
+    A changed ciphertext (new settings, or a key rotation) never hits a stale
+    entry because its digest is checked on every lookup; this is what keeps
+    the per-process caches of every worker right without a broadcast.
+    """
+    digest = hashlib.sha256(f"{username_enc}\0{password_enc}".encode("utf-8")).hexdigest()
+    hit = _credentials.get(campaign_id)
+    if hit is not None and hit[0] == digest:
+        return hit[1]
+    creds = (decrypt_str(username_enc), decrypt_str(password_enc))
+    _credentials.set(campaign_id, (digest, creds))
+    return creds
+
+
+def rotate_campaign_credentials(batch_size: int = 500) -> int:
+    """Re-encrypt every campaign's SMTP credentials under the primary key; returns how many campaigns."""
+    # imported here: the models pull in the database engine, which encrypting alone never needs
+    from sqlalchemy import select
+
+    from .db import SessionLocal
+    from .models import Campaign
+
+    rotated = 0
+    last_id = 0
+    with SessionLocal() as db:
+        while True:
+            campaigns = db.scalars(
+                select(Campaign).where(Campaign.id > last_id).order_by(Campaign.id).limit(batch_size)
+            ).all()
+            if not campaigns:
+                return rotated
+            for campaign in campaigns:
+                campaign.smtp_username_enc = rotate_str(campaign.smtp_username_enc)
+                campaign.smtp_password_enc = rotate_str(campaign.smtp_password_enc)
+            # a batch per transaction; an interrupted run can simply be repeated
+            db.commit()
+            rotated += len(campaigns)
+            last_id = campaigns[-1].id
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(prog="python -m app.crypto", description=__doc__.split("\n\n")[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+    rotate = commands.add_parser("rotate", help="re-encrypt stored SMTP credentials under the first ENCRYPTION_KEY")
+    rotate.add_argument("--batch-size", type=int, default=500)
+    args = parser.parse_args()
+
+    if args.command == "rotate":
+        print(f"re-encrypted the credentials of {rotate_campaign_credentials(args.batch_size)} campaigns")
+
+
+if __name__ == "__main__":
+    main()
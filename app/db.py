@@ -1,4 +1,5 @@
 from sqlalchemy import create_engine
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
 from sqlalchemy.orm import sessionmaker, DeclarativeBase
 
 from .config import settings
@@ -13,9 +14,27 @@ _db_url = settings.database_url
 if _db_url.startswith("postgres://"):
     _db_url = _db_url.replace("postgres://", "postgresql+psycopg2://", 1)
 
+
+def _async_url(url: str) -> str:
+    """The same database through an asyncio driver (asyncpg, aiosqlite)."""
+    scheme, sep, rest = url.partition("://")
+    driver = scheme.split("+", 1)[0]
+    if driver == "postgresql":
+        # asyncpg spells libpq's sslmode as ssl
+        return "postgresql+asyncpg://" + rest.replace("sslmode=", "ssl=")
+    if driver == "sqlite":
+        return "sqlite+aiosqlite://" + rest
+    return url
+
+
+# Celery workers, the scheduler and the async delivery engine use the sync engine
 engine = create_engine(_db_url, pool_pre_ping=True, future=True)
 SessionLocal = sessionmaker(bind=engine, autocommit=False, autoflush=False, future=True)
 
+# FastAPI routers use the asyncio engine so slow queries never hold a threadpool worker
+async_db_engine = create_async_engine(_async_url(_db_url), pool_pre_ping=True)
+AsyncSessionLocal = async_sessionmaker(bind=async_db_engine, autoflush=False, expire_on_commit=False)
+
 
 def get_db():
     db = SessionLocal()
@@ -23,3 +42,8 @@ def get_db():
         yield db
     finally:
         db.close()
+
+
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
@@ -0,0 +1,402 @@
+from __future__ import annotations
+
+import json
+import random
+from datetime import datetime, timedelta, timezone
+from typing import Callable, NamedTuple, Optional
+
+from sqlalchemy import (
+    DateTime,
+    Integer,
+    String,
+    Text,
+    and_,
+    cast,
+    column,
+    func,
+    insert,
+    or_,
+    select,
+    update,
+    values,
+)
+from sqlalchemy.orm import Session
+
+from .config import settings
+from .logs import get_logger
+from .models import Campaign, CampaignStatus, Recipient, RecipientStatus, SentEmail, SuppressionReason
+from .suppression import add_suppressions
+
+log = get_logger(__name__)
+
+# Result statuses besides RecipientStatus.sent/failed. Both put the recipient
+# back to pending until ``retry_at``; only a deferral counts as an attempt.
+DEFERRED = "deferred"  # transient failure such as a 4xx reply
+RELEASED = "released"  # never tried: the connection was throttled earlier in the batch
+
+
+def claim_fence(claimed_at: datetime) -> str:
+    """``last_attempt_at`` of a claim in one canonical form, for comparing claims outside the database."""
+    # SQLite hands back naive datetimes; they are stored in UTC
+    if claimed_at.tzinfo is None:
+        claimed_at = claimed_at.replace(tzinfo=timezone.utc)
+    return claimed_at.astimezone(timezone.utc).isoformat()
+
+
+def claim_recipients(
+    db: Session,
+    campaign_id: int,
+    limit: int,
+    lease_seconds: int,
+    journaled: Optional[Callable[[int, list[int]], dict[int, str]]] = None,
+) -> list[Recipient]:
+    """Atomically move up to ``limit`` recipients of a campaign to ``in_flight``.
+
+    Pending rows whose ``retry_at`` has passed are claimed in id order,
+    together with in-flight rows whose lease has expired because their
+    sender died. ``journaled`` maps recipient ids to the claim fence (see
+    ``claim_fence``) of a result still waiting in the write-behind journal;
+    an expired claim with such a result was sent and is not taken again. On
+    PostgreSQL rows locked by a concurrent claim are skipped; elsewhere the
+    UPDATE re-checks that each row is still claimable. The claim is committed
+    before returning; with ``expire_on_commit`` left on the returned rows
+    reload one by one on first access.
+    """
+    now = datetime.now(timezone.utc)
+    claimable = or_(
+        and_(
+            Recipient.status == RecipientStatus.pending,
+            or_(Recipient.retry_at.is_(None), Recipient.retry_at <= now),
+        ),
+        and_(
+            Recipient.status == RecipientStatus.in_flight,
+            Recipient.last_attempt_at < now - timedelta(seconds=lease_seconds),
+        ),
+    )
+    candidates = (
+        select(Recipient.id, Recipient.status, Recipient.last_attempt_at)
+        .where(Recipient.campaign_id == campaign_id, claimable)
+        .order_by(Recipient.id.asc())
+        .limit(max(1, limit))
+    )
+    if db.get_bind().dialect.name == "postgresql":
+        candidates = candidates.with_for_update(skip_locked=True)
+    rows = db.execute(candidates).all()
+
+    expired = [row for row in rows if row.status == RecipientStatus.in_flight]
+    sent: set[int] = set()
+    if expired and journaled is not None:
+        fences = journaled(campaign_id, [row.id for row in expired])
+        sent = {row.id for row in expired if fences.get(row.id) == claim_fence(row.last_attempt_at)}
+        if sent:
+            log.warning("reclaim_skipped_journaled", campaign_id=campaign_id, count=len(sent))
+    ids = [row.id for row in rows if row.id not in sent]
+    if not ids:
+        db.commit()
+        return []
+
+    claimed = db.scalars(
+        update(Recipient)
+        .where(Recipient.id.in_(ids), claimable)
+        .values(status=RecipientStatus.in_flight, last_attempt_at=now)
+        .returning(Recipient)
+        .execution_options(synchronize_session=False, populate_existing=True)
+    ).all()
+    db.commit()
+    return sorted(claimed, key=lambda r: r.id)
+
+
+def has_unfinished(db: Session, campaign_id: int) -> bool:
+    """Whether any recipient is still pending or being sent."""
+    return db.execute(
+        select(Recipient.id).where(
+            Recipient.campaign_id == campaign_id,
+            Recipient.status.in_((RecipientStatus.pending, RecipientStatus.in_flight)),
+        ).limit(1)
+    ).first() is not None
+
+
+def next_retry_in(db: Session, campaign_id: int) -> Optional[float]:
+    """Seconds until the earliest deferred recipient is due, if only deferred ones are left."""
+    now = datetime.now(timezone.utc)
+    ready = db.execute(
+        select(Recipient.id).where(
+            Recipient.campaign_id == campaign_id,
+            or_(
+                Recipient.status == RecipientStatus.in_flight,
+                and_(
+                    Recipient.status == RecipientStatus.pending,
+                    or_(Recipient.retry_at.is_(None), Recipient.retry_at <= now),
+                ),
+            ),
+        ).limit(1)
+    ).first()
+    if ready is not None:
+        return None
+    earliest = db.execute(
+        select(func.min(Recipient.retry_at)).where(
+            Recipient.campaign_id == campaign_id, Recipient.status == RecipientStatus.pending
+        )
+    ).scalar_one_or_none()
+    if earliest is None:
+        return None
+    if earliest.tzinfo is None:
+        earliest = earliest.replace(tzinfo=timezone.utc)
+    return max(0.0, (earliest - now).total_seconds())
+
+
+def retry_at(attempts: int) -> datetime:
+    """When to try again after ``attempts`` earlier attempts: exponential backoff with jitter."""
+    delay = min(settings.retry_backoff_max_seconds, settings.retry_backoff_seconds * 2 ** attempts)
+    return datetime.now(timezone.utc) + timedelta(seconds=delay * random.uniform(0.8, 1.2))
+
+
+class DeliveryResult(NamedTuple):
+    """Outcome of one send, applied to the database later in bulk.
+
+    ``claimed_at`` is the recipient's ``last_attempt_at`` from its claim. It
+    fences the write: a result only lands while the recipient is still
+    in flight under that same claim, so replaying a result is a no-op.
+    ``bounced`` marks a permanent refusal that suppresses the address;
+    ``retry_at`` is set for DEFERRED and RELEASED results.
+    """
+
+    campaign_id: int
+    recipient_id: int
+    claimed_at: datetime
+    status: str
+    finished_at: datetime
+    message_id: Optional[str] = None
+    smtp_response: Optional[str] = None
+    error: Optional[str] = None
+    bounced: bool = False
+    retry_at: Optional[datetime] = None
+
+    @classmethod
+    def sent(
+        cls, recipient: Recipient, message_id: Optional[str], smtp_response: Optional[str]
+    ) -> DeliveryResult:
+        return cls(
+            recipient.campaign_id,
+            recipient.id,
+            recipient.last_attempt_at,
+            RecipientStatus.sent.value,
+            datetime.now(timezone.utc),
+            message_id,
+            smtp_response,
+        )
+
+    @classmethod
+    def failed(cls, recipient: Recipient, err: str, bounced: bool = False) -> DeliveryResult:
+        return cls(
+            recipient.campaign_id,
+            recipient.id,
+            recipient.last_attempt_at,
+            RecipientStatus.failed.value,
+            datetime.now(timezone.utc),
+            error=err,
+            bounced=bounced,
+        )
+
+    @classmethod
+    def deferred(cls, recipient: Recipient, err: str) -> DeliveryResult:
+        return cls(
+            recipient.campaign_id,
+            recipient.id,
+            recipient.last_attempt_at,
+            DEFERRED,
+            datetime.now(timezone.utc),
+            error=err,
+            retry_at=retry_at(recipient.attempts),
+        )
+
+    @classmethod
+    def released(cls, recipient: Recipient, reason: str, after: Optional[float] = None) -> DeliveryResult:
+        """Hand back an untried recipient, due again in ``after`` seconds or the first backoff step."""
+        return cls(
+            recipient.campaign_id,
+            recipient.id,
+            recipient.last_attempt_at,
+            RELEASED,
+            datetime.now(timezone.utc),
+            error=reason,
+            retry_at=retry_at(0) if after is None else datetime.now(timezone.utc) + timedelta(seconds=after),
+        )
+
+    def dumps(self) -> str:
+        return json.dumps([
+            self.campaign_id,
+            self.recipient_id,
+            self.claimed_at.isoformat(),
+            self.status,
+            self.finished_at.isoformat(),
+            self.message_id,
+            self.smtp_response,
+            self.error,
+            self.bounced,
+            self.retry_at.isoformat() if self.retry_at is not None else None,
+        ])
+
+    @classmethod
+    def loads(cls, raw: str | bytes) -> DeliveryResult:
+        # results journaled by older senders lack the trailing fields
+        fields = json.loads(raw) + [False, None]
+        campaign_id, recipient_id, claimed_at, status, finished_at, message_id, smtp_response, error = fields[:8]
+        return cls(
+            campaign_id,
+            recipient_id,
+            datetime.fromisoformat(claimed_at),
+            status,
+            datetime.fromisoformat(finished_at),
+            message_id,
+            smtp_response,
+            error,
+            bool(fields[8]),
+            datetime.fromisoformat(fields[9]) if fields[9] else None,
+        )
+
+
+def _recipient_status(result_status: str) -> RecipientStatus:
+    if result_status in (DEFERRED, RELEASED):
+        return RecipientStatus.pending
+    return RecipientStatus(result_status)
+
+
+def apply_results(db: Session, results: list[DeliveryResult]) -> list[DeliveryResult]:
+    """Write a batch of results: one recipients UPDATE and one sent_emails INSERT.
+
+    Every result but a RELEASED one is logged in sent_emails with the
+    recipient's attempt count, and hard-bounced addresses are added to their
+    owner's suppression list. Returns the results that took effect; the rest
+    were already applied or belong to a claim that has since expired. The
+    caller commits.
+    """
+    if not results:
+        return []
+    if db.get_bind().dialect.name == "postgresql":
+        attempts = _update_recipients_from_values(db, results)
+    else:
+        attempts = _update_recipients_one_by_one(db, results)
+    applied = [r for r in results if r.recipient_id in attempts]
+    logged = [r for r in applied if r.status != RELEASED]
+    if not logged:
+        return applied
+
+    subjects = dict(
+        db.execute(
+            select(Campaign.id, Campaign.subject).where(Campaign.id.in_({r.campaign_id for r in logged}))
+        ).all()
+    )
+    db.execute(
+        insert(SentEmail.__table__),
+        [
+            {
+                "campaign_id": r.campaign_id,
+                "recipient_id": r.recipient_id,
+                "subject": subjects.get(r.campaign_id, ""),
+                "message_id": r.message_id,
+                "smtp_response": r.smtp_response,
+                "status": r.status,
+                "attempts": attempts[r.recipient_id],
+                "delivered_at": r.finished_at if r.status == RecipientStatus.sent.value else None,
+                "error": r.error,
+            }
+            for r in logged
+        ],
+    )
+    bounced = [r.recipient_id for r in logged if r.bounced]
+    if bounced:
+        add_suppressions(
+            db,
+            db.execute(
+                select(Campaign.user_id, Recipient.to_email)
+                .join(Campaign, Campaign.id == Recipient.campaign_id)
+                .where(Recipient.id.in_(bounced))
+            ).all(),
+            SuppressionReason.bounced,
+        )
+    return applied
+
+
+def _update_recipients_from_values(db: Session, results: list[DeliveryResult]) -> dict[int, int]:
+    # UPDATE recipients ... FROM (VALUES ...) RETURNING id, attempts; the casts
+    # keep PostgreSQL from typing all-NULL VALUES columns as text
+    ts = DateTime(timezone=True)
+    v = values(
+        column("id", Integer),
+        column("claimed_at", ts),
+        column("status", String),
+        column("sent_at", ts),
+        column("last_error", Text),
+        column("retry_at", ts),
+        column("attempted", Integer),
+        name="v",
+    ).data([
+        (
+            r.recipient_id,
+            r.claimed_at,
+            _recipient_status(r.status).name,
+            r.finished_at if r.status == RecipientStatus.sent.value else None,
+            r.error,
+            r.retry_at,
+            int(r.status != RELEASED),
+        )
+        for r in results
+    ])
+    stmt = (
+        update(Recipient)
+        .where(
+            Recipient.id == cast(v.c.id, Integer),
+            Recipient.status == RecipientStatus.in_flight,
+            Recipient.last_attempt_at == cast(v.c.claimed_at, ts),
+        )
+        .values(
+            status=cast(v.c.status, Recipient.__table__.c.status.type),
+            sent_at=cast(v.c.sent_at, ts),
+            last_error=cast(v.c.last_error, Text),
+            retry_at=cast(v.c.retry_at, ts),
+            attempts=Recipient.attempts + cast(v.c.attempted, Integer),
+        )
+        .returning(Recipient.id, Recipient.attempts)
+        .execution_options(synchronize_session=False)
+    )
+    return dict(db.execute(stmt).all())
+
+
+def _update_recipients_one_by_one(db: Session, results: list[DeliveryResult]) -> dict[int, int]:
+    applied: dict[int, int] = {}
+    for r in results:
+        sent = r.status == RecipientStatus.sent.value
+        attempts = db.execute(
+            update(Recipient)
+            .where(
+                Recipient.id == r.recipient_id,
+                Recipient.status == RecipientStatus.in_flight,
+                Recipient.last_attempt_at == r.claimed_at,
+            )
+            .values(
+                status=_recipient_status(r.status),
+                sent_at=r.finished_at if sent else None,
+                last_error=r.error,
+                retry_at=r.retry_at,
+                attempts=Recipient.attempts + int(r.status != RELEASED),
+            )
+            .returning(Recipient.attempts)
+            .execution_options(synchronize_session=False)
+        ).scalar_one_or_none()
+        if attempts is not None:
+            applied[r.recipient_id] = attempts
+    return applied
+
+
+def complete_if_done(db: Session, campaign_id: int) -> bool:
+    """Mark a running campaign completed once nothing is left to send; commits."""
+    campaign = db.get(Campaign, campaign_id)
+    if campaign is None or campaign.status != CampaignStatus.running:
+        return False
+    if has_unfinished(db, campaign_id):
+        return False
+    log.info("campaign_completed", campaign_id=campaign_id)
+    campaign.status = CampaignStatus.completed
+    db.commit()
+    return True
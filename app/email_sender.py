@@ -1,10 +1,461 @@
 from __future__ import annotations
 
+import base64
+import re
 import smtplib
 import ssl
+import time
+from email.header import Header
 from email.mime.text import MIMEText
-from email.utils import formataddr
-from typing import Optional, Tuple
+from email.policy import compat32
+from email.utils import formataddr, formatdate, make_msgid
+from functools import lru_cache
+from typing import TYPE_CHECKING, Any, Mapping, Optional, Tuple
+
+from .cache import TTLCache
+from .metrics import timed
+from .templating import compile_lenient, recipient_values
+
+if TYPE_CHECKING:
+    from .smtp_pool import PooledConnection, SMTPConnectionPool
+
+
+_CRLF = compat32.clone(linesep="\r\n")
+_date_header: list = [0, ""]
+
+
+def _current_date() -> str:
+    # RFC 5322 date, formatted at most once per second
+    now = int(time.time())
+    if _date_header[0] != now:
+        _date_header[:] = [now, formatdate(now, usegmt=True)]
+    return _date_header[1]
+
+
+def is_plain_address(address: str) -> bool:
+    """Whether ``address`` can go into headers and RCPT TO as it is."""
+    return address.isascii() and "\r" not in address and "\n" not in address
+
+
+class MessageTemplate:
+    """A campaign message encoded once.
+
+    Headers and body that are the same for every recipient are kept as
+    encoded bytes; ``render`` splices To, Message-ID and Date in front of
+    them. Merge fields (see ``app.templating``) are compiled once, and a
+    personalized body is base64 encoded per distinct set of values, so
+    recipients that share them share the encoded bytes.
+    """
+
+    def __init__(self, from_email: str, from_name: Optional[str], subject: str, body: str) -> None:
+        self.from_email = from_email
+        self._subject = compile_lenient(subject)
+        self._body = compile_lenient(body)
+        self.fields = self._subject.fields | self._body.fields
+        msg = MIMEText(body if self._body.is_static else "", _charset="utf-8")
+        msg["From"] = formataddr((from_name or "", from_email))
+        if self._subject.is_static:
+            msg["Subject"] = subject
+        head, _, tail = msg.as_bytes(policy=_CRLF).partition(b"\r\n\r\n")
+        self._head = head + b"\r\n"
+        self._static_body = tail
+        self._domain = from_email.rpartition("@")[2] or "localhost"
+        self._body_key = tuple(sorted(self._body.fields))
+        # a body that names to_email is unique per recipient; caching it is waste
+        self._bodies: Optional[TTLCache[bytes]] = (
+            TTLCache(ttl_seconds=600, maxsize=4096)
+            if self._body_key and "to_email" not in self._body_key
+            else None
+        )
+
+    def render(
+        self,
+        to_email: str,
+        to_name: Optional[str] = None,
+        attributes: Optional[Mapping[str, Any]] = None,
+    ) -> Tuple[str, bytes]:
+        """Return the Message-ID and the wire bytes for one recipient."""
+        if not is_plain_address(to_email):
+            raise ValueError(f"Unsupported recipient address: {to_email!r}")
+        message_id = make_msgid(domain=self._domain)
+        parts = [
+            b"To: ", to_email.encode("ascii"),
+            b"\r\nMessage-ID: ", message_id.encode("ascii"),
+            b"\r\nDate: ", _current_date().encode("ascii"),
+            b"\r\n", self._head,
+        ]
+        if not self.fields:
+            parts += (b"\r\n", self._static_body)
+            return message_id, b"".join(parts)
+
+        values = recipient_values(to_email, to_name, attributes, self.fields)
+        if not self._subject.is_static:
+            parts.append(_subject_header(self._subject.render(values)))
+        parts.append(b"\r\n")
+        parts.append(self._static_body if self._body.is_static else self._render_body(values))
+        return message_id, b"".join(parts)
+
+    def render_shared(self) -> Tuple[str, bytes]:
+        """Return the Message-ID and wire bytes of one copy for several recipients.
+
+        The To header names none of them, as with Bcc; only a template without
+        merge fields can be shared.
+        """
+        if self.fields:
+            raise ValueError("A personalized message cannot be shared between recipients")
+        message_id = make_msgid(domain=self._domain)
+        return message_id, b"".join((
+            b"To: undisclosed-recipients:;",
+            b"\r\nMessage-ID: ", message_id.encode("ascii"),
+            b"\r\nDate: ", _current_date().encode("ascii"),
+            b"\r\n", self._head,
+            b"\r\n", self._static_body,
+        ))
+
+    def _render_body(self, values: dict[str, str]) -> bytes:
+        if self._bodies is None:
+            return _encode_body(self._body.render(values))
+        key = tuple(values.get(f, "") for f in self._body_key)
+        encoded = self._bodies.get(key)
+        if encoded is None:
+            encoded = _encode_body(self._body.render(values))
+            self._bodies.set(key, encoded)
+        return encoded
+
+
+def _subject_header(subject: str) -> bytes:
+    # merge values come from recipient data and must not start new headers
+    if "\r" in subject or "\n" in subject:
+        subject = subject.replace("\r", " ").replace("\n", " ")
+    if subject.isascii() and len(subject) <= 900:
+        return b"Subject: " + subject.encode("ascii") + b"\r\n"
+    return b"Subject: " + Header(subject, "utf-8", header_name="Subject").encode(linesep="\r\n").encode("ascii") + b"\r\n"
+
+
+def _encode_body(body: str) -> bytes:
+    return base64.encodebytes(body.encode("utf-8")).replace(b"\n", b"\r\n")
+
+
+@lru_cache(maxsize=1)
+def get_ssl_context() -> ssl.SSLContext:
+    # Building a context loads the CA bundle; do it once per process
+    return ssl.create_default_context()
+
+
+def open_smtp_connection(
+    smtp_host: str,
+    smtp_port: int,
+    smtp_username: str,
+    smtp_password: str,
+    use_starttls: bool,
+    use_ssl: bool = False,
+    timeout: int = 30,
+) -> smtplib.SMTP:
+    """Connect and authenticate. The caller owns the returned connection.
+
+    With implicit SSL the TLS handshake is part of the "connect" stage.
+    """
+    with timed("connect"):
+        if use_ssl:
+            server: smtplib.SMTP = smtplib.SMTP_SSL(
+                host=smtp_host, port=smtp_port, context=get_ssl_context(), timeout=timeout
+            )
+        else:
+            server = smtplib.SMTP(host=smtp_host, port=smtp_port, timeout=timeout)
+    try:
+        if not use_ssl:
+            server.ehlo()
+            if use_starttls:
+                with timed("tls"):
+                    server.starttls(context=get_ssl_context())
+                    server.ehlo()
+        with timed("auth"):
+            server.login(smtp_username, smtp_password)
+    except BaseException:
+        server.close()
+        raise
+    return server
+
+
+class TransientSMTPError(smtplib.SMTPException):
+    """A failure on our side of the conversation that is worth retrying later."""
+
+
+def reply_code(exc: BaseException) -> Optional[int]:
+    """The SMTP reply code behind a failed send, if the server gave one."""
+    if isinstance(exc, smtplib.SMTPRecipientsRefused):
+        return max((code for code, _ in exc.recipients.values()), default=None)
+    if isinstance(exc, smtplib.SMTPResponseException):
+        return exc.smtp_code
+    return None
+
+
+def is_hard_bounce(exc: BaseException) -> bool:
+    """Whether the server permanently refused the recipient (5xx to RCPT TO)."""
+    if isinstance(exc, smtplib.SMTPRecipientsRefused):
+        return bool(exc.recipients) and all(code >= 500 for code, _ in exc.recipients.values())
+    return False
+
+
+# an RFC 3463 enhanced status of class 4.7 (security or policy), e.g. a rate limit
+_POLICY_STATUS = re.compile(r"^\s*4\.7\.\d{1,3}\b")
+
+
+def is_throttle_reply(code: int, reply: Any) -> bool:
+    """Whether a single reply asks us to slow down: 421, or a 4xx with a 4.7.x status."""
+    if code == 421:
+        return True
+    if isinstance(reply, bytes):
+        reply = reply.decode("utf-8", "replace")
+    return 400 <= code < 500 and bool(_POLICY_STATUS.match(str(reply)))
+
+
+def is_throttle(exc: BaseException) -> bool:
+    """Whether the provider wants us to slow down rather than turning one recipient away.
+
+    Any 4xx outside RCPT TO (MAIL FROM, DATA, the greeting) holds back every
+    message on the connection. A plain 450/451 to RCPT TO is greylisting or a
+    full mailbox: only that recipient waits and the batch carries on.
+    """
+    if isinstance(exc, smtplib.SMTPRecipientsRefused):
+        return any(is_throttle_reply(code, reply) for code, reply in exc.recipients.values())
+    code = reply_code(exc)
+    return code is not None and 400 <= code < 500
+
+
+def is_transient(exc: BaseException) -> bool:
+    """Whether retrying the same message later may succeed; 5xx replies and bad input never will."""
+    code = reply_code(exc)
+    if code is not None:
+        return 400 <= code < 500
+    if isinstance(exc, (TransientSMTPError, smtplib.SMTPServerDisconnected)):
+        return True
+    # every SMTPException is an OSError; only socket and TLS errors are worth a retry
+    return isinstance(exc, OSError) and not isinstance(exc, smtplib.SMTPException)
+
+
+def is_connection_failure(exc: BaseException) -> bool:
+    """Whether the connection, not the message, failed: the rest of a batch would fail the same way."""
+    if isinstance(exc, (TransientSMTPError, smtplib.SMTPServerDisconnected, smtplib.SMTPConnectError)):
+        return True
+    if isinstance(exc, (smtplib.SMTPHeloError, smtplib.SMTPAuthenticationError)):
+        return True
+    return isinstance(exc, OSError) and not isinstance(exc, smtplib.SMTPException)
+
+
+def pipelined_sendmail(server: smtplib.SMTP, from_addr: str, to_addrs: list[str], msg: bytes) -> dict:
+    """``server.sendmail`` with MAIL FROM and every RCPT TO written at once (RFC 2920).
+
+    Only for servers that advertise PIPELINING. Returns and raises like ``sendmail``:
+    a dict of refused addresses to ``(code, reply)``, ``SMTPRecipientsRefused``
+    when none was accepted.
+    """
+    server.ehlo_or_helo_if_needed()
+    options = f" SIZE={len(msg)}" if server.has_extn("size") else ""
+    commands = [f"MAIL FROM:{smtplib.quoteaddr(from_addr)}{options}\r\n"]
+    commands += [f"RCPT TO:{smtplib.quoteaddr(addr)}\r\n" for addr in to_addrs]
+    server.send("".join(commands))
+    mail_code, mail_reply = server.getreply()
+    refused = {}
+    for addr in to_addrs:
+        code, reply = server.getreply()
+        if code not in (250, 251):
+            refused[addr] = (code, reply)
+    if mail_code != 250:
+        server._rset()  # noqa: SLF001 - the same recovery sendmail performs
+        raise smtplib.SMTPSenderRefused(mail_code, mail_reply, from_addr)
+    if len(refused) == len(to_addrs):
+        server._rset()  # noqa: SLF001
+        raise smtplib.SMTPRecipientsRefused(refused)
+    code, reply = server.data(msg)
+    if code != 250:
+        server._rset()  # noqa: SLF001
+        raise smtplib.SMTPDataError(code, reply)
+    return refused
+
+
+def _reset(server: smtplib.SMTP) -> bool:
+    """RSET after a failed transaction; whether the connection is still usable."""
+    if server.sock is None:
+        return False
+    try:
+        code, _ = server.rset()
+    except (smtplib.SMTPException, OSError):
+        return False
+    return code == 250
+
+
+def close_quietly(server: smtplib.SMTP) -> None:
+    try:
+        server.quit()
+    except (smtplib.SMTPException, OSError):
+        server.close()
+
+
+class SMTPSession:
+    """One authenticated SMTP connection reused for several messages.
+
+    The connection is opened lazily on the first send and reopened only when
+    the server drops it or ``max_messages`` have gone over it. With a ``pool``
+    the connection is borrowed from it and handed back on close.
+    """
+
+    def __init__(
+        self,
+        smtp_host: str,
+        smtp_port: int,
+        smtp_username: str,
+        smtp_password: str,
+        use_starttls: bool,
+        use_ssl: bool = False,
+        max_messages: int = 100,
+        pool: Optional[SMTPConnectionPool] = None,
+    ) -> None:
+        self.smtp_host = smtp_host
+        self.smtp_port = smtp_port
+        self.smtp_username = smtp_username
+        self.smtp_password = smtp_password
+        self.use_starttls = use_starttls
+        self.use_ssl = use_ssl
+        self.max_messages = max(1, max_messages)
+        self.pool = pool
+        self._server: Optional[smtplib.SMTP] = None
+        self._lease: Optional[PooledConnection] = None
+        self._sent_on_connection = 0
+        self._fresh = True
+        # messages resent on a new connection after the old one was found dead
+        self.retries = 0
+
+    def _connect(self) -> smtplib.SMTP:
+        if self.pool is not None:
+            self._lease = self.pool.acquire(
+                smtp_host=self.smtp_host,
+                smtp_port=self.smtp_port,
+                smtp_username=self.smtp_username,
+                smtp_password=self.smtp_password,
+                use_starttls=self.use_starttls,
+                use_ssl=self.use_ssl,
+            )
+            self._server = self._lease.server
+            self._sent_on_connection = self._lease.messages_sent
+            self._fresh = self._lease.fresh
+            return self._server
+
+        from .circuit import guard
+
+        with guard(self.smtp_host, self.smtp_port, self.smtp_username):
+            self._server = open_smtp_connection(
+                smtp_host=self.smtp_host,
+                smtp_port=self.smtp_port,
+                smtp_username=self.smtp_username,
+                smtp_password=self.smtp_password,
+                use_starttls=self.use_starttls,
+                use_ssl=self.use_ssl,
+            )
+        self._sent_on_connection = 0
+        self._fresh = True
+        return self._server
+
+    def _drop(self) -> None:
+        if self._lease is not None and self.pool is not None:
+            self.pool.discard(self._lease)
+        elif self._server is not None:
+            close_quietly(self._server)
+        self._server = None
+        self._lease = None
+        self._sent_on_connection = 0
+
+    def send(
+        self,
+        from_email: str,
+        from_name: Optional[str],
+        to_email: str,
+        subject: str,
+        body: str,
+    ) -> Tuple[Optional[str], Optional[str]]:
+        return self.send_template(MessageTemplate(from_email, from_name, subject, body), to_email)
+
+    def send_template(
+        self,
+        template: MessageTemplate,
+        to_email: str,
+        to_name: Optional[str] = None,
+        attributes: Optional[Mapping[str, Any]] = None,
+    ) -> Tuple[Optional[str], Optional[str]]:
+        if self._server is not None and self._sent_on_connection >= self.max_messages:
+            self._drop()
+        with timed("render"):
+            message_id, msg = template.render(to_email, to_name, attributes)
+
+        server = self._server or self._connect()
+        try:
+            resp = self._deliver(server, template.from_email, [to_email], msg)
+        except smtplib.SMTPServerDisconnected:
+            if self._fresh:
+                raise
+            # The provider closed an idle connection; retry once on a fresh one
+            self.retries += 1
+            resp = self._deliver(self._connect(), template.from_email, [to_email], msg)
+        return message_id, str(resp) if resp else "250 OK"
+
+    def send_shared(self, template: MessageTemplate, to_emails: list[str]) -> Tuple[str, dict]:
+        """Send one copy of a message without merge fields to several recipients in one transaction.
+
+        Returns the Message-ID and the refused addresses mapped to ``(code, reply)``;
+        raises like ``send_template`` when the transaction as a whole fails.
+        """
+        if self._server is not None and self._sent_on_connection >= self.max_messages:
+            self._drop()
+        with timed("render"):
+            message_id, msg = template.render_shared()
+
+        server = self._server or self._connect()
+        try:
+            refused = self._deliver(server, template.from_email, to_emails, msg)
+        except smtplib.SMTPServerDisconnected:
+            if self._fresh:
+                raise
+            self.retries += 1
+            refused = self._deliver(self._connect(), template.from_email, to_emails, msg)
+        return message_id, refused
+
+    def _deliver(self, server: smtplib.SMTP, from_email: str, to_addrs: list[str], msg: bytes) -> dict:
+        try:
+            with timed("data"):
+                if len(to_addrs) > 1 and server.has_extn("pipelining"):
+                    resp = pipelined_sendmail(server, from_email, to_addrs, msg)
+                else:
+                    resp = server.sendmail(from_addr=from_email, to_addrs=to_addrs, msg=msg)
+        except (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused, smtplib.SMTPDataError):
+            # Message-level rejection; keep the connection only if the server
+            # confirms the transaction is reset (a 421 has already closed it)
+            if _reset(server):
+                self._sent_on_connection += 1
+                self._fresh = False
+            else:
+                self._drop()
+            raise
+        except BaseException:
+            self._drop()
+            raise
+        self._sent_on_connection += 1
+        self._fresh = False
+        return resp
+
+    def close(self) -> None:
+        if self._lease is not None and self.pool is not None:
+            self._lease.messages_sent = self._sent_on_connection
+            self.pool.release(self._lease)
+            self._server = None
+            self._lease = None
+            return
+        self._drop()
+
+    def __enter__(self) -> SMTPSession:
+        return self
+
+    def __exit__(self, *exc_info: object) -> None:
+        self.close()
 
 
 def send_email_smtp(
@@ -20,31 +471,13 @@ def send_email_smtp(
     body: str,
     use_ssl: bool = False,
 ) -> Tuple[Optional[str], Optional[str]]:
-    msg = MIMEText(body, _charset="utf-8")
-    sender = formataddr((from_name or "", from_email))
-    msg["From"] = sender
-    msg["To"] = to_email
-    msg["Subject"] = subject
-
-    if use_ssl:
-        context = ssl.create_default_context()
-        with smtplib.SMTP_SSL(host=smtp_host, port=smtp_port, context=context, timeout=30) as server:
-            server.login(smtp_username, smtp_password)
-            resp = server.sendmail(from_addr=from_email, to_addrs=[to_email], msg=msg.as_string())
-            return None, str(resp) if resp else "250 OK"
-
-    if use_starttls:
-        context = ssl.create_default_context()
-        with smtplib.SMTP(host=smtp_host, port=smtp_port, timeout=30) as server:
-            server.ehlo()
-            server.starttls(context=context)
-            server.ehlo()
-            server.login(smtp_username, smtp_password)
-            resp = server.sendmail(from_addr=from_email, to_addrs=[to_email], msg=msg.as_string())
-            return None, str(resp) if resp else "250 OK"
-    else:
-        with smtplib.SMTP(host=smtp_host, port=smtp_port, timeout=30) as server:
-            server.ehlo()
-            server.login(smtp_username, smtp_password)
-            resp = server.sendmail(from_addr=from_email, to_addrs=[to_email], msg=msg.as_string())
-            return None, str(resp) if resp else "250 OK"
+    with SMTPSession(
+        smtp_host=smtp_host,
+        smtp_port=smtp_port,
+        smtp_username=smtp_username,
+        smtp_password=smtp_password,
+        use_starttls=use_starttls,
+        use_ssl=use_ssl,
+        max_messages=1,
+    ) as session:
+        return session.send(from_email, from_name, to_email, subject, body)
@@ -0,0 +1,235 @@
+"""Streaming recipient import for large lists.
+
+Rows are parsed from CSV or NDJSON as the request body arrives, validated in
+batches and written with ``COPY`` (asyncpg) on PostgreSQL or executemany
+inserts elsewhere. Repeated addresses and addresses on the user's
+suppression list are dropped on the way in; each batch is checked against
+the campaign's existing rows with an indexed lookup rather than by holding
+every address seen, so memory stays flat regardless of list size.
+"""
+from __future__ import annotations
+
+import codecs
+import csv
+import io
+import json
+from dataclasses import dataclass, field
+from typing import AsyncIterator, Optional
+
+from email_validator import EmailNotValidError, validate_email
+from sqlalchemy import func, insert, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from .models import Recipient, RecipientStatus
+from .suppression import email_key, suppressed
+
+MAX_NAME_LENGTH = 255
+MAX_REPORTED_ERRORS = 100
+# a CSV record spanning more than this is cut off: an unbalanced quote must
+# not pull the rest of the upload into one row
+MAX_RECORD_CHARS = 65_536
+_CSV_HEADERS = {"to_email", "email"}
+
+RecipientRow = tuple[str, Optional[str], Optional[dict]]
+
+
+@dataclass
+class ImportResult:
+    accepted: int = 0
+    rejected: int = 0
+    duplicates: int = 0
+    suppressed: int = 0
+    errors: list[tuple[int, str]] = field(default_factory=list)
+
+    def reject(self, line: int, reason: str) -> None:
+        self.rejected += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append((line, reason))
+
+
+async def iter_lines(chunks: AsyncIterator[bytes]) -> AsyncIterator[str]:
+    decoder = codecs.getincrementaldecoder("utf-8-sig")(errors="replace")
+    tail = ""
+    async for chunk in chunks:
+        text = tail + decoder.decode(chunk)
+        lines = text.split("\n")
+        tail = lines.pop()
+        for line in lines:
+            yield line
+    tail += decoder.decode(b"", final=True)
+    if tail:
+        yield tail
+
+
+async def iter_records(chunks: AsyncIterator[bytes], fmt: str) -> AsyncIterator[tuple[int, str]]:
+    """Yield ``(first line number, record)``; a CSV record continues while a quoted field is open.
+
+    RFC 4180 allows line breaks inside quoted fields. Doubled quotes escape a
+    quote, so an odd number of quotes so far means the field is still open.
+    """
+    line_no = 0
+    start = 0
+    pending: list[str] = []
+    quotes = size = 0
+    async for line in iter_lines(chunks):
+        line_no += 1
+        if fmt != "csv":
+            yield line_no, line
+            continue
+        line = line.rstrip("\r")
+        if not pending:
+            start = line_no
+        pending.append(line)
+        quotes += line.count('"')
+        size += len(line) + 1
+        if quotes % 2 == 0 or size > MAX_RECORD_CHARS:
+            yield start, "\n".join(pending)
+            pending = []
+            quotes = size = 0
+    if pending:
+        yield start, "\n".join(pending)
+
+
+def _parse_csv(line: str) -> RecipientRow:
+    fields = next(csv.reader([line]), [])
+    if not fields:
+        return "", None, None
+    name = fields[1].strip() if len(fields) > 1 else ""
+    return fields[0], name or None, None
+
+
+def _parse_ndjson(line: str) -> RecipientRow:
+    obj = json.loads(line)
+    if not isinstance(obj, dict):
+        raise ValueError("expected a JSON object")
+    name = obj.get("to_name")
+    attributes = obj.get("attributes")
+    if attributes is not None and not isinstance(attributes, dict):
+        raise ValueError("attributes must be a JSON object")
+    return str(obj.get("to_email") or ""), str(name) if name else None, attributes or None
+
+
+def parse_row(line: str, line_no: int, fmt: str, result: ImportResult) -> Optional[RecipientRow]:
+    """Parse and validate one line, recording a rejection if it is unusable."""
+    line = line.rstrip("\r")
+    if not line.strip():
+        return None
+    try:
+        to_email, to_name, attributes = _parse_csv(line) if fmt == "csv" else _parse_ndjson(line)
+    except (ValueError, csv.Error) as e:
+        result.reject(line_no, f"unparseable row: {e}")
+        return None
+    if fmt == "csv" and line_no == 1 and to_email.strip().lower() in _CSV_HEADERS:
+        return None
+    try:
+        normalized = validate_email(to_email.strip(), check_deliverability=False).normalized
+    except EmailNotValidError as e:
+        result.reject(line_no, f"invalid email address: {e}")
+        return None
+    if to_name is not None and len(to_name) > MAX_NAME_LENGTH:
+        result.reject(line_no, f"to_name longer than {MAX_NAME_LENGTH} characters")
+        return None
+    return normalized, to_name, attributes
+
+
+class RecipientFilter:
+    """Drops addresses a campaign already has, or that are suppressed for its user.
+
+    ``drop_existing`` looks a batch up against the campaign's rows through the
+    ``(campaign_id, lower(to_email))`` index, in the import's own transaction so
+    earlier batches of the same upload count too. ``apply`` queries the
+    suppression list and is meant to run in a worker thread.
+    """
+
+    _LOOKUP_CHUNK = 1000
+
+    def __init__(self, user_id: int, campaign_id: Optional[int] = None) -> None:
+        self.user_id = user_id
+        self.campaign_id = campaign_id
+
+    async def drop_existing(
+        self, db: AsyncSession, rows: list[RecipientRow], result: ImportResult
+    ) -> list[RecipientRow]:
+        if self.campaign_id is None or not rows:
+            return rows
+        keys = list({email_key(row[0]) for row in rows})
+        existing: set[str] = set()
+        for i in range(0, len(keys), self._LOOKUP_CHUNK):
+            chunk = keys[i : i + self._LOOKUP_CHUNK]
+            existing.update(await db.scalars(
+                select(func.lower(Recipient.to_email)).where(
+                    Recipient.campaign_id == self.campaign_id, func.lower(Recipient.to_email).in_(chunk)
+                )
+            ))
+        if not existing:
+            return rows
+        kept = [row for row in rows if email_key(row[0]) not in existing]
+        result.duplicates += len(rows) - len(kept)
+        return kept
+
+    def apply(self, rows: list[RecipientRow], result: ImportResult) -> list[RecipientRow]:
+        seen: set[str] = set()
+        unique: list[RecipientRow] = []
+        for row in rows:
+            key = email_key(row[0])
+            if key in seen:
+                result.duplicates += 1
+                continue
+            seen.add(key)
+            unique.append(row)
+        blocked = suppressed(self.user_id, [row[0] for row in unique])
+        if not blocked:
+            return unique
+        kept = [row for row in unique if email_key(row[0]) not in blocked]
+        result.suppressed += len(unique) - len(kept)
+        return kept
+
+
+class RecipientWriter:
+    """Appends validated rows for one campaign inside the session's transaction."""
+
+    def __init__(self, db: AsyncSession, campaign_id: int) -> None:
+        self.db = db
+        self.campaign_id = campaign_id
+        self._use_copy = db.get_bind().dialect.name == "postgresql"
+
+    async def write(self, rows: list[RecipientRow]) -> None:
+        if not rows:
+            return
+        if self._use_copy:
+            await self._copy(rows)
+        else:
+            await self.db.execute(
+                insert(Recipient.__table__),
+                [
+                    {
+                        "campaign_id": self.campaign_id,
+                        "to_email": to_email,
+                        "to_name": to_name,
+                        "attributes": attributes,
+                        "status": RecipientStatus.pending.name,
+                    }
+                    for to_email, to_name, attributes in rows
+                ],
+            )
+
+    async def _copy(self, rows: list[RecipientRow]) -> None:
+        buf = io.StringIO()
+        writer = csv.writer(buf)
+        for to_email, to_name, attributes in rows:
+            # an unquoted empty field is NULL in COPY's csv format
+            writer.writerow((
+                self.campaign_id,
+                to_email,
+                to_name or "",
+                json.dumps(attributes) if attributes else "",
+                RecipientStatus.pending.name,
+            ))
+        conn = await self.db.connection()
+        raw = await conn.get_raw_connection()
+        await raw.driver_connection.copy_to_table(
+            "recipients",
+            source=io.BytesIO(buf.getvalue().encode("utf-8")),
+            columns=["campaign_id", "to_email", "to_name", "attributes", "status"],
+            format="csv",
+        )
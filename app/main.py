@@ -1,10 +1,33 @@
-from fastapi import FastAPI
+from fastapi import Depends, FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 
+from .auth import current_user, require_admin, start_background, stop_background
+from .config import settings
+from .logs import configure_logging, get_logger
+from .metrics import serve as serve_metrics
+from .routers.api_keys import router as api_keys_router
 from .routers.campaigns import router as campaigns_router
+from .routers.queues import router as queues_router
 from .routers.smtp import router as smtp_router
+from .routers.suppressions import router as suppressions_router
+
+configure_logging()
+log = get_logger(__name__)
+
+
+def _serve_metrics() -> None:
+    try:
+        serve_metrics(settings.api_metrics_port)
+    except OSError as e:
+        # only the first of several API worker processes binds the port; with
+        # PROMETHEUS_MULTIPROC_DIR set it serves every process's samples
+        log.info("metrics_port_in_use", port=settings.api_metrics_port, error=str(e))
+
 
 app = FastAPI()
+app.add_event_handler("startup", start_background)
+app.add_event_handler("startup", _serve_metrics)
+app.add_event_handler("shutdown", stop_background)
 
 # Add CORS middleware
 app.add_middleware(
@@ -21,5 +44,8 @@ async def ping():
     return {"status": "ok"}
 
 
-app.include_router(smtp_router)
+app.include_router(smtp_router, dependencies=[Depends(current_user)])
 app.include_router(campaigns_router)
+app.include_router(suppressions_router)
+app.include_router(queues_router, dependencies=[Depends(require_admin)])
+app.include_router(api_keys_router)
@@ -0,0 +1,68 @@
+"""Prometheus metrics for the send path.
+
+Every process serves them on a port of its own, never the public API port:
+the API on API_METRICS_PORT, the Celery worker and the async engine on
+WORKER_METRICS_PORT, the scheduler on SCHEDULER_METRICS_PORT. A prefork Celery worker needs
+PROMETHEUS_MULTIPROC_DIR set to a writable directory so the pool processes'
+samples are aggregated.
+"""
+from __future__ import annotations
+
+import os
+import time
+from contextlib import contextmanager
+from typing import Iterator
+
+from prometheus_client import REGISTRY, CollectorRegistry, Counter, Histogram, start_http_server
+
+# claim, decrypt, suppress, render, connect, tls, auth, data, commit; "verify"
+# is a whole POST /smtp/verify check, kept apart from the send stages
+SEND_STAGE_SECONDS = Histogram(
+    "email_send_stage_seconds",
+    "Time spent in each stage of sending a message",
+    ["stage"],
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0),
+)
+
+# per SMTP host, not per campaign: every campaign ever run would stay a series
+MESSAGES = Counter(
+    "email_messages_total",
+    "Messages by outcome: sent, failed, deferred for a later retry, suppressed, or retried on a fresh connection",
+    ["smtp_host", "result"],
+)
+
+QUEUE_LAG_SECONDS = Histogram(
+    "email_queue_lag_seconds",
+    "Time from the scheduler granting a send to the worker starting it",
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0),
+)
+
+RESULTS_FLUSHED = Counter(
+    "email_results_flushed_total",
+    "Delivery results written to the database by the write-behind flush",
+)
+
+
+@contextmanager
+def timed(stage: str) -> Iterator[None]:
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        SEND_STAGE_SECONDS.labels(stage).observe(time.perf_counter() - started)
+
+
+def _registry() -> CollectorRegistry:
+    if not os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        return REGISTRY
+    from prometheus_client import multiprocess
+
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return registry
+
+
+def serve(port: int) -> None:
+    """Expose this process's metrics over HTTP on ``port``; 0 disables."""
+    if port:
+        start_http_server(port, registry=_registry())
@@ -10,11 +10,14 @@ from sqlalchemy import (
     Enum as SAEnum,
     ForeignKey,
     Integer,
+    JSON,
     String,
     Text,
     func,
     Index,
     UniqueConstraint,
+    false,
+    text,
 )
 from sqlalchemy.orm import Mapped, mapped_column, relationship
 
@@ -31,10 +34,19 @@ class CampaignStatus(str, Enum):
 
 class RecipientStatus(str, Enum):
     pending = "pending"
+    # claimed by a sender; last_attempt_at + RECIPIENT_LEASE_SECONDS is the lease expiry
+    in_flight = "in_flight"
     sent = "sent"
     failed = "failed"
 
 
+class SuppressionReason(str, Enum):
+    unsubscribed = "unsubscribed"
+    bounced = "bounced"
+    complained = "complained"
+    manual = "manual"
+
+
 class User(Base):
     __tablename__ = "users"
 
@@ -42,6 +54,10 @@ class User(Base):
     email: Mapped[str] = mapped_column(String(320), nullable=False, unique=True)
     name: Mapped[Optional[str]] = mapped_column(String(255), nullable=True)
     is_active: Mapped[bool] = mapped_column(Boolean, nullable=False, default=True)
+    # relative share of sending capacity while several users have campaigns running
+    send_weight: Mapped[int] = mapped_column(Integer, nullable=False, default=1, server_default="1")
+    # may use operator endpoints such as GET /queues/
+    is_admin: Mapped[bool] = mapped_column(Boolean, nullable=False, default=False, server_default=false())
     created_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), server_default=func.now())
     updated_at: Mapped[datetime] = mapped_column(
         DateTime(timezone=True), server_default=func.now(), onupdate=func.now()
@@ -95,6 +111,8 @@ class Campaign(Base):
     # Limits
     limit_count: Mapped[int] = mapped_column(Integer, nullable=False, default=1)
     limit_window_seconds: Mapped[int] = mapped_column(Integer, nullable=False, default=3600)
+    # >1: one SMTP transaction carries up to this many recipients of identical content
+    recipients_per_message: Mapped[int] = mapped_column(Integer, nullable=False, default=1, server_default="1")
 
     status: Mapped[CampaignStatus] = mapped_column(
         SAEnum(CampaignStatus), nullable=False, default=CampaignStatus.draft
@@ -117,7 +135,11 @@ class Campaign(Base):
 class Recipient(Base):
     __tablename__ = "recipients"
     __table_args__ = (
-        Index("ix_recipients_campaign_status", "campaign_id", "status"),
+        # claims and listings walk a campaign's rows in id order, optionally by status
+        Index("ix_recipients_campaign_status_id", "campaign_id", "status", "id"),
+        Index("ix_recipients_campaign_id", "campaign_id", "id"),
+        # uploads look up which of a batch's addresses the campaign already has
+        Index("ix_recipients_campaign_email", "campaign_id", text("lower(to_email)")),
     )
 
     id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
@@ -125,6 +147,8 @@ class Recipient(Base):
 
     to_email: Mapped[str] = mapped_column(String(320), nullable=False)
     to_name: Mapped[Optional[str]] = mapped_column(String(255), nullable=True)
+    # custom merge fields, referenced as {{ attributes.<key> }}
+    attributes: Mapped[Optional[dict]] = mapped_column(JSON, nullable=True)
 
     status: Mapped[RecipientStatus] = mapped_column(
         SAEnum(RecipientStatus), nullable=False, default=RecipientStatus.pending
@@ -132,6 +156,9 @@ class Recipient(Base):
     last_error: Mapped[Optional[str]] = mapped_column(Text, nullable=True)
     sent_at: Mapped[Optional[datetime]] = mapped_column(DateTime(timezone=True), nullable=True)
     last_attempt_at: Mapped[Optional[datetime]] = mapped_column(DateTime(timezone=True), nullable=True)
+    # completed send attempts; a pending recipient is not claimed before retry_at
+    attempts: Mapped[int] = mapped_column(Integer, nullable=False, default=0, server_default="0")
+    retry_at: Mapped[Optional[datetime]] = mapped_column(DateTime(timezone=True), nullable=True)
 
     campaign: Mapped[Campaign] = relationship(back_populates="recipients")
     sent_emails: Mapped[list[SentEmail]] = relationship(back_populates="recipient")
@@ -139,6 +166,12 @@ class Recipient(Base):
 
 class SentEmail(Base):
     __tablename__ = "sent_emails"
+    __table_args__ = (
+        Index("ix_sent_emails_campaign_status_id", "campaign_id", "status", "id"),
+        Index("ix_sent_emails_campaign_id", "campaign_id", "id"),
+        # ON DELETE CASCADE from recipients
+        Index("ix_sent_emails_recipient_id", "recipient_id"),
+    )
 
     id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
     campaign_id: Mapped[int] = mapped_column(ForeignKey("campaigns.id", ondelete="CASCADE"), nullable=False)
@@ -155,3 +188,18 @@ class SentEmail(Base):
 
     campaign: Mapped[Campaign] = relationship(back_populates="sent_emails")
     recipient: Mapped[Recipient] = relationship(back_populates="sent_emails")
+
+
+class Suppression(Base):
+    """An address a user must never be mailed again; ``email`` is lowercased."""
+
+    __tablename__ = "suppressions"
+    __table_args__ = (
+        UniqueConstraint("user_id", "email", name="uq_suppression_user_email"),
+    )
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
+    user_id: Mapped[int] = mapped_column(ForeignKey("users.id", ondelete="CASCADE"), nullable=False)
+    email: Mapped[str] = mapped_column(String(320), nullable=False)
+    reason: Mapped[str] = mapped_column(String(20), nullable=False)
+    created_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), server_default=func.now())
@@ -0,0 +1,97 @@
+"""Campaign progress events over Redis pub/sub.
+
+The result flush publishes small deltas once results are committed (see
+``app.result_sink``); the API turns them into a Server-Sent Events stream
+per campaign, coalescing bursts so a fast campaign produces at most a few
+updates per second.
+"""
+from __future__ import annotations
+
+import asyncio
+import json
+from typing import AsyncIterator, Awaitable, Callable, Optional
+
+import redis
+
+from .logs import get_logger
+from .redis_client import get_async_redis, get_redis
+from .schemas import CampaignStatusOut
+
+log = get_logger(__name__)
+
+_TERMINAL = {"completed", "failed"}
+_KEEPALIVE_SECONDS = 15.0
+
+
+def channel(campaign_id: int) -> str:
+    return f"campaign:{campaign_id}:progress"
+
+
+def publish_progress(campaign_id: int, sent: int = 0, failed: int = 0, status: Optional[str] = None) -> None:
+    """Best effort: a missed event only delays a stream update, never a send."""
+    event: dict[str, object] = {"sent": sent, "failed": failed}
+    if status is not None:
+        event["status"] = status
+    try:
+        get_redis().publish(channel(campaign_id), json.dumps(event))
+    except redis.RedisError as e:
+        log.warning("progress_publish_failed", campaign_id=campaign_id, error=str(e))
+
+
+def _apply(snapshot: CampaignStatusOut, event: dict) -> CampaignStatusOut:
+    sent = min(snapshot.total, snapshot.sent + int(event.get("sent", 0)))
+    failed = min(snapshot.total - sent, snapshot.failed + int(event.get("failed", 0)))
+    return CampaignStatusOut(
+        id=snapshot.id,
+        status=event.get("status") or snapshot.status,
+        total=snapshot.total,
+        sent=sent,
+        failed=failed,
+        pending=snapshot.total - sent - failed,
+        progress_pct=round(sent / snapshot.total * 100.0, 2) if snapshot.total > 0 else 0.0,
+    )
+
+
+def _sse(snapshot: CampaignStatusOut) -> str:
+    return f"event: progress\ndata: {snapshot.model_dump_json()}\n\n"
+
+
+async def progress_events(
+    campaign_id: int,
+    load_snapshot: Callable[[], Awaitable[Optional[CampaignStatusOut]]],
+    interval: float,
+) -> AsyncIterator[str]:
+    """Yield SSE frames for one campaign until it completes or fails."""
+    pubsub = get_async_redis().pubsub()
+    # subscribe before reading the snapshot so no delta falls in between
+    await pubsub.subscribe(channel(campaign_id))
+    try:
+        snapshot = await load_snapshot()
+        if snapshot is None:
+            return
+        yield _sse(snapshot)
+        if snapshot.status in _TERMINAL:
+            return
+
+        loop = asyncio.get_running_loop()
+        last_emit = loop.time()
+        dirty = False
+        while True:
+            wait = max(0.0, interval - (loop.time() - last_emit)) if dirty else _KEEPALIVE_SECONDS
+            message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=wait)
+            if message is not None:
+                snapshot = _apply(snapshot, json.loads(message["data"]))
+                dirty = True
+            if dirty and loop.time() - last_emit >= interval:
+                yield _sse(snapshot)
+                if snapshot.status in _TERMINAL:
+                    return
+                last_emit = loop.time()
+                dirty = False
+            elif message is None and not dirty and loop.time() - last_emit >= _KEEPALIVE_SECONDS:
+                # not on an early None, like the one the subscribe confirmation leaves
+                yield ": keepalive\n\n"
+                last_emit = loop.time()
+    finally:
+        await pubsub.unsubscribe(channel(campaign_id))
+        await pubsub.aclose()
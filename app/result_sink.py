@@ -0,0 +1,239 @@
+"""Write-behind delivery results.
+
+Senders push each outcome to a Redis list right after the SMTP exchange
+instead of writing to the database. A flusher (the scheduler and every
+Celery worker process for the Celery engine, the engine itself for
+SEND_ENGINE=async) moves up to
+RESULT_FLUSH_BATCH_SIZE results at a time into its own processing list and
+applies them with ``apply_results``: one recipients UPDATE and one
+sent_emails INSERT per batch, in one transaction. Progress deltas for the
+campaign event streams are published once that transaction has committed.
+
+A batch stays in the processing list until its transaction has committed.
+If the flusher dies in between, another flusher notices the expired owner
+key and moves the batch back to the journal. Replays are harmless because
+``apply_results`` only touches recipients still in flight under the claim
+the result was produced for.
+
+Until its result is applied a recipient stays ``in_flight`` in the
+database, and its lease may run out while flushing lags. So that it is not
+claimed and sent a second time, the claim each journaled result belongs to
+is also kept in a per-campaign hash that ``claim_recipients`` consults
+before reclaiming (see ``journaled_claims``).
+"""
+from __future__ import annotations
+
+import threading
+import time
+import uuid
+
+import redis
+
+from .config import settings
+from .db import SessionLocal
+from .logs import get_logger
+from .metrics import RESULTS_FLUSHED, timed
+from .delivery import DeliveryResult, apply_results, claim_fence, complete_if_done
+from .models import CampaignStatus, RecipientStatus
+from .progress import publish_progress
+from .redis_client import get_async_redis, get_redis
+
+log = get_logger(__name__)
+
+_JOURNAL_KEY = "results:journal"
+_PROCESSING_PREFIX = "results:processing:"
+_OWNER_PREFIX = "results:owner:"
+_CLAIMS_PREFIX = "results:claims:"
+# a claims hash outlives any plausible flush backlog; entries leave it as they are applied
+_CLAIMS_TTL_SECONDS = 7 * 86400
+
+# KEYS[1] journal, KEYS[2] processing list, KEYS[3] owner key
+# ARGV[1] batch size, ARGV[2] owner ttl ms
+# A batch left over from a failed apply is returned again before new results.
+_TAKE_SCRIPT = """
+redis.call('SET', KEYS[3], '1', 'PX', ARGV[2])
+if redis.call('LLEN', KEYS[2]) > 0 then
+  return redis.call('LRANGE', KEYS[2], 0, -1)
+end
+local items = redis.call('LRANGE', KEYS[1], 0, tonumber(ARGV[1]) - 1)
+if #items == 0 then
+  return items
+end
+redis.call('LTRIM', KEYS[1], #items, -1)
+for i = 1, #items, 1000 do
+  redis.call('RPUSH', KEYS[2], unpack(items, i, math.min(i + 999, #items)))
+end
+return items
+"""
+
+# KEYS[1] processing list, KEYS[2] its owner key, KEYS[3] journal
+_RECOVER_SCRIPT = """
+if redis.call('EXISTS', KEYS[2]) == 1 then
+  return 0
+end
+local items = redis.call('LRANGE', KEYS[1], 0, -1)
+for i = 1, #items, 1000 do
+  redis.call('RPUSH', KEYS[3], unpack(items, i, math.min(i + 999, #items)))
+end
+redis.call('DEL', KEYS[1])
+return #items
+"""
+
+
+# KEYS[1] claims hash, ARGV pairs of (recipient id, claim fence)
+# Drops each entry still holding that fence; a newer claim's entry is kept.
+_FORGET_SCRIPT = """
+for i = 1, #ARGV, 2 do
+  if redis.call('HGET', KEYS[1], ARGV[i]) == ARGV[i + 1] then
+    redis.call('HDEL', KEYS[1], ARGV[i])
+  end
+end
+return 0
+"""
+
+
+def claims_key(campaign_id: int) -> str:
+    return f"{_CLAIMS_PREFIX}{campaign_id}"
+
+
+def _claims_by_campaign(results: list[DeliveryResult]) -> dict[int, dict[str, str]]:
+    claims: dict[int, dict[str, str]] = {}
+    for r in results:
+        claims.setdefault(r.campaign_id, {})[str(r.recipient_id)] = claim_fence(r.claimed_at)
+    return claims
+
+
+def _journal(pipe, results: list[DeliveryResult]) -> None:  # noqa: ANN001
+    pipe.rpush(_JOURNAL_KEY, *(r.dumps() for r in results))
+    for campaign_id, claims in _claims_by_campaign(results).items():
+        pipe.hset(claims_key(campaign_id), mapping=claims)
+        pipe.expire(claims_key(campaign_id), _CLAIMS_TTL_SECONDS)
+
+
+def push_results(results: list[DeliveryResult]) -> None:
+    """Journal results for the next flush, with their claims, in one MULTI."""
+    if results:
+        pipe = get_redis().pipeline(transaction=True)
+        _journal(pipe, results)
+        pipe.execute()
+
+
+async def push_results_async(results: list[DeliveryResult]) -> None:
+    if results:
+        pipe = get_async_redis().pipeline(transaction=True)
+        _journal(pipe, results)
+        await pipe.execute()
+
+
+def journaled_claims(campaign_id: int, recipient_ids: list[int]) -> dict[int, str]:
+    """Claim fences of recipients whose result is journaled but not yet applied."""
+    if not recipient_ids:
+        return {}
+    fences = get_redis().hmget(claims_key(campaign_id), [str(i) for i in recipient_ids])
+    return {i: f.decode("utf-8") for i, f in zip(recipient_ids, fences) if f is not None}
+
+
+class ResultSink:
+    """Flushes the journal into the database; one instance per flushing process."""
+
+    def __init__(self, client: redis.Redis, batch_size: int, interval_seconds: float) -> None:
+        self.client = client
+        self.batch_size = min(max(1, batch_size), 5000)
+        self.interval_seconds = interval_seconds
+        self.owner = uuid.uuid4().hex
+        self._take = client.register_script(_TAKE_SCRIPT)
+        self._recover = client.register_script(_RECOVER_SCRIPT)
+        self._forget = client.register_script(_FORGET_SCRIPT)
+        self._next_flush = 0.0
+        self._next_recovery = 0.0
+        # one batch at a time: the processing list is shared by this instance
+        self._lock = threading.Lock()
+
+    @property
+    def _processing_key(self) -> str:
+        return _PROCESSING_PREFIX + self.owner
+
+    @property
+    def _owner_key(self) -> str:
+        return _OWNER_PREFIX + self.owner
+
+    def flush_due(self) -> int:
+        """Flush when a full batch is waiting or the interval has passed."""
+        now = time.monotonic()
+        if now >= self._next_recovery:
+            self._recover_orphans()
+            self._next_recovery = now + max(10.0, self.interval_seconds * 10)
+        if now < self._next_flush and self.client.llen(_JOURNAL_KEY) < self.batch_size:
+            return 0
+        self._next_flush = now + self.interval_seconds
+        return self.flush()
+
+    def flush(self) -> int:
+        """Apply everything currently journaled; returns the number of results applied."""
+        applied = 0
+        with self._lock:
+            while True:
+                raw = self._take(
+                    keys=[_JOURNAL_KEY, self._processing_key, self._owner_key],
+                    args=[self.batch_size, self._owner_ttl_ms()],
+                )
+                if not raw:
+                    return applied
+                results = [DeliveryResult.loads(item) for item in raw]
+                applied += self._apply(results)
+                self.client.delete(self._processing_key)
+                # applied or superseded, these recipients may be claimed again
+                self._forget_claims(results)
+                if len(raw) < self.batch_size:
+                    return applied
+
+    def _apply(self, results: list[DeliveryResult]) -> int:
+        with SessionLocal() as db:
+            with timed("commit"):
+                applied = apply_results(db, results)
+                db.commit()
+            RESULTS_FLUSHED.inc(len(applied))
+            completed = [cid for cid in {r.campaign_id for r in applied} if complete_if_done(db, cid)]
+        # progress streams only ever count what the database already holds
+        counts: dict[int, list[int]] = {}
+        for r in applied:
+            tally = counts.setdefault(r.campaign_id, [0, 0])
+            if r.status == RecipientStatus.sent.value:
+                tally[0] += 1
+            elif r.status == RecipientStatus.failed.value:
+                tally[1] += 1
+        for campaign_id, (sent, failed) in counts.items():
+            if sent or failed:
+                publish_progress(campaign_id, sent=sent, failed=failed)
+        for campaign_id in completed:
+            publish_progress(campaign_id, status=CampaignStatus.completed.value)
+        return len(applied)
+
+    def _forget_claims(self, results: list[DeliveryResult]) -> None:
+        for campaign_id, claims in _claims_by_campaign(results).items():
+            self._forget(keys=[claims_key(campaign_id)], args=[x for pair in claims.items() for x in pair])
+
+    def _recover_orphans(self) -> None:
+        for key in self.client.scan_iter(match=_PROCESSING_PREFIX + "*", count=100):
+            key = key.decode() if isinstance(key, bytes) else key
+            owner = key[len(_PROCESSING_PREFIX):]
+            if owner == self.owner:
+                continue
+            moved = self._recover(keys=[key, _OWNER_PREFIX + owner, _JOURNAL_KEY])
+            if moved:
+                log.warning("results_recovered", count=moved, flusher=owner)
+
+    def _owner_ttl_ms(self) -> int:
+        # long enough to outlive a slow batch, short enough to recover promptly
+        return int(max(60.0, self.interval_seconds * 30) * 1000)
+
+    def close(self) -> None:
+        self.client.delete(self._owner_key)
+
+
+def make_sink(client: redis.Redis) -> ResultSink:
+    return ResultSink(
+        client,
+        batch_size=settings.result_flush_batch_size,
+        interval_seconds=settings.result_flush_interval_seconds,
+    )
@@ -0,0 +1,73 @@
+from __future__ import annotations
+
+from datetime import datetime, timedelta, timezone
+
+from fastapi import APIRouter, Depends, HTTPException
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from ..auth import Principal, announce_revoked, current_user, generate_key, require_api_key
+from ..db import get_async_db
+from ..logs import get_logger
+from ..models import ApiKey
+from ..schemas import ApiKeyCreate, ApiKeyCreated, ApiKeyOut
+
+router = APIRouter(prefix="/api-keys", tags=["api-keys"])
+log = get_logger(__name__)
+
+
+def _out(k: ApiKey) -> ApiKeyOut:
+    return ApiKeyOut(
+        id=k.id,
+        name=k.key_name,
+        is_active=k.is_active,
+        created_at=k.created_at,
+        expires_at=k.expires_at,
+        last_used_at=k.last_used_at,
+    )
+
+
+@router.post("/", response_model=ApiKeyCreated)
+async def create_api_key(
+    payload: ApiKeyCreate, principal: Principal = Depends(require_api_key), db: AsyncSession = Depends(get_async_db)
+) -> ApiKeyCreated:
+    # keyless requests are anonymous; the first key is issued with python -m app.auth create
+    key, key_hash = generate_key()
+    expires_at = None
+    if payload.expires_in_days is not None:
+        expires_at = datetime.now(timezone.utc) + timedelta(days=payload.expires_in_days)
+    api_key = ApiKey(user_id=principal.user_id, key_name=payload.name, key_hash=key_hash, expires_at=expires_at)
+    db.add(api_key)
+    try:
+        await db.commit()
+    except IntegrityError:
+        await db.rollback()
+        raise HTTPException(status_code=409, detail="An API key with this name already exists")
+    await db.refresh(api_key)
+    log.info("api_key_created", user_id=principal.user_id, key_id=api_key.id)
+    return ApiKeyCreated(**_out(api_key).model_dump(), key=key)
+
+
+@router.get("/", response_model=list[ApiKeyOut])
+async def list_api_keys(
+    principal: Principal = Depends(current_user), db: AsyncSession = Depends(get_async_db)
+) -> list[ApiKeyOut]:
+    keys = await db.scalars(select(ApiKey).where(ApiKey.user_id == principal.user_id).order_by(ApiKey.id))
+    return [_out(k) for k in keys]
+
+
+@router.delete("/{key_id}")
+async def revoke_api_key(
+    key_id: int, principal: Principal = Depends(current_user), db: AsyncSession = Depends(get_async_db)
+) -> dict:
+    api_key = await db.get(ApiKey, key_id)
+    if api_key is None or api_key.user_id != principal.user_id:
+        raise HTTPException(status_code=404, detail="API key not found")
+    api_key.is_active = False
+    await db.commit()
+    # every API process drops its cached lookup now rather than at expiry
+    await run_in_threadpool(announce_revoked, api_key.key_hash)
+    log.info("api_key_revoked", user_id=principal.user_id, key_id=api_key.id)
+    return {"status": "revoked", "id": api_key.id}
@@ -1,52 +1,80 @@
 from __future__ import annotations
 
-from fastapi import APIRouter, Depends, HTTPException
+from typing import Literal, Optional
+
+from fastapi import APIRouter, Depends, HTTPException, Query, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
 from sqlalchemy import func, select
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 
+from ..auth import Principal, current_user
+from ..cache import TTLCache
+from ..config import settings
 from ..crypto import encrypt_str
-from ..db import get_db
-from ..models import Campaign, CampaignStatus, Recipient, RecipientStatus, User
+from ..db import AsyncSessionLocal, get_async_db
+from ..export import export_rows
+from ..ingest import ImportResult, RecipientFilter, RecipientRow, RecipientWriter, iter_records, parse_row
+from ..logs import get_logger
+from ..models import Campaign, CampaignStatus, Recipient, RecipientStatus, SentEmail
+from ..progress import progress_events, publish_progress
 from ..schemas import (
     CampaignCreate,
     CampaignOut,
     CampaignStatusOut,
+    DeliveryOut,
+    DeliveryPage,
+    DeliveryStatus,
+    RecipientImportError,
+    RecipientImportOut,
+    RecipientOut,
+    RecipientPage,
 )
-from ..tasks import send_next_email
+from ..tasks import dispatch_campaign
+from ..templating import TemplateError, compile_template
 
 router = APIRouter(prefix="/campaigns", tags=["campaigns"])
+log = get_logger(__name__)
 
+_status_cache: TTLCache[Optional[CampaignStatusOut]] = TTLCache(ttl_seconds=settings.status_cache_ttl_seconds)
+_owners: TTLCache[Optional[int]] = TTLCache(ttl_seconds=3600.0, maxsize=10000)
 
-def get_default_user(db: Session) -> User:
-    """Get or create default user for campaigns"""
-    user = db.execute(
-        select(User).where(User.email == "a@aiemailnewsletter.com")
-    ).scalar_one_or_none()
-    
-    if user is None:
-        user = User(
-            email="a@aiemailnewsletter.com",
-            name="Admin User",
-            is_active=True
-        )
-        db.add(user)
-        db.commit()
-        db.refresh(user)
-    
-    return user
+
+async def _load_owner(campaign_id: int) -> Optional[int]:
+    async with AsyncSessionLocal() as db:
+        return (await db.execute(select(Campaign.user_id).where(Campaign.id == campaign_id))).scalar_one_or_none()
+
+
+async def _authorize(campaign_id: int, principal: Principal) -> None:
+    # a campaign never changes hands, so its owner is looked up once per process
+    owner = await _owners.get_or_compute_async(campaign_id, lambda: _load_owner(campaign_id))
+    if owner != principal.user_id:
+        raise HTTPException(status_code=404, detail="Campaign not found")
 
 
 @router.post("/", response_model=CampaignOut)
-def create_campaign(payload: CampaignCreate, db: Session = Depends(get_db)) -> CampaignOut:
+async def create_campaign(
+    payload: CampaignCreate,
+    principal: Principal = Depends(current_user),
+    db: AsyncSession = Depends(get_async_db),
+) -> CampaignOut:
     if payload.limits_count < 1 or payload.limits_window_seconds < 1:
         raise HTTPException(status_code=400, detail="Invalid limits")
-
-    # Get default user
-    user = get_default_user(db)
+    personalized = False
+    for field_name, source in (("subject", payload.subject), ("body", payload.body)):
+        try:
+            # compile both, so the body is validated even when the subject is personalized
+            personalized = not compile_template(source).is_static or personalized
+        except TemplateError as e:
+            raise HTTPException(status_code=400, detail=f"Invalid {field_name} template: {e}")
+    if payload.recipients_per_message > 1 and personalized:
+        raise HTTPException(
+            status_code=400, detail="recipients_per_message above 1 needs a subject and body without merge fields"
+        )
 
     c = Campaign(
         name=payload.name,
-        user_id=user.id,
+        user_id=principal.user_id,
         smtp_host=payload.smtp.smtp_host,
         smtp_port=payload.smtp.smtp_port,
         smtp_username_enc=encrypt_str(payload.smtp.smtp_username),
@@ -59,92 +87,183 @@ def create_campaign(payload: CampaignCreate, db: Session = Depends(get_db)) -> C
         body=payload.body,
         limit_count=payload.limits_count,
         limit_window_seconds=payload.limits_window_seconds,
+        recipients_per_message=payload.recipients_per_message,
         status=CampaignStatus.draft,
     )
     db.add(c)
-    db.flush()
+    await db.flush()
 
+    screened = ImportResult()
+    rows = await run_in_threadpool(
+        RecipientFilter(principal.user_id).apply,
+        [(r.to_email, r.to_name, r.attributes) for r in payload.recipients],
+        screened,
+    )
     recipients = [
-        Recipient(campaign_id=c.id, to_email=r.to_email, to_name=r.to_name, status=RecipientStatus.pending)
-        for r in payload.recipients
+        Recipient(
+            campaign_id=c.id,
+            to_email=to_email,
+            to_name=to_name,
+            attributes=attributes,
+            status=RecipientStatus.pending,
+        )
+        for to_email, to_name, attributes in rows
     ]
     db.add_all(recipients)
-    db.commit()
-    return CampaignOut(id=c.id, name=c.name)
+    await db.commit()
+    return CampaignOut(id=c.id, name=c.name, duplicates=screened.duplicates, suppressed=screened.suppressed)
+
+
+@router.post("/{campaign_id}/recipients/bulk", response_model=RecipientImportOut)
+async def import_recipients(
+    campaign_id: int,
+    request: Request,
+    principal: Principal = Depends(current_user),
+    db: AsyncSession = Depends(get_async_db),
+) -> RecipientImportOut:
+    """Append recipients streamed as CSV (to_email,to_name) or NDJSON lines."""
+    content_type = request.headers.get("content-type", "")
+    if "csv" in content_type:
+        fmt = "csv"
+    elif "ndjson" in content_type or "jsonl" in content_type:
+        fmt = "ndjson"
+    else:
+        raise HTTPException(status_code=415, detail="Use text/csv or application/x-ndjson")
+
+    campaign = await db.get(Campaign, campaign_id)
+    if campaign is None or campaign.user_id != principal.user_id:
+        raise HTTPException(status_code=404, detail="Campaign not found")
+    if campaign.status not in (CampaignStatus.draft, CampaignStatus.paused):
+        raise HTTPException(status_code=400, detail="Recipients can only be added to draft or paused campaigns")
+
+    result = ImportResult()
+    screen = RecipientFilter(campaign.user_id, campaign.id)
+    writer = RecipientWriter(db, campaign.id)
+    batch: list[RecipientRow] = []
+
+    async def flush(rows: list[RecipientRow]) -> None:
+        rows = await screen.drop_existing(db, rows, result)
+        kept = await run_in_threadpool(screen.apply, rows, result)
+        await writer.write(kept)
+        result.accepted += len(kept)
+
+    try:
+        async for line_no, record in iter_records(request.stream(), fmt):
+            row = parse_row(record, line_no, fmt, result)
+            if row is None:
+                continue
+            batch.append(row)
+            if len(batch) >= settings.ingest_batch_size:
+                await flush(batch)
+                batch = []
+        await flush(batch)
+        await db.commit()
+    except BaseException:
+        await db.rollback()
+        raise
+
+    log.info(
+        "recipients_imported",
+        campaign_id=campaign.id,
+        accepted=result.accepted,
+        rejected=result.rejected,
+        duplicates=result.duplicates,
+        suppressed=result.suppressed,
+    )
+    return RecipientImportOut(
+        accepted=result.accepted,
+        rejected=result.rejected,
+        duplicates=result.duplicates,
+        suppressed=result.suppressed,
+        errors=[RecipientImportError(line=line, reason=reason) for line, reason in result.errors],
+    )
+
+
+def _announce(campaign_id: int, status: CampaignStatus, dispatch: bool) -> None:
+    # Redis calls are blocking; callers run this in the threadpool
+    if dispatch:
+        dispatch_campaign(campaign_id)
+    publish_progress(campaign_id, status=status.value)
 
 
 @router.post("/{campaign_id}/start")
-def start_campaign(campaign_id: int, db: Session = Depends(get_db)) -> dict:
-    campaign = db.get(Campaign, campaign_id)
-    if campaign is None:
+async def start_campaign(
+    campaign_id: int, principal: Principal = Depends(current_user), db: AsyncSession = Depends(get_async_db)
+) -> dict:
+    campaign = await db.get(Campaign, campaign_id)
+    if campaign is None or campaign.user_id != principal.user_id:
         raise HTTPException(status_code=404, detail="Campaign not found")
     if campaign.status not in (CampaignStatus.draft, CampaignStatus.failed):
         raise HTTPException(status_code=400, detail="Campaign already running or completed")
 
-    has_any = db.execute(
+    has_any = (await db.execute(
         select(func.count()).select_from(Recipient).where(Recipient.campaign_id == campaign.id)
-    ).scalar_one()
+    )).scalar_one()
     if has_any == 0:
         raise HTTPException(status_code=400, detail="No recipients")
 
     campaign.status = CampaignStatus.running
-    db.commit()
+    await db.commit()
 
-    print(f"Starting campaign {campaign.id} with {has_any} recipients")
-    send_next_email.apply_async(args=[campaign.id], countdown=0)
+    log.info("campaign_started", campaign_id=campaign.id, recipients=has_any)
+    _status_cache.invalidate(campaign.id)
+    await run_in_threadpool(_announce, campaign.id, CampaignStatus.running, True)
     return {"status": "started", "id": campaign.id}
 
 
 @router.post("/{campaign_id}/pause")
-def pause_campaign(campaign_id: int, db: Session = Depends(get_db)) -> dict:
-    campaign = db.get(Campaign, campaign_id)
-    if campaign is None:
+async def pause_campaign(
+    campaign_id: int, principal: Principal = Depends(current_user), db: AsyncSession = Depends(get_async_db)
+) -> dict:
+    campaign = await db.get(Campaign, campaign_id)
+    if campaign is None or campaign.user_id != principal.user_id:
         raise HTTPException(status_code=404, detail="Campaign not found")
     if campaign.status != CampaignStatus.running:
         raise HTTPException(status_code=400, detail="Campaign is not running")
     
-    print(f"Pausing campaign {campaign.id}")
+    log.info("campaign_paused", campaign_id=campaign.id)
     campaign.status = CampaignStatus.paused
-    db.commit()
+    await db.commit()
+    _status_cache.invalidate(campaign.id)
+    await run_in_threadpool(_announce, campaign.id, CampaignStatus.paused, False)
     return {"status": "paused", "id": campaign.id}
 
 
 @router.post("/{campaign_id}/resume")
-def resume_campaign(campaign_id: int, db: Session = Depends(get_db)) -> dict:
-    campaign = db.get(Campaign, campaign_id)
-    if campaign is None:
+async def resume_campaign(
+    campaign_id: int, principal: Principal = Depends(current_user), db: AsyncSession = Depends(get_async_db)
+) -> dict:
+    campaign = await db.get(Campaign, campaign_id)
+    if campaign is None or campaign.user_id != principal.user_id:
         raise HTTPException(status_code=404, detail="Campaign not found")
     if campaign.status != CampaignStatus.paused:
         raise HTTPException(status_code=400, detail="Campaign is not paused")
     
-    print(f"Resuming campaign {campaign.id}")
+    log.info("campaign_resumed", campaign_id=campaign.id)
     campaign.status = CampaignStatus.running
-    db.commit()
+    await db.commit()
     
     # Start sending emails again
-    send_next_email.apply_async(args=[campaign.id], countdown=0)
+    _status_cache.invalidate(campaign.id)
+    await run_in_threadpool(_announce, campaign.id, CampaignStatus.running, True)
     return {"status": "resumed", "id": campaign.id}
 
 
-@router.get("/{campaign_id}/status", response_model=CampaignStatusOut)
-def campaign_status(campaign_id: int, db: Session = Depends(get_db)) -> CampaignStatusOut:
-    campaign = db.get(Campaign, campaign_id)
+async def _load_status(db: AsyncSession, campaign_id: int) -> Optional[CampaignStatusOut]:
+    campaign = await db.get(Campaign, campaign_id)
     if campaign is None:
-        raise HTTPException(status_code=404, detail="Campaign not found")
+        return None
 
-    total = db.execute(
-        select(func.count()).select_from(Recipient).where(Recipient.campaign_id == campaign.id)
-    ).scalar_one()
-    sent = db.execute(
-        select(func.count()).select_from(Recipient).where(
-            Recipient.campaign_id == campaign.id, Recipient.status == RecipientStatus.sent
-        )
-    ).scalar_one()
-    failed = db.execute(
-        select(func.count()).select_from(Recipient).where(
-            Recipient.campaign_id == campaign.id, Recipient.status == RecipientStatus.failed
-        )
-    ).scalar_one()
+    counts = dict(
+        (await db.execute(
+            select(Recipient.status, func.count())
+            .where(Recipient.campaign_id == campaign.id)
+            .group_by(Recipient.status)
+        )).all()
+    )
+    sent = counts.get(RecipientStatus.sent, 0)
+    failed = counts.get(RecipientStatus.failed, 0)
+    total = sum(counts.values())
     pending = total - sent - failed
     progress_pct = (sent / total * 100.0) if total > 0 else 0.0
 
@@ -157,3 +276,127 @@ def campaign_status(campaign_id: int, db: Session = Depends(get_db)) -> Campaign
         pending=pending,
         progress_pct=round(progress_pct, 2),
     )
+
+
+@router.get("/{campaign_id}/status", response_model=CampaignStatusOut)
+async def campaign_status(
+    campaign_id: int, principal: Principal = Depends(current_user), db: AsyncSession = Depends(get_async_db)
+) -> CampaignStatusOut:
+    await _authorize(campaign_id, principal)
+    # concurrent pollers of one campaign share a single query per TTL
+    out = await _status_cache.get_or_compute_async(campaign_id, lambda: _load_status(db, campaign_id))
+    if out is None:
+        raise HTTPException(status_code=404, detail="Campaign not found")
+    return out
+
+
+@router.get("/{campaign_id}/events")
+async def campaign_events(campaign_id: int, principal: Principal = Depends(current_user)) -> StreamingResponse:
+    """Server-Sent Events stream of status snapshots, pushed as the campaign progresses."""
+    await _authorize(campaign_id, principal)
+
+    async def load() -> Optional[CampaignStatusOut]:
+        # read after subscribing and past the status cache, so every delta the
+        # stream receives is newer than the snapshot; a short-lived session
+        # because the stream may stay open for hours
+        async with AsyncSessionLocal() as db:
+            return await _load_status(db, campaign_id)
+
+    return StreamingResponse(
+        progress_events(campaign_id, load, settings.progress_stream_interval_seconds),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@router.get("/{campaign_id}/recipients", response_model=RecipientPage)
+async def list_recipients(
+    campaign_id: int,
+    status: Optional[RecipientStatus] = None,
+    after: Optional[int] = Query(None, ge=0, description="id of the last recipient on the previous page"),
+    limit: int = Query(100, ge=1, le=1000),
+    principal: Principal = Depends(current_user),
+    db: AsyncSession = Depends(get_async_db),
+) -> RecipientPage:
+    """Recipients in id order; each page is an index range scan, however deep."""
+    await _authorize(campaign_id, principal)
+    stmt = select(Recipient).where(Recipient.campaign_id == campaign_id)
+    if status is not None:
+        stmt = stmt.where(Recipient.status == status)
+    if after is not None:
+        stmt = stmt.where(Recipient.id > after)
+    rows = list((await db.scalars(stmt.order_by(Recipient.id.asc()).limit(limit + 1))).all())
+    more = len(rows) > limit
+    rows = rows[:limit]
+    return RecipientPage(
+        items=[
+            RecipientOut(
+                id=r.id,
+                to_email=r.to_email,
+                to_name=r.to_name,
+                attributes=r.attributes,
+                status=r.status.value,
+                last_error=r.last_error,
+                last_attempt_at=r.last_attempt_at,
+                sent_at=r.sent_at,
+            )
+            for r in rows
+        ],
+        next_after=rows[-1].id if more else None,
+    )
+
+
+@router.get("/{campaign_id}/deliveries", response_model=DeliveryPage)
+async def list_deliveries(
+    campaign_id: int,
+    status: Optional[DeliveryStatus] = None,
+    after: Optional[int] = Query(None, ge=0, description="id of the last delivery on the previous page"),
+    limit: int = Query(100, ge=1, le=1000),
+    principal: Principal = Depends(current_user),
+    db: AsyncSession = Depends(get_async_db),
+) -> DeliveryPage:
+    """The campaign's sent_emails log in id order, paginated like the recipient list."""
+    await _authorize(campaign_id, principal)
+    stmt = select(SentEmail).where(SentEmail.campaign_id == campaign_id)
+    if status is not None:
+        stmt = stmt.where(SentEmail.status == status)
+    if after is not None:
+        stmt = stmt.where(SentEmail.id > after)
+    rows = list((await db.scalars(stmt.order_by(SentEmail.id.asc()).limit(limit + 1))).all())
+    more = len(rows) > limit
+    rows = rows[:limit]
+    return DeliveryPage(
+        items=[
+            DeliveryOut(
+                id=d.id,
+                recipient_id=d.recipient_id,
+                status=d.status,
+                message_id=d.message_id,
+                smtp_response=d.smtp_response,
+                attempts=d.attempts,
+                delivered_at=d.delivered_at,
+                error=d.error,
+            )
+            for d in rows
+        ],
+        next_after=rows[-1].id if more else None,
+    )
+
+
+@router.get("/{campaign_id}/export")
+async def export_results(
+    campaign_id: int,
+    format: Literal["csv", "ndjson"] = "csv",
+    status: Optional[RecipientStatus] = None,
+    gzip: bool = False,
+    principal: Principal = Depends(current_user),
+) -> StreamingResponse:
+    """Download every recipient's outcome, streamed from a server-side cursor."""
+    await _authorize(campaign_id, principal)
+    filename = f"campaign-{campaign_id}.{format}" + (".gz" if gzip else "")
+    media_type = "application/gzip" if gzip else ("text/csv" if format == "csv" else "application/x-ndjson")
+    return StreamingResponse(
+        export_rows(campaign_id, format, status, gzip),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{filename}"', "X-Accel-Buffering": "no"},
+    )
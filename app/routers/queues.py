@@ -0,0 +1,24 @@
+from __future__ import annotations
+
+from fastapi import APIRouter
+from fastapi.concurrency import run_in_threadpool
+
+from ..cache import TTLCache
+from ..config import settings
+from ..routing import backlog
+from ..schemas import QueueBacklogOut
+
+router = APIRouter(prefix="/queues", tags=["queues"])
+
+_backlog_cache: TTLCache[QueueBacklogOut] = TTLCache(ttl_seconds=settings.queue_stats_cache_ttl_seconds, maxsize=1)
+
+
+async def _compute() -> QueueBacklogOut:
+    return QueueBacklogOut(**await run_in_threadpool(backlog))
+
+
+@router.get("/", response_model=QueueBacklogOut)
+async def queue_backlog() -> QueueBacklogOut:
+    """Broker depth and due work per send queue, for scaling workers."""
+    # pollers share one count per cache period instead of each running it
+    return await _backlog_cache.get_or_compute_async("all", _compute)
@@ -1,33 +1,63 @@
 from __future__ import annotations
 
-import smtplib
-import ssl
-from fastapi import APIRouter
+import asyncio
+import hashlib
 
+from fastapi import APIRouter, HTTPException
+
+from ..async_sender import close_quietly_async, open_smtp_connection_async
+from ..cache import TTLCache
+from ..config import settings
+from ..metrics import timed
 from ..schemas import SMTPVerifyIn, SMTPVerifyOut
 
 router = APIRouter(prefix="/smtp", tags=["smtp"])
 
+# a check holds no thread, only a socket; this caps the sockets per API process
+_slots = asyncio.Semaphore(settings.smtp_verify_concurrency)
+_results: TTLCache[SMTPVerifyOut] = TTLCache(ttl_seconds=settings.smtp_verify_cache_ttl_seconds, maxsize=4096)
 
-@router.post("/verify", response_model=SMTPVerifyOut)
-def smtp_verify(payload: SMTPVerifyIn) -> SMTPVerifyOut:
+
+def _cache_key(payload: SMTPVerifyIn) -> str:
+    # the password only ever appears in the key hashed
+    parts = (
+        payload.smtp_host.lower(),
+        str(payload.smtp_port),
+        payload.smtp_username,
+        payload.smtp_password,
+        str(payload.smtp_tls),
+        str(payload.smtp_ssl),
+    )
+    return hashlib.sha256("\0".join(parts).encode("utf-8")).hexdigest()
+
+
+async def _verify(payload: SMTPVerifyIn) -> SMTPVerifyOut:
     try:
-        if payload.smtp_ssl:
-            context = ssl.create_default_context()
-            with smtplib.SMTP_SSL(payload.smtp_host, payload.smtp_port, context=context, timeout=15) as server:
-                server.login(payload.smtp_username, payload.smtp_password)
-        else:
-            if payload.smtp_tls:
-                context = ssl.create_default_context()
-                with smtplib.SMTP(payload.smtp_host, payload.smtp_port, timeout=15) as server:
-                    server.ehlo()
-                    server.starttls(context=context)
-                    server.ehlo()
-                    server.login(payload.smtp_username, payload.smtp_password)
-            else:
-                with smtplib.SMTP(payload.smtp_host, payload.smtp_port, timeout=15) as server:
-                    server.ehlo()
-                    server.login(payload.smtp_username, payload.smtp_password)
+        await asyncio.wait_for(_slots.acquire(), timeout=settings.smtp_verify_queue_seconds)
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=503, detail="Too many SMTP checks in progress, try again shortly")
+    try:
+        # timed as a stage of its own so checks do not skew the send path's connect/tls/auth
+        with timed("verify"):
+            client = await open_smtp_connection_async(
+                smtp_host=payload.smtp_host,
+                smtp_port=payload.smtp_port,
+                smtp_username=payload.smtp_username,
+                smtp_password=payload.smtp_password,
+                use_starttls=payload.smtp_tls,
+                use_ssl=payload.smtp_ssl,
+                timeout=15,
+                timed_stages=False,
+            )
+            await close_quietly_async(client)
         return SMTPVerifyOut(ok=True)
     except Exception as e:  # noqa: BLE001
-        return SMTPVerifyOut(ok=False, detail=str(e))
+        return SMTPVerifyOut(ok=False, detail=str(e) or type(e).__name__)
+    finally:
+        _slots.release()
+
+
+@router.post("/verify", response_model=SMTPVerifyOut)
+async def smtp_verify(payload: SMTPVerifyIn) -> SMTPVerifyOut:
+    # identical checks in flight share one connection; a repeat within the TTL is answered from memory
+    return await _results.get_or_compute_async(_cache_key(payload), lambda: _verify(payload))
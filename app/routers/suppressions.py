@@ -0,0 +1,42 @@
+from __future__ import annotations
+
+from fastapi import APIRouter, Depends, HTTPException
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from ..auth import Principal, current_user
+from ..db import get_async_db
+from ..logs import get_logger
+from ..schemas import SuppressionsIn, SuppressionsOut
+from ..suppression import add_suppressions, remove_suppression
+
+router = APIRouter(prefix="/suppressions", tags=["suppressions"])
+log = get_logger(__name__)
+
+
+@router.post("/", response_model=SuppressionsOut)
+async def suppress_addresses(
+    payload: SuppressionsIn,
+    principal: Principal = Depends(current_user),
+    db: AsyncSession = Depends(get_async_db),
+) -> SuppressionsOut:
+    """Never mail these addresses again from any of the user's campaigns."""
+    user_id = principal.user_id
+    added = await db.run_sync(
+        lambda sync_db: add_suppressions(sync_db, [(user_id, email) for email in payload.emails], payload.reason)
+    )
+    await db.commit()
+    log.info("addresses_suppressed", user_id=user_id, added=added, reason=payload.reason.value)
+    return SuppressionsOut(added=added)
+
+
+@router.delete("/{email}")
+async def unsuppress_address(
+    email: str, principal: Principal = Depends(current_user), db: AsyncSession = Depends(get_async_db)
+) -> dict:
+    user_id = principal.user_id
+    removed = await db.run_sync(lambda sync_db: remove_suppression(sync_db, user_id, email))
+    if not removed:
+        raise HTTPException(status_code=404, detail="Address is not suppressed")
+    await db.commit()
+    log.info("address_unsuppressed", user_id=user_id)
+    return {"status": "removed", "email": email}
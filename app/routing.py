@@ -0,0 +1,169 @@
+"""Routing of send tasks to Celery queues.
+
+Campaigns are spread over SEND_QUEUE_SHARDS queues (``send.0``, ``send.1``,
+...) by a stable hash of their id, so adding workers for one shard never
+reshuffles the others. A campaign, a user or an SMTP host can be pinned to a
+queue of its own (or to a particular shard) with an override kept in Redis;
+the scheduler picks overrides up on its next refresh. A worker started
+without ``-Q`` consumes every shard; a dedicated worker runs with
+``-Q <queue>``.
+
+    python -m app.routing show
+    python -m app.routing set user 42 send.heavy
+    python -m app.routing clear user 42
+"""
+from __future__ import annotations
+
+import argparse
+import zlib
+from datetime import datetime, timezone
+from typing import Optional
+
+import redis
+from sqlalchemy import func, or_, select
+
+from .config import settings
+from .db import SessionLocal
+from .models import Campaign, CampaignStatus, Recipient, RecipientStatus
+from .redis_client import get_redis
+
+SHARD_PREFIX = "send."
+# queue of tasks enqueued before sharding; workers keep draining it
+LEGACY_QUEUE = "celery"
+OVERRIDE_KINDS = ("campaign", "user", "host")
+
+_OVERRIDES_KEY = "routing:overrides"
+# kombu's Redis transport keeps messages of priority p > 0 in "<queue>\x06\x16<p>"
+_PRIORITY_SUFFIXES = ("", "\x06\x163", "\x06\x166", "\x06\x169")
+
+
+def shard_queues() -> list[str]:
+    return [f"{SHARD_PREFIX}{i}" for i in range(max(1, settings.send_queue_shards))]
+
+
+def shard_for(campaign_id: int) -> str:
+    shards = max(1, settings.send_queue_shards)
+    return f"{SHARD_PREFIX}{zlib.crc32(str(campaign_id).encode('ascii')) % shards}"
+
+
+def _field(kind: str, value: str) -> str:
+    if kind not in OVERRIDE_KINDS:
+        raise ValueError(f"Unknown route kind {kind!r}; expected one of {', '.join(OVERRIDE_KINDS)}")
+    return f"{kind}:{value.lower() if kind == 'host' else value}"
+
+
+def load_overrides(client: Optional[redis.Redis] = None) -> dict[str, str]:
+    raw = (client or get_redis()).hgetall(_OVERRIDES_KEY)
+    return {k.decode("utf-8"): v.decode("utf-8") for k, v in raw.items()}
+
+
+def set_override(kind: str, value: str, queue: str, client: Optional[redis.Redis] = None) -> None:
+    (client or get_redis()).hset(_OVERRIDES_KEY, _field(kind, value), queue)
+
+
+def clear_override(kind: str, value: str, client: Optional[redis.Redis] = None) -> bool:
+    return bool((client or get_redis()).hdel(_OVERRIDES_KEY, _field(kind, value)))
+
+
+def route(overrides: dict[str, str], campaign_id: int, user_id: int, smtp_host: str) -> str:
+    """The queue for a campaign's send tasks: campaign, then user, then host overrides, then its shard."""
+    for field in (f"campaign:{campaign_id}", f"user:{user_id}", f"host:{smtp_host.lower()}"):
+        queue = overrides.get(field)
+        if queue:
+            return queue
+    return shard_for(campaign_id)
+
+
+def queued_tasks(queues: list[str], client: Optional[redis.Redis] = None) -> dict[str, int]:
+    """Messages waiting in the broker per queue."""
+    pipe = (client or get_redis()).pipeline(transaction=False)
+    for queue in queues:
+        for suffix in _PRIORITY_SUFFIXES:
+            pipe.llen(queue + suffix)
+    lengths = pipe.execute()
+    n = len(_PRIORITY_SUFFIXES)
+    return {queue: sum(lengths[i * n:(i + 1) * n]) for i, queue in enumerate(queues)}
+
+
+def backlog() -> dict:
+    """Broker depth and due work per queue, for autoscaling workers.
+
+    ``due_recipients`` counts pending recipients of running campaigns whose
+    retry time has come; ``max_send_rate`` is the most those campaigns may
+    send per second under their own limits.
+    """
+    now = datetime.now(timezone.utc)
+    with SessionLocal() as db:
+        rows = db.execute(
+            select(
+                Campaign.id,
+                Campaign.user_id,
+                Campaign.smtp_host,
+                Campaign.limit_count,
+                Campaign.limit_window_seconds,
+                func.count(Recipient.id),
+            )
+            .join(Recipient, Recipient.campaign_id == Campaign.id)
+            .where(
+                Campaign.status == CampaignStatus.running,
+                Recipient.status == RecipientStatus.pending,
+                or_(Recipient.retry_at.is_(None), Recipient.retry_at <= now),
+            )
+            .group_by(Campaign.id)
+        ).all()
+    client = get_redis()
+    overrides = load_overrides(client)
+    # every shard and override target is listed, idle ones too
+    stats = {queue: _empty_stats() for queue in [*shard_queues(), *overrides.values()]}
+    for campaign_id, user_id, smtp_host, limit_count, window, due in rows:
+        entry = stats.setdefault(route(overrides, campaign_id, user_id, smtp_host), _empty_stats())
+        entry["campaigns"] += 1
+        entry["due_recipients"] += due
+        entry["max_send_rate"] += limit_count / max(1, window)
+    depths = queued_tasks([*stats, LEGACY_QUEUE], client)
+    if depths[LEGACY_QUEUE]:
+        stats[LEGACY_QUEUE] = _empty_stats()
+    queues = [
+        {"queue": queue, "queued_tasks": depths[queue], **entry, "max_send_rate": round(entry["max_send_rate"], 3)}
+        for queue, entry in sorted(stats.items())
+    ]
+    return {"generated_at": now, "queues": queues}
+
+
+def _empty_stats() -> dict:
+    return {"campaigns": 0, "due_recipients": 0, "max_send_rate": 0.0}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(prog="python -m app.routing", description=__doc__.split("\n\n")[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("show", help="list overrides and the backlog per queue")
+    pin = commands.add_parser("set", help="route a campaign, user or SMTP host to a queue")
+    pin.add_argument("kind", choices=OVERRIDE_KINDS)
+    pin.add_argument("value")
+    pin.add_argument("queue")
+    unpin = commands.add_parser("clear", help="send a campaign, user or SMTP host back to its shard")
+    unpin.add_argument("kind", choices=OVERRIDE_KINDS)
+    unpin.add_argument("value")
+    args = parser.parse_args()
+
+    if args.command == "set":
+        set_override(args.kind, args.value, args.queue)
+        if args.queue not in shard_queues():
+            print(f"{args.queue} is not a shard; run a worker with -Q {args.queue}")
+    elif args.command == "clear":
+        if not clear_override(args.kind, args.value):
+            print(f"no route for {args.kind} {args.value}")
+    else:
+        for field, queue in sorted(load_overrides().items()):
+            print(f"{field} -> {queue}")
+        print(f"{'queue':<24}{'queued':>10}{'campaigns':>11}{'due':>12}{'max/s':>10}")
+        for q in backlog()["queues"]:
+            print(
+                f"{q['queue']:<24}{q['queued_tasks']:>10}{q['campaigns']:>11}"
+                f"{q['due_recipients']:>12}{q['max_send_rate']:>10.2f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
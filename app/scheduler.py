@@ -0,0 +1,525 @@
+"""Central send scheduler for the Celery engine.
+
+Run with ``python -m app.scheduler``. Instead of every campaign parking a
+countdown task in the broker, one loop decides which running campaign may
+send next and enqueues ``send_next_email`` on the campaign's queue (see
+``app.routing``) with the number of messages it was granted. Pacing is GCRA
+(a token bucket expressed as a theoretical arrival time) stored in Redis,
+per campaign and optionally per SMTP account, and Redis leases cap the active senders per campaign at
+SCHEDULER_SENDERS_PER_CAMPAIGN (one by default). Senders report throttling
+replies per SMTP account; the account's adaptive rate factor (AIMD, see
+``record_pacing``) stretches the emission interval of every campaign on it.
+Users (tenants) share worker capacity by weighted fair queuing, see
+``Scheduler``. Several scheduler processes may run; the Lua script makes
+each grant atomic. The loop also flushes the write-behind delivery results
+(see ``app.result_sink``), as do the Celery workers. A failing tick (Redis
+or the database unreachable) is logged and retried with backoff up to
+_MAX_BACKOFF_SECONDS; the loop itself never exits on one.
+"""
+from __future__ import annotations
+
+import hashlib
+import heapq
+import math
+import time
+import uuid
+from collections import deque
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Optional
+
+import redis
+from sqlalchemy import select
+
+from .config import settings
+from .crypto import decrypt_str
+from .db import SessionLocal
+from .logs import configure_logging, get_logger
+from .metrics import serve as serve_metrics
+from .models import Campaign, CampaignStatus, User
+from .redis_client import get_async_redis, get_redis
+from .result_sink import ResultSink, make_sink
+from .routing import load_overrides, route
+
+log = get_logger(__name__)
+
+_WAKE_KEY = "scheduler:wake"
+_MAX_BACKOFF_SECONDS = 30.0
+
+# KEYS[1] sender leases (zset of token -> expiry ms), KEYS[2] campaign hold
+# (set while only deferred recipients remain), KEYS[3] adaptive rate of the
+# SMTP account (hash, field f in (0, 1]), KEYS[4] the user's senders in flight
+# (zset like KEYS[1]), KEYS[5..n] GCRA keys
+# ARGV[1] lease token, ARGV[2] lease ttl ms, ARGV[3] max messages wanted,
+# ARGV[4] max concurrent senders, then (emission interval us, burst tolerance us)
+# for each GCRA key.
+# Returns {granted, retry_after_ms}; retry_after_ms is -1 while all sender slots are taken.
+_GRANT_SCRIPT = """
+local t = redis.call('TIME')
+local now = tonumber(t[1]) * 1000000 + tonumber(t[2])
+local now_ms = math.floor(now / 1000)
+local hold = redis.call('PTTL', KEYS[2])
+if hold > 0 then
+  return {0, hold}
+end
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now_ms)
+if redis.call('ZCARD', KEYS[1]) >= tonumber(ARGV[4]) then
+  return {0, -1}
+end
+local factor = tonumber(redis.call('HGET', KEYS[3], 'f') or '1')
+local granted = tonumber(ARGV[3])
+local wait = 0
+local tats = {}
+local intervals = {}
+for i = 5, #KEYS do
+  -- a throttled account spaces sends out; the burst window keeps its length
+  local interval = math.ceil(tonumber(ARGV[2 * i - 5]) / factor)
+  local tau = tonumber(ARGV[2 * i - 4])
+  intervals[i] = interval
+  local tat = tonumber(redis.call('GET', KEYS[i]) or '0')
+  if tat < now then
+    tat = now
+  end
+  tats[i] = tat
+  local k = math.floor((now + tau - tat) / interval) + 1
+  if k < 1 then
+    k = 0
+    if tat - tau - now > wait then
+      wait = tat - tau - now
+    end
+  end
+  if k < granted then
+    granted = k
+  end
+end
+if granted <= 0 then
+  return {0, math.ceil(wait / 1000)}
+end
+for i = 5, #KEYS do
+  local tau = tonumber(ARGV[2 * i - 4])
+  local new_tat = tats[i] + granted * intervals[i]
+  redis.call('SET', KEYS[i], string.format('%d', new_tat), 'PX', math.ceil((new_tat - now + tau) / 1000) + 1000)
+end
+redis.call('ZADD', KEYS[1], now_ms + tonumber(ARGV[2]), ARGV[1])
+redis.call('PEXPIRE', KEYS[1], ARGV[2])
+redis.call('ZREMRANGEBYSCORE', KEYS[4], '-inf', now_ms)
+redis.call('ZADD', KEYS[4], now_ms + tonumber(ARGV[2]), ARGV[1])
+redis.call('PEXPIRE', KEYS[4], ARGV[2])
+return {granted, 0}
+"""
+
+# KEYS[1] adaptive rate hash: f (factor), t (last update ms), d (last decrease ms)
+# ARGV[1] "1" if the sender was throttled, ARGV[2] decrease factor,
+# ARGV[3] increase per second, ARGV[4] floor, ARGV[5] decrease cooldown ms
+# Returns the new factor; the key is dropped once it is back at 1.
+_PACING_SCRIPT = """
+local t = redis.call('TIME')
+local now_ms = tonumber(t[1]) * 1000 + math.floor(tonumber(t[2]) / 1000)
+local state = redis.call('HMGET', KEYS[1], 'f', 't', 'd')
+local f = tonumber(state[1] or '1')
+local last = tonumber(state[2] or now_ms)
+if ARGV[1] == '1' then
+  if now_ms - tonumber(state[3] or '0') < tonumber(ARGV[5]) then
+    return tostring(f)
+  end
+  f = math.max(tonumber(ARGV[4]), f * tonumber(ARGV[2]))
+  redis.call('HSET', KEYS[1], 'd', now_ms)
+else
+  -- additive increase for the time since the last report, capped so an idle gap is no free pass
+  f = math.min(1, f + tonumber(ARGV[3]) * math.min(10000, now_ms - last) / 1000)
+end
+if f >= 1 then
+  redis.call('DEL', KEYS[1])
+  return '1'
+end
+redis.call('HSET', KEYS[1], 'f', tostring(f), 't', now_ms)
+redis.call('PEXPIRE', KEYS[1], 86400000)
+return tostring(f)
+"""
+
+
+def lease_key(campaign_id: int) -> str:
+    return f"scheduler:lease:campaign:{campaign_id}"
+
+
+def campaign_rate_key(campaign_id: int) -> str:
+    return f"scheduler:gcra:campaign:{campaign_id}"
+
+
+def campaign_hold_key(campaign_id: int) -> str:
+    return f"scheduler:hold:campaign:{campaign_id}"
+
+
+def user_in_flight_key(user_id: int) -> str:
+    return f"scheduler:inflight:user:{user_id}"
+
+
+def _account_digest(smtp_host: str, smtp_port: int, smtp_username: str) -> str:
+    return hashlib.sha256(f"{smtp_host.lower()}:{smtp_port}:{smtp_username}".encode("utf-8")).hexdigest()[:16]
+
+
+def account_rate_key(smtp_host: str, smtp_port: int, smtp_username: str) -> str:
+    return f"scheduler:gcra:smtp:{_account_digest(smtp_host, smtp_port, smtp_username)}"
+
+
+def account_pacing_key(smtp_host: str, smtp_port: int, smtp_username: str) -> str:
+    return f"scheduler:pacing:smtp:{_account_digest(smtp_host, smtp_port, smtp_username)}"
+
+
+def gcra_params(limit_count: int, limit_window_seconds: int) -> tuple[int, int]:
+    """Emission interval and burst tolerance in microseconds.
+
+    The tolerance lets a campaign spend its whole ``limit_count`` inside one
+    window instead of being held to a rounded-up fixed delay.
+    """
+    count = max(1, limit_count)
+    interval = math.ceil(limit_window_seconds * 1_000_000 / count)
+    return interval, interval * (count - 1)
+
+
+def request_dispatch(campaign_id: int) -> None:
+    """Ask running schedulers to pick the campaign up without waiting for a refresh."""
+    get_redis().sadd(_WAKE_KEY, campaign_id)
+
+
+def release_sender(campaign_id: int, lease_token: str, user_id: Optional[int] = None) -> None:
+    # without the user the token leaves its in-flight set when the lease expires
+    pipe = get_redis().pipeline(transaction=False)
+    pipe.zrem(lease_key(campaign_id), lease_token)
+    if user_id is not None:
+        pipe.zrem(user_in_flight_key(user_id), lease_token)
+    pipe.execute()
+
+
+def hold_dispatch(campaign_id: int, seconds: float) -> None:
+    """Grant the campaign nothing for ``seconds``: its remaining recipients are deferred
+    or its SMTP server's circuit is open."""
+    get_redis().set(campaign_hold_key(campaign_id), 1, px=max(1, int(seconds * 1000)))
+
+
+def _pacing_args(throttled: bool) -> list:
+    return [
+        "1" if throttled else "0",
+        settings.adaptive_rate_decrease,
+        settings.adaptive_rate_increase_per_second,
+        settings.adaptive_rate_floor,
+        int(settings.adaptive_rate_cooldown_seconds * 1000),
+    ]
+
+
+@lru_cache(maxsize=1)
+def _pacing_script():  # noqa: ANN202
+    return get_redis().register_script(_PACING_SCRIPT)
+
+
+@lru_cache(maxsize=1)
+def _pacing_script_async():  # noqa: ANN202
+    return get_async_redis().register_script(_PACING_SCRIPT)
+
+
+def record_pacing(smtp_host: str, smtp_port: int, smtp_username: str, throttled: bool) -> float:
+    """Report how sending on an SMTP account went; returns its new rate factor.
+
+    A throttling reply cuts the factor multiplicatively, anything else adds
+    back linearly with time until the configured rate is reached again.
+    """
+    if not settings.adaptive_rate_enabled:
+        return 1.0
+    key = account_pacing_key(smtp_host, smtp_port, smtp_username)
+    try:
+        factor = float(_pacing_script()(keys=[key], args=_pacing_args(throttled)))
+    except redis.RedisError as e:
+        # pacing is advisory; the scheduler keeps the last known factor
+        log.warning("pacing_report_failed", smtp_host=smtp_host, error=str(e))
+        return 1.0
+    if throttled:
+        log.warning("smtp_throttled", smtp_host=smtp_host, rate_factor=round(factor, 3))
+    return factor
+
+
+async def record_pacing_async(smtp_host: str, smtp_port: int, smtp_username: str, throttled: bool) -> float:
+    if not settings.adaptive_rate_enabled:
+        return 1.0
+    key = account_pacing_key(smtp_host, smtp_port, smtp_username)
+    try:
+        factor = float(await _pacing_script_async()(keys=[key], args=_pacing_args(throttled)))
+    except redis.RedisError as e:
+        log.warning("pacing_report_failed", smtp_host=smtp_host, error=str(e))
+        return 1.0
+    if throttled:
+        log.warning("smtp_throttled", smtp_host=smtp_host, rate_factor=round(factor, 3))
+    return factor
+
+
+@dataclass
+class _ScheduledCampaign:
+    id: int
+    user_id: int
+    queue: str
+    pacing_key: str
+    rate_keys: list[str]
+    rate_args: list[int]
+    not_before: float = 0.0
+    # last successful grant; a user's due campaigns take turns in this order
+    last_granted: float = 0.0
+
+
+class Scheduler:
+    """Grants sends to running campaigns, sharing capacity fairly between users.
+
+    Users with due campaigns are served by weighted fair queuing: a grant
+    advances the user's virtual time by the messages granted divided by the
+    user's ``send_weight``, and the user with the lowest virtual time goes
+    next. With ``max_in_flight`` set, a user holds at most its weighted share
+    of that many concurrent senders, and may borrow idle capacity up to
+    ``tenant_max_share`` of it, so one large customer never holds every worker.
+    """
+
+    def __init__(
+        self,
+        client: redis.Redis,
+        tick_seconds: float,
+        refresh_seconds: float,
+        sink: Optional[ResultSink] = None,
+        max_in_flight: int = 0,
+        tenant_max_share: float = 1.0,
+    ) -> None:
+        self.client = client
+        self.sink = sink
+        self.tick_seconds = tick_seconds
+        self.refresh_seconds = refresh_seconds
+        self.max_in_flight = max(0, max_in_flight)
+        self.tenant_max_share = min(1.0, max(0.0, tenant_max_share))
+        self._grant = client.register_script(_GRANT_SCRIPT)
+        self._campaigns: dict[int, _ScheduledCampaign] = {}
+        self._usernames: dict[str, str] = {}
+        self._weights: dict[int, int] = {}
+        self._vtime: dict[int, float] = {}
+        # virtual time of the last grant; users coming back from idle start here
+        self._clock = 0.0
+        self._next_refresh = 0.0
+        # consecutive ticks that failed; the loop backs off while they last
+        self.failures = 0
+
+    def run_forever(self) -> None:
+        log.info("scheduler_started")
+        try:
+            while True:
+                self.run_once()
+                time.sleep(self._sleep_seconds())
+        finally:
+            if self.sink is not None:
+                self.sink.close()
+
+    def run_once(self) -> int:
+        try:
+            dispatched = self._tick()
+        except Exception as e:  # noqa: BLE001
+            # the next tick starts over from a refresh; grants made so far stand
+            self.failures += 1
+            self._next_refresh = 0.0
+            log.error("scheduler_tick_failed", error=str(e), failures=self.failures)
+            dispatched = 0
+        else:
+            self.failures = 0
+        if self.sink is not None:
+            try:
+                self.sink.flush_due()
+            except Exception as e:  # noqa: BLE001
+                # the batch stays journaled and is retried on the next tick
+                log.error("result_flush_failed", error=str(e))
+        return dispatched
+
+    def _sleep_seconds(self) -> float:
+        if not self.failures:
+            return self.tick_seconds
+        return min(_MAX_BACKOFF_SECONDS, max(self.tick_seconds, 0.1) * 2 ** self.failures)
+
+    def _tick(self) -> int:
+        now = time.monotonic()
+        woken = self.client.spop(_WAKE_KEY, 1000)
+        if woken or now >= self._next_refresh:
+            self._refresh()
+            self._next_refresh = now + self.refresh_seconds
+        due: dict[int, list[_ScheduledCampaign]] = {}
+        for campaign in self._campaigns.values():
+            if campaign.not_before <= now:
+                due.setdefault(campaign.user_id, []).append(campaign)
+        return self._dispatch_fairly(due, now) if due else 0
+
+    def _dispatch_fairly(self, due: dict[int, list[_ScheduledCampaign]], now: float) -> int:
+        queues = {
+            user_id: deque(sorted(campaigns, key=lambda c: c.last_granted))
+            for user_id, campaigns in due.items()
+        }
+        for user_id in queues:
+            # no credit is banked while idle
+            self._vtime[user_id] = max(self._vtime.get(user_id, self._clock), self._clock)
+        if not self.max_in_flight:
+            return self._serve(queues, now)
+
+        in_flight = self._in_flight()
+        # shares are of every user with running campaigns, not only the ones due this
+        # tick: capacity a paced user is not using right now is borrowed, not handed over
+        active_weight = sum(self._weights.get(u, 1) for u in set(self._weights) | set(queues))
+        fair = {u: math.ceil(self.max_in_flight * self._weights.get(u, 1) / active_weight) for u in queues}
+        borrow = math.floor(self.max_in_flight * self.tenant_max_share)
+        # everyone up to their fair share first, then idle capacity up to the borrowing cap
+        dispatched = self._serve(queues, now, fair, in_flight)
+        if sum(in_flight.values()) < self.max_in_flight:
+            dispatched += self._serve(queues, now, {u: max(n, borrow) for u, n in fair.items()}, in_flight)
+        return dispatched
+
+    def _serve(
+        self,
+        queues: dict[int, deque[_ScheduledCampaign]],
+        now: float,
+        limits: Optional[dict[int, int]] = None,
+        in_flight: Optional[dict[int, int]] = None,
+    ) -> int:
+        """Dispatch queued campaigns in virtual-time order; ``limits`` caps each user's senders."""
+        heap = [(self._vtime[u], u) for u, queue in queues.items() if queue]
+        heapq.heapify(heap)
+        total = sum(in_flight.values()) if in_flight is not None else 0
+        dispatched = 0
+        while heap and (limits is None or total < self.max_in_flight):
+            vtime, user_id = heapq.heappop(heap)
+            if limits is not None and in_flight.get(user_id, 0) >= limits[user_id]:
+                continue
+            campaign = queues[user_id].popleft()
+            granted = self._dispatch(campaign, now)
+            if granted:
+                dispatched += granted
+                campaign.last_granted = now
+                self._clock = vtime
+                self._vtime[user_id] = vtime + granted / self._weights.get(user_id, 1)
+                if in_flight is not None:
+                    in_flight[user_id] = in_flight.get(user_id, 0) + 1
+                    total += 1
+            if queues[user_id]:
+                heapq.heappush(heap, (self._vtime[user_id], user_id))
+        return dispatched
+
+    def _in_flight(self) -> dict[int, int]:
+        """Senders granted and not yet finished, per user with running campaigns."""
+        users = list(self._weights)
+        now_ms = int(time.time() * 1000)
+        pipe = self.client.pipeline(transaction=False)
+        for user_id in users:
+            pipe.zcount(user_in_flight_key(user_id), now_ms, "+inf")
+        return dict(zip(users, pipe.execute()))
+
+    def _dispatch(self, campaign: _ScheduledCampaign, now: float) -> int:
+        # imported here: the task module imports this one
+        from .tasks import send_next_email
+
+        token = uuid.uuid4().hex
+        granted, retry_after_ms = self._grant(
+            keys=[
+                lease_key(campaign.id),
+                campaign_hold_key(campaign.id),
+                campaign.pacing_key,
+                user_in_flight_key(campaign.user_id),
+                *campaign.rate_keys,
+            ],
+            args=[
+                token,
+                settings.scheduler_lease_seconds * 1000,
+                max(1, settings.send_batch_size),
+                max(1, settings.scheduler_senders_per_campaign),
+                *campaign.rate_args,
+            ],
+        )
+        if granted <= 0:
+            if retry_after_ms > 0:
+                campaign.not_before = now + retry_after_ms / 1000.0
+            return 0
+        send_next_email.apply_async(
+            args=[campaign.id, granted, token, time.time(), campaign.user_id], queue=campaign.queue
+        )
+        return granted
+
+    def _refresh(self) -> None:
+        with SessionLocal() as db:
+            rows = db.execute(
+                select(
+                    Campaign.id,
+                    Campaign.user_id,
+                    Campaign.limit_count,
+                    Campaign.limit_window_seconds,
+                    Campaign.smtp_host,
+                    Campaign.smtp_port,
+                    Campaign.smtp_username_enc,
+                    User.send_weight,
+                )
+                .join(User, User.id == Campaign.user_id)
+                .where(Campaign.status == CampaignStatus.running)
+            ).all()
+        overrides = load_overrides(self.client)
+
+        campaigns: dict[int, _ScheduledCampaign] = {}
+        for row in rows:
+            rate_keys = [campaign_rate_key(row.id)]
+            rate_args = list(gcra_params(row.limit_count, row.limit_window_seconds))
+            username = self._username(row.smtp_username_enc)
+            if settings.smtp_account_limit_count:
+                rate_keys.append(account_rate_key(row.smtp_host, row.smtp_port, username))
+                rate_args.extend(
+                    gcra_params(settings.smtp_account_limit_count, settings.smtp_account_limit_window_seconds)
+                )
+            previous = self._campaigns.get(row.id)
+            campaigns[row.id] = _ScheduledCampaign(
+                id=row.id,
+                user_id=row.user_id,
+                queue=route(overrides, row.id, row.user_id, row.smtp_host),
+                pacing_key=account_pacing_key(row.smtp_host, row.smtp_port, username),
+                rate_keys=rate_keys,
+                rate_args=rate_args,
+                not_before=previous.not_before if previous is not None else 0.0,
+                last_granted=previous.last_granted if previous is not None else 0.0,
+            )
+        self._campaigns = campaigns
+        self._weights = {row.user_id: max(1, row.send_weight) for row in rows}
+        self._vtime = {u: v for u, v in self._vtime.items() if u in self._weights}
+        # forget decrypted usernames of campaigns that stopped running
+        live = {row.smtp_username_enc for row in rows}
+        self._usernames = {enc: name for enc, name in self._usernames.items() if enc in live}
+
+    def _username(self, smtp_username_enc: str) -> str:
+        username = self._usernames.get(smtp_username_enc)
+        if username is None:
+            username = self._usernames[smtp_username_enc] = decrypt_str(smtp_username_enc)
+        return username
+
+
+def max_in_flight() -> int:
+    """SCHEDULER_MAX_IN_FLIGHT, or the worker slots it stands for when unset."""
+    if settings.scheduler_max_in_flight is not None:
+        return max(0, settings.scheduler_max_in_flight)
+    return max(1, settings.worker_count) * max(1, settings.worker_concurrency)
+
+
+def main() -> None:
+    configure_logging()
+    if settings.send_engine != "celery":
+        # the async engine paces its own sends; granting tasks too would double the rate
+        log.warning("scheduler_disabled", send_engine=settings.send_engine)
+        return
+    serve_metrics(settings.scheduler_metrics_port)
+    cap = max_in_flight()
+    if cap:
+        log.info("scheduler_fair_share", max_in_flight=cap, tenant_max_share=settings.scheduler_tenant_max_share)
+    else:
+        log.warning("scheduler_fair_share_uncapped", hint="one user's campaigns can fill every worker slot")
+    Scheduler(
+        get_redis(),
+        tick_seconds=settings.scheduler_tick_seconds,
+        refresh_seconds=settings.scheduler_refresh_seconds,
+        sink=make_sink(get_redis()),
+        max_in_flight=cap,
+        tenant_max_share=settings.scheduler_tenant_max_share,
+    ).run_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,11 @@
 from __future__ import annotations
 
-from typing import List, Optional
+from datetime import datetime
+from typing import Dict, List, Literal, Optional, Union
 from pydantic import BaseModel, EmailStr, Field
 
+from .models import SuppressionReason
+
 
 class SMTPSettings(BaseModel):
     smtp_host: str
@@ -16,6 +19,8 @@ class SMTPSettings(BaseModel):
 class RecipientIn(BaseModel):
     to_email: EmailStr
     to_name: Optional[str] = None
+    # merge fields available to the templates as {{ attributes.<key> }}
+    attributes: Optional[Dict[str, Union[str, int, float, bool]]] = None
 
 
 class CampaignCreate(BaseModel):
@@ -28,14 +33,21 @@ class CampaignCreate(BaseModel):
 
     limits_count: int = Field(1, ge=1)
     limits_window_seconds: int = Field(3600, ge=1)
+    # send one copy to up to this many recipients at once (undisclosed To);
+    # only for a subject and body without merge fields
+    recipients_per_message: int = Field(1, ge=1, le=100)
 
     smtp: SMTPSettings
-    recipients: List[RecipientIn]
+    # may be left empty and uploaded through POST /campaigns/{id}/recipients/bulk
+    recipients: List[RecipientIn] = Field(default_factory=list)
 
 
 class CampaignOut(BaseModel):
     id: int
     name: str
+    # recipients left out as repeats or as suppressed addresses
+    duplicates: int = 0
+    suppressed: int = 0
 
     class Config:
         from_attributes = True
@@ -51,6 +63,80 @@ class CampaignStatusOut(BaseModel):
     progress_pct: float
 
 
+class RecipientImportError(BaseModel):
+    line: int
+    reason: str
+
+
+class RecipientImportOut(BaseModel):
+    accepted: int
+    rejected: int
+    duplicates: int = 0
+    suppressed: int = 0
+    errors: List[RecipientImportError]
+
+
+class RecipientOut(BaseModel):
+    id: int
+    to_email: str
+    to_name: Optional[str] = None
+    attributes: Optional[Dict[str, Union[str, int, float, bool]]] = None
+    status: str
+    last_error: Optional[str] = None
+    last_attempt_at: Optional[datetime] = None
+    sent_at: Optional[datetime] = None
+
+
+class RecipientPage(BaseModel):
+    items: List[RecipientOut]
+    # pass as ?after= for the next page; null on the last page
+    next_after: Optional[int] = None
+
+
+DeliveryStatus = Literal["sent", "failed", "deferred"]
+
+
+class DeliveryOut(BaseModel):
+    id: int
+    recipient_id: int
+    status: str
+    message_id: Optional[str] = None
+    smtp_response: Optional[str] = None
+    attempts: int
+    delivered_at: Optional[datetime] = None
+    error: Optional[str] = None
+
+
+class DeliveryPage(BaseModel):
+    items: List[DeliveryOut]
+    next_after: Optional[int] = None
+
+
+class SuppressionsIn(BaseModel):
+    emails: List[EmailStr] = Field(min_length=1, max_length=10000)
+    reason: SuppressionReason = SuppressionReason.manual
+
+
+class SuppressionsOut(BaseModel):
+    added: int
+
+
+class QueueBacklog(BaseModel):
+    queue: str
+    # send tasks waiting in the broker
+    queued_tasks: int
+    # running campaigns routed here that have recipients due now
+    campaigns: int
+    due_recipients: int
+    # messages per second those campaigns may send at most
+    max_send_rate: float
+
+
+class QueueBacklogOut(BaseModel):
+    generated_at: datetime
+    queues: List[QueueBacklog]
+
+
 class SMTPVerifyIn(SMTPSettings):
     pass
 
@@ -58,3 +144,24 @@ class SMTPVerifyIn(SMTPSettings):
 class SMTPVerifyOut(BaseModel):
     ok: bool
     detail: Optional[str] = None
+
+
+class ApiKeyCreate(BaseModel):
+    name: str = Field(min_length=1, max_length=255)
+    # the key stops working after this many days; never when left out
+    expires_in_days: Optional[int] = Field(None, ge=1)
+
+
+class ApiKeyOut(BaseModel):
+    id: int
+    name: str
+    is_active: bool
+    created_at: Optional[datetime] = None
+    expires_at: Optional[datetime] = None
+    # written back in batches, so up to API_KEY_LAST_USED_FLUSH_SECONDS behind
+    last_used_at: Optional[datetime] = None
+
+
+class ApiKeyCreated(ApiKeyOut):
+    # shown only in this response; only its hash is stored
+    key: str
@@ -0,0 +1,203 @@
+from __future__ import annotations
+
+import hashlib
+import smtplib
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import NamedTuple
+
+from .circuit import guard
+from .config import settings
+from .email_sender import TransientSMTPError, close_quietly, open_smtp_connection
+
+
+class PoolKey(NamedTuple):
+    smtp_host: str
+    smtp_port: int
+    smtp_username: str
+    password_digest: str
+    use_starttls: bool
+    use_ssl: bool
+
+
+class PoolExhausted(TransientSMTPError):
+    pass
+
+
+@dataclass
+class PooledConnection:
+    key: PoolKey
+    server: smtplib.SMTP
+    last_used_at: float = field(default_factory=time.monotonic)
+    messages_sent: int = 0
+    # True until the connection has been handed out once; a failure on a fresh
+    # connection is the server's answer, not a stale socket
+    fresh: bool = True
+
+
+def make_key(
+    smtp_host: str,
+    smtp_port: int,
+    smtp_username: str,
+    smtp_password: str,
+    use_starttls: bool,
+    use_ssl: bool,
+) -> PoolKey:
+    # The password is part of the key so a changed password never rides on a
+    # connection authenticated with the old one
+    digest = hashlib.sha256(smtp_password.encode("utf-8")).hexdigest()
+    return PoolKey(smtp_host.lower(), smtp_port, smtp_username, digest, use_starttls, use_ssl)
+
+
+class SMTPConnectionPool:
+    """Authenticated SMTP connections shared by every campaign in a worker process.
+
+    Idle connections are checked with NOOP before reuse once they have sat for
+    ``noop_after`` seconds and are closed after ``idle_timeout`` seconds. At most
+    ``max_per_host`` connections (idle and in use) exist per host and port.
+    """
+
+    def __init__(
+        self,
+        max_per_host: int,
+        idle_timeout: float,
+        noop_after: float,
+        max_messages: int,
+        acquire_timeout: float = 30.0,
+    ) -> None:
+        self.max_per_host = max(1, max_per_host)
+        self.idle_timeout = idle_timeout
+        self.noop_after = noop_after
+        self.max_messages = max(1, max_messages)
+        self.acquire_timeout = acquire_timeout
+        self._idle: dict[PoolKey, list[PooledConnection]] = {}
+        self._open_per_host: dict[tuple[str, int], int] = {}
+        self._cond = threading.Condition()
+
+    def acquire(
+        self,
+        smtp_host: str,
+        smtp_port: int,
+        smtp_username: str,
+        smtp_password: str,
+        use_starttls: bool,
+        use_ssl: bool = False,
+    ) -> PooledConnection:
+        key = make_key(smtp_host, smtp_port, smtp_username, smtp_password, use_starttls, use_ssl)
+        host = (key.smtp_host, key.smtp_port)
+        deadline = time.monotonic() + self.acquire_timeout
+
+        while True:
+            stale: list[PooledConnection] = []
+            with self._cond:
+                self._reap_locked(stale)
+                idle = self._idle.get(key)
+                conn = idle.pop() if idle else None
+                if conn is None:
+                    if self._open_per_host.get(host, 0) < self.max_per_host:
+                        # reserve the slot before connecting outside the lock
+                        self._open_per_host[host] = self._open_per_host.get(host, 0) + 1
+                    elif not self._evict_other_idle_locked(host, key, stale):
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            raise PoolExhausted(f"No free SMTP connection for {smtp_host}:{smtp_port}")
+                        self._cond.wait(remaining)
+                        continue
+            for old in stale:
+                close_quietly(old.server)
+
+            if conn is not None:
+                if self._is_alive(conn):
+                    conn.fresh = False
+                    return conn
+                self.discard(conn)
+                continue
+
+            try:
+                with guard(smtp_host, smtp_port, smtp_username):
+                    server = open_smtp_connection(
+                        smtp_host=smtp_host,
+                        smtp_port=smtp_port,
+                        smtp_username=smtp_username,
+                        smtp_password=smtp_password,
+                        use_starttls=use_starttls,
+                        use_ssl=use_ssl,
+                    )
+            except BaseException:
+                self._forget(host)
+                raise
+            return PooledConnection(key=key, server=server)
+
+    def release(self, conn: PooledConnection) -> None:
+        """Return a healthy connection for reuse."""
+        if conn.messages_sent >= self.max_messages:
+            self.discard(conn)
+            return
+        conn.last_used_at = time.monotonic()
+        with self._cond:
+            self._idle.setdefault(conn.key, []).append(conn)
+            self._cond.notify()
+
+    def discard(self, conn: PooledConnection) -> None:
+        """Close a connection that is broken or has reached its message cap."""
+        close_quietly(conn.server)
+        self._forget((conn.key.smtp_host, conn.key.smtp_port))
+
+    def close_all(self) -> None:
+        with self._cond:
+            conns = [c for idle in self._idle.values() for c in idle]
+            self._idle.clear()
+            for c in conns:
+                host = (c.key.smtp_host, c.key.smtp_port)
+                self._open_per_host[host] = max(0, self._open_per_host.get(host, 0) - 1)
+            self._cond.notify_all()
+        for c in conns:
+            close_quietly(c.server)
+
+    def _is_alive(self, conn: PooledConnection) -> bool:
+        if time.monotonic() - conn.last_used_at < self.noop_after:
+            return True
+        try:
+            code, _ = conn.server.noop()
+        except (smtplib.SMTPException, OSError):
+            return False
+        return code == 250
+
+    def _forget(self, host: tuple[str, int]) -> None:
+        with self._cond:
+            self._open_per_host[host] = max(0, self._open_per_host.get(host, 0) - 1)
+            self._cond.notify()
+
+    def _reap_locked(self, stale: list[PooledConnection]) -> None:
+        cutoff = time.monotonic() - self.idle_timeout
+        for key, idle in list(self._idle.items()):
+            keep = [c for c in idle if c.last_used_at >= cutoff]
+            for c in idle:
+                if c.last_used_at < cutoff:
+                    stale.append(c)
+                    host = (key.smtp_host, key.smtp_port)
+                    self._open_per_host[host] = max(0, self._open_per_host.get(host, 0) - 1)
+            if keep:
+                self._idle[key] = keep
+            else:
+                del self._idle[key]
+
+    def _evict_other_idle_locked(self, host: tuple[str, int], key: PoolKey, stale: list[PooledConnection]) -> bool:
+        # The host is at its cap but another account may be sitting idle on it;
+        # close that one so this account can connect
+        for other_key, idle in self._idle.items():
+            if other_key != key and (other_key.smtp_host, other_key.smtp_port) == host and idle:
+                stale.append(idle.pop(0))
+                if not idle:
+                    del self._idle[other_key]
+                return True
+        return False
+
+
+pool = SMTPConnectionPool(
+    max_per_host=settings.smtp_pool_max_per_host,
+    idle_timeout=settings.smtp_pool_idle_timeout_seconds,
+    noop_after=settings.smtp_pool_noop_after_seconds,
+    max_messages=settings.smtp_max_messages_per_connection,
+)
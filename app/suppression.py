@@ -0,0 +1,196 @@
+"""Per-user suppression list: addresses that unsubscribed, bounced or were blocked.
+
+Every process that checks addresses keeps a compact index per user: a sorted
+``array('Q')`` of 64-bit address hashes (8 bytes an entry, about 80 MB for
+ten million addresses) plus a small set of hashes added since it was built.
+A lookup is a bisect. Hash hits are confirmed against the table in one query
+per batch, so a collision or a since-removed suppression never blocks a send,
+and a million-address upload costs a handful of queries rather than one per
+address. New suppressions reach an index within SUPPRESSION_REFRESH_SECONDS;
+the whole index is rebuilt every SUPPRESSION_RELOAD_SECONDS.
+"""
+from __future__ import annotations
+
+import hashlib
+import threading
+import time
+from array import array
+from bisect import bisect_left
+from typing import Iterable, Optional
+
+from sqlalchemy import delete, insert, select
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+from .cache import TTLCache
+from .config import settings
+from .db import SessionLocal
+from .logs import get_logger
+from .models import Suppression, SuppressionReason
+
+log = get_logger(__name__)
+
+_LOAD_CHUNK = 50_000
+_CONFIRM_CHUNK = 1000
+
+
+def email_key(address: str) -> str:
+    """The form addresses are compared and stored in."""
+    return address.strip().lower()
+
+
+def email_hash(key: str) -> int:
+    return int.from_bytes(hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest(), "big")
+
+
+class SuppressionIndex:
+    """Hashes of one user's suppressed addresses; may report false positives."""
+
+    def __init__(self, user_id: int) -> None:
+        self.user_id = user_id
+        self._sorted = array("Q")
+        self._recent: set[int] = set()
+        self._max_id = 0
+        self._next_refresh = 0.0
+        self._lock = threading.Lock()
+
+    def load(self) -> SuppressionIndex:
+        hashes: list[int] = []
+        max_id = 0
+        with SessionLocal() as db:
+            rows = db.execute(
+                select(Suppression.id, Suppression.email)
+                .where(Suppression.user_id == self.user_id)
+                .execution_options(yield_per=_LOAD_CHUNK)
+            )
+            for row_id, email in rows:
+                hashes.append(email_hash(email))
+                max_id = max(max_id, row_id)
+        hashes.sort()
+        self._sorted = array("Q", hashes)
+        self._max_id = max_id
+        self._next_refresh = time.monotonic() + settings.suppression_refresh_seconds
+        log.info("suppression_index_loaded", user_id=self.user_id, entries=len(self._sorted))
+        return self
+
+    def refresh_if_due(self) -> None:
+        """Pick up suppressions added by other processes since the last look."""
+        if time.monotonic() < self._next_refresh:
+            return
+        with self._lock:
+            if time.monotonic() < self._next_refresh:
+                return
+            with SessionLocal() as db:
+                rows = db.execute(
+                    select(Suppression.id, Suppression.email).where(
+                        Suppression.user_id == self.user_id, Suppression.id > self._max_id
+                    )
+                ).all()
+            for row_id, email in rows:
+                self._recent.add(email_hash(email))
+                self._max_id = max(self._max_id, row_id)
+            self._next_refresh = time.monotonic() + settings.suppression_refresh_seconds
+
+    def add(self, key: str) -> None:
+        self._recent.add(email_hash(key))
+
+    def might_contain(self, h: int) -> bool:
+        if h in self._recent:
+            return True
+        i = bisect_left(self._sorted, h)
+        return i < len(self._sorted) and self._sorted[i] == h
+
+
+_indexes: TTLCache[SuppressionIndex] = TTLCache(ttl_seconds=settings.suppression_reload_seconds, maxsize=256)
+
+
+def get_index(user_id: int) -> SuppressionIndex:
+    index = _indexes.get_or_compute(user_id, lambda: SuppressionIndex(user_id).load())
+    index.refresh_if_due()
+    return index
+
+
+def suppressed(user_id: int, addresses: Iterable[str], db: Optional[Session] = None) -> set[str]:
+    """The keys (see ``email_key``) of ``addresses`` on the user's suppression list."""
+    index = get_index(user_id)
+    candidates = {key for key in map(email_key, addresses) if index.might_contain(email_hash(key))}
+    if not candidates:
+        return set()
+    if db is None:
+        with SessionLocal() as own:
+            return _confirm(own, user_id, candidates)
+    return _confirm(db, user_id, candidates)
+
+
+def _confirm(db: Session, user_id: int, candidates: set[str]) -> set[str]:
+    found: set[str] = set()
+    keys = sorted(candidates)
+    for i in range(0, len(keys), _CONFIRM_CHUNK):
+        found.update(
+            db.scalars(
+                select(Suppression.email).where(
+                    Suppression.user_id == user_id, Suppression.email.in_(keys[i:i + _CONFIRM_CHUNK])
+                )
+            )
+        )
+    return found
+
+
+def add_suppressions(db: Session, entries: Iterable[tuple[int, str]], reason: SuppressionReason) -> int:
+    """Insert ``(user_id, address)`` pairs, skipping ones already listed; the caller commits."""
+    rows = [
+        {"user_id": user_id, "email": key, "reason": reason.value}
+        for user_id, key in {(user_id, email_key(address)) for user_id, address in entries}
+    ]
+    if not rows:
+        return 0
+    dialect = db.get_bind().dialect.name
+    if dialect in ("postgresql", "sqlite"):
+        dml = postgresql if dialect == "postgresql" else sqlite
+        stmt = dml.insert(Suppression.__table__).on_conflict_do_nothing(index_elements=["user_id", "email"])
+        added = len(db.execute(stmt.returning(Suppression.id), rows).all())
+    else:
+        added = _insert_missing(db, rows)
+    for row in rows:
+        # this process sees its own additions without waiting for a refresh
+        index = _indexes.get(row["user_id"])
+        if index is not None:
+            index.add(row["email"])
+    return added
+
+
+def _insert_missing(db: Session, rows: list[dict]) -> int:
+    """Portable ON CONFLICT DO NOTHING: select the pairs already listed, insert the rest.
+
+    Runs in a savepoint of the caller's transaction; if a concurrent writer
+    inserts one of the same pairs in between, the savepoint is rolled back
+    and the lookup repeated.
+    """
+    by_user: dict[int, list[str]] = {}
+    for row in rows:
+        by_user.setdefault(row["user_id"], []).append(row["email"])
+    for attempt in range(3):
+        existing: set[tuple[int, str]] = set()
+        for user_id, keys in by_user.items():
+            existing.update((user_id, key) for key in _confirm(db, user_id, set(keys)))
+        missing = [row for row in rows if (row["user_id"], row["email"]) not in existing]
+        if not missing:
+            return 0
+        try:
+            with db.begin_nested():
+                db.execute(insert(Suppression.__table__), missing)
+        except IntegrityError:
+            if attempt == 2:
+                raise
+            continue
+        return len(missing)
+    return 0
+
+
+def remove_suppression(db: Session, user_id: int, address: str) -> bool:
+    """Delete one entry; indexes keep its hash until rebuilt, which the exact check makes harmless."""
+    result = db.execute(
+        delete(Suppression).where(Suppression.user_id == user_id, Suppression.email == email_key(address))
+    )
+    return result.rowcount > 0
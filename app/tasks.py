@@ -1,143 +1,303 @@
 from __future__ import annotations
 
-import math
-from datetime import datetime, timezone
-from typing import Optional
+import os
+import smtplib
+import time
+from functools import lru_cache
+from typing import Iterator, Optional
 
-from sqlalchemy import select
+from celery.signals import worker_init, worker_process_shutdown, worker_shutdown
 from sqlalchemy.orm import Session
 
 from .worker import celery
+from .cache import TTLCache
+from .config import settings
 from .db import SessionLocal
-from .models import Campaign, CampaignStatus, Recipient, RecipientStatus, SentEmail
-from .crypto import decrypt_str
-from .email_sender import send_email_smtp
+from .models import Campaign, CampaignStatus, Recipient
+from .crypto import get_smtp_credentials
+from .circuit import CircuitOpenError
+from .delivery import DeliveryResult, claim_recipients, complete_if_done, next_retry_in
+from .progress import publish_progress
+from .redis_client import get_redis
+from .result_sink import ResultSink, journaled_claims, make_sink, push_results
+from .email_sender import (
+    MessageTemplate,
+    SMTPSession,
+    is_connection_failure,
+    is_hard_bounce,
+    is_plain_address,
+    is_throttle,
+    is_transient,
+)
+from .logs import get_logger
+from .metrics import MESSAGES, QUEUE_LAG_SECONDS, serve as serve_metrics, timed
+from .scheduler import hold_dispatch, record_pacing, release_sender, request_dispatch
+from .smtp_pool import PoolExhausted, pool as smtp_pool
+from .suppression import email_key, suppressed
 
 
-def _get_delay_seconds(campaign: Campaign) -> int:
-    # round up to be safe for provider limits
-    delay = max(0, math.ceil(campaign.limit_window_seconds / max(1, campaign.limit_count)))
-    print(f"Calculated delay for campaign {campaign.id}: {delay} seconds (window: {campaign.limit_window_seconds}, count: {campaign.limit_count})")
-    return delay
+log = get_logger(__name__)
+
+# encoded once per campaign content and reused by every task in the process
+_templates: TTLCache[MessageTemplate] = TTLCache(ttl_seconds=600, maxsize=256)
+
+
+def _get_template(campaign: Campaign, from_email: str) -> MessageTemplate:
+    key = (campaign.id, from_email, campaign.from_name, campaign.subject, campaign.body)
+    return _templates.get_or_compute(
+        key, lambda: MessageTemplate(from_email, campaign.from_name, campaign.subject, campaign.body)
+    )
+
+
+class _BatchOutcome:
+    """Results and tallies of one ``send_next_email`` batch."""
+
+    def __init__(self, campaign_id: int) -> None:
+        self.campaign_id = campaign_id
+        self.results: list[DeliveryResult] = []
+        self.sent = self.failed = self.deferred = self.skipped = 0
+        self.throttled = False
+        # once set, the rest of the batch is handed back untried with this reason
+        self.stop_reason: Optional[str] = None
+        self.circuit_wait: Optional[float] = None
+
+    def skip(self, recipient: Recipient) -> None:
+        self.results.append(DeliveryResult.failed(recipient, "suppressed"))
+        self.skipped += 1
+
+    def delivered(self, recipient: Recipient, message_id: Optional[str], smtp_response: Optional[str]) -> None:
+        log.debug("email_sent", campaign_id=self.campaign_id, recipient_id=recipient.id)
+        self.results.append(DeliveryResult.sent(recipient, message_id, smtp_response))
+        self.sent += 1
+
+    def release(self, recipients: list[Recipient]) -> None:
+        for recipient in recipients:
+            self.results.append(DeliveryResult.released(recipient, self.stop_reason, after=self.circuit_wait))
+        self.deferred += len(recipients)
+
+    def circuit_open(self, recipients: list[Recipient], e: CircuitOpenError) -> None:
+        # nothing was attempted; wait for the server's next probe
+        self.circuit_wait = e.retry_after
+        self.stop_reason = str(e)
+        self.release(recipients)
+
+    def pool_exhausted(self, recipients: list[Recipient], e: PoolExhausted) -> None:
+        # nothing was attempted; other senders hold every connection to the host
+        self.stop_reason = str(e)
+        self.release(recipients)
+
+    def error(self, recipient: Recipient, e: Exception) -> None:
+        err = str(e)
+        if is_throttle(e):
+            # the provider asked us to back off; a greylisted recipient alone is not
+            # a throttle and only that recipient is deferred
+            self.throttled = True
+            self.stop_reason = "throttled before this attempt"
+        elif is_connection_failure(e):
+            # the next recipient would wait out the same timeout
+            self.stop_reason = "connection failed before this attempt"
+        if is_transient(e) and recipient.attempts + 1 < settings.send_max_attempts:
+            log.info("email_deferred", campaign_id=self.campaign_id, recipient_id=recipient.id, error=err)
+            self.results.append(DeliveryResult.deferred(recipient, err))
+            self.deferred += 1
+        else:
+            log.warning("email_failed", campaign_id=self.campaign_id, recipient_id=recipient.id, error=err)
+            self.results.append(DeliveryResult.failed(recipient, err, bounced=is_hard_bounce(e)))
+            self.failed += 1
+
+
+def _envelopes(recipients: list[Recipient], size: int) -> Iterator[list[Recipient]]:
+    """Group recipients into SMTP transactions of at most ``size``."""
+    group: list[Recipient] = []
+    for recipient in recipients:
+        if size > 1 and not is_plain_address(recipient.to_email):
+            # refused by the renderer on its own, without failing the rest of a group
+            yield [recipient]
+            continue
+        group.append(recipient)
+        if len(group) >= size:
+            yield group
+            group = []
+    if group:
+        yield group
+
+
+@worker_process_shutdown.connect
+@worker_shutdown.connect
+def _close_smtp_pool(**_: object) -> None:
+    smtp_pool.close_all()
+
+
+@lru_cache(maxsize=1)
+def _result_sink() -> ResultSink:
+    return make_sink(get_redis())
+
+
+def _flush_results() -> None:
+    # every worker flushes as well as the scheduler, so results keep reaching
+    # the database while the scheduler is down
+    try:
+        _result_sink().flush_due()
+    except Exception as e:  # noqa: BLE001
+        # the batch stays journaled and is retried by the next flush
+        log.error("result_flush_failed", error=str(e))
+
+
+@worker_process_shutdown.connect
+def _close_result_sink(**_: object) -> None:
+    if _result_sink.cache_info().currsize:
+        _result_sink().close()
+
+
+@worker_init.connect
+def _serve_metrics(**_: object) -> None:
+    serve_metrics(settings.worker_metrics_port)
+
+
+@worker_process_shutdown.connect
+def _mark_metrics_process_dead(pid: Optional[int] = None, **_: object) -> None:
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        from prometheus_client import multiprocess
+
+        multiprocess.mark_process_dead(pid or os.getpid())
 
 
 @celery.task(name="send_next_email")
-def send_next_email(campaign_id: int) -> None:
-    print(f"Starting send_next_email task for campaign {campaign_id}")
-    db: Session = SessionLocal()
+def send_next_email(
+    campaign_id: int,
+    budget: int = 1,
+    lease_token: Optional[str] = None,
+    granted_at: Optional[float] = None,
+    user_id: Optional[int] = None,
+) -> None:
+    """Send up to ``budget`` messages for a campaign.
+
+    The scheduler has already charged the campaign's rate limit for ``budget``
+    at ``granted_at`` (epoch seconds) and holds the sender lease identified by
+    ``lease_token``, counted against ``user_id``'s share of senders.
+    """
+    if granted_at is not None:
+        QUEUE_LAG_SECONDS.observe(max(0.0, time.time() - granted_at))
+    log.debug("task_started", campaign_id=campaign_id, budget=budget)
+    # the claim commits; keep its rows loaded instead of reloading each one
+    db: Session = SessionLocal(expire_on_commit=False)
     try:
         campaign: Optional[Campaign] = db.get(Campaign, campaign_id)
         if campaign is None:
-            print(f"Campaign {campaign_id} not found")
+            log.warning("campaign_not_found", campaign_id=campaign_id)
             return
-        if campaign.status not in (CampaignStatus.running, CampaignStatus.paused):
-            print(f"Campaign {campaign_id} status is {campaign.status}, not running or paused")
-            return
-        
-        if campaign.status == CampaignStatus.paused:
-            print(f"Campaign {campaign_id} is paused, stopping execution")
+        if campaign.status != CampaignStatus.running:
+            log.info("campaign_not_running", campaign_id=campaign_id, status=campaign.status.value)
             return
 
-        # next pending recipient
-        recipient: Optional[Recipient] = db.execute(
-            select(Recipient).where(
-                Recipient.campaign_id == campaign.id,
-                Recipient.status == RecipientStatus.pending,
-            ).order_by(Recipient.id.asc()).limit(1)
-        ).scalar_one_or_none()
-
-        if recipient is None:
-            # complete campaign
-            print(f"No more pending recipients for campaign {campaign_id}, marking as completed")
-            campaign.status = CampaignStatus.completed
-            db.commit()
+        # claim the next block; concurrent senders never see the same rows
+        with timed("claim"):
+            recipients = claim_recipients(
+                db, campaign.id, budget, settings.recipient_lease_seconds, journaled=journaled_claims
+            )
+
+        if not recipients:
+            if complete_if_done(db, campaign.id):
+                publish_progress(campaign_id, status=CampaignStatus.completed.value)
+            else:
+                wait = next_retry_in(db, campaign.id)
+                if wait:
+                    # only deferred recipients remain; stop the scheduler granting empty tasks
+                    hold_dispatch(campaign.id, wait)
             return
 
-        print(f"Found recipient {recipient.id} ({recipient.to_email}) for campaign {campaign_id}")
-
-        # decrypt SMTP creds
-        username = decrypt_str(campaign.smtp_username_enc)
-        password = decrypt_str(campaign.smtp_password_enc)
-
-        recipient.last_attempt_at = datetime.now(timezone.utc)
-        db.commit()
-
-        try:
-            print(f"Sending email to {recipient.to_email}")
-            message_id, smtp_response = send_email_smtp(
-                smtp_host=campaign.smtp_host,
-                smtp_port=campaign.smtp_port,
-                smtp_username=username,
-                smtp_password=password,
-                use_starttls=campaign.smtp_tls,
-                from_email=campaign.from_email or username,
-                from_name=campaign.from_name,
-                to_email=recipient.to_email,
-                subject=campaign.subject,
-                body=campaign.body,
-                use_ssl=campaign.smtp_ssl,
-            )
+        log.debug("recipients_claimed", campaign_id=campaign_id, count=len(recipients), first_id=recipients[0].id)
 
-            print(f"Email sent successfully to {recipient.to_email}")
-            recipient.status = RecipientStatus.sent
-            recipient.sent_at = datetime.now(timezone.utc)
-            recipient.last_error = None
-
-            se = SentEmail(
-                campaign_id=campaign.id,
-                recipient_id=recipient.id,
-                subject=campaign.subject,
-                message_id=message_id,
-                smtp_response=smtp_response,
-                status="sent",
-                attempts=1,
-                delivered_at=recipient.sent_at,
-                error=None,
+        # decrypt SMTP creds (cached per worker process)
+        with timed("decrypt"):
+            username, password = get_smtp_credentials(
+                campaign.id, campaign.smtp_username_enc, campaign.smtp_password_enc
             )
-            db.add(se)
-            db.commit()
-        except Exception as e:  # noqa: BLE001
-            err = str(e)
-            print(f"Failed to send email to {recipient.to_email}: {err}")
-            recipient.status = RecipientStatus.failed
-            recipient.last_error = err
-
-            se = SentEmail(
-                campaign_id=campaign.id,
-                recipient_id=recipient.id,
-                subject=campaign.subject,
-                message_id=None,
-                smtp_response=None,
-                status="failed",
-                attempts=1,
-                delivered_at=None,
-                error=err,
-            )
-            db.add(se)
-            db.commit()
-
-        # schedule next if pending remain
-        remaining = db.execute(
-            select(Recipient).where(
-                Recipient.campaign_id == campaign.id,
-                Recipient.status == RecipientStatus.pending,
-            ).limit(1)
-        ).scalar_one_or_none()
-
-        print(f"Checking for remaining recipients for campaign {campaign_id}: {'found' if remaining else 'none'}")
-        
-        if remaining is not None and campaign.status == CampaignStatus.running:
-            delay = _get_delay_seconds(campaign)
-            print(f"Scheduling next email for campaign {campaign_id} with delay {delay} seconds")
-            send_next_email.apply_async(args=[campaign.id], countdown=delay)
-        else:
-            # No remaining -> mark completed if not already
-            if campaign.status == CampaignStatus.running:
-                print(f"No more recipients for campaign {campaign_id}, marking as completed")
-                campaign.status = CampaignStatus.completed
-                db.commit()
+
+        # addresses suppressed after they were imported
+        with timed("suppress"):
+            blocked = suppressed(campaign.user_id, [r.to_email for r in recipients], db)
+
+        template = _get_template(campaign, campaign.from_email or username)
+        # identical content may go to several recipients per SMTP transaction
+        envelope = campaign.recipients_per_message if not template.fields else 1
+        out = _BatchOutcome(campaign_id)
+        to_send = []
+        for recipient in recipients:
+            if blocked and email_key(recipient.to_email) in blocked:
+                out.skip(recipient)
             else:
-                print(f"Campaign {campaign_id} status is {campaign.status}, not scheduling next")
+                to_send.append(recipient)
+        with SMTPSession(
+            smtp_host=campaign.smtp_host,
+            smtp_port=campaign.smtp_port,
+            smtp_username=username,
+            smtp_password=password,
+            use_starttls=campaign.smtp_tls,
+            use_ssl=campaign.smtp_ssl,
+            max_messages=settings.smtp_max_messages_per_connection,
+            pool=smtp_pool if settings.smtp_pool_enabled else None,
+        ) as session:
+            for group in _envelopes(to_send, envelope):
+                if out.stop_reason is not None:
+                    out.release(group)
+                    continue
+                try:
+                    if len(group) == 1:
+                        recipient = group[0]
+                        message_id, smtp_response = session.send_template(
+                            template, recipient.to_email, recipient.to_name, recipient.attributes
+                        )
+                        out.delivered(recipient, message_id, smtp_response)
+                        continue
+                    message_id, refused = session.send_shared(template, [r.to_email for r in group])
+                except CircuitOpenError as e:
+                    out.circuit_open(group, e)
+                    continue
+                except PoolExhausted as e:
+                    out.pool_exhausted(group, e)
+                    continue
+                except Exception as e:  # noqa: BLE001
+                    for recipient in group:
+                        out.error(recipient, e)
+                    continue
+                for recipient in group:
+                    reply = refused.get(recipient.to_email)
+                    if reply is None:
+                        out.delivered(recipient, message_id, "250 OK")
+                    else:
+                        out.error(recipient, smtplib.SMTPRecipientsRefused({recipient.to_email: reply}))
+            retried = session.retries
+
+        # written to the database in bulk by the result flush, which also
+        # marks the campaign completed after its last result
+        with timed("journal"):
+            push_results(out.results)
+        _flush_results()
+        if out.circuit_wait is not None:
+            # give worker capacity to healthy campaigns until the server is probed again
+            hold_dispatch(campaign.id, out.circuit_wait)
+        elif out.sent or out.failed or out.deferred:
+            record_pacing(campaign.smtp_host, campaign.smtp_port, username, out.throttled)
+        host = campaign.smtp_host
+        MESSAGES.labels(host, "sent").inc(out.sent)
+        MESSAGES.labels(host, "failed").inc(out.failed)
+        if out.deferred:
+            MESSAGES.labels(host, "deferred").inc(out.deferred)
+        if out.skipped:
+            MESSAGES.labels(host, "suppressed").inc(out.skipped)
+        if retried:
+            MESSAGES.labels(host, "retried").inc(retried)
     finally:
-        print(f"Completed send_next_email task for campaign {campaign_id}")
+        log.debug("task_finished", campaign_id=campaign_id)
         db.close()
+        if lease_token is not None:
+            release_sender(campaign_id, lease_token, user_id)
+
+
+def dispatch_campaign(campaign_id: int) -> None:
+    """Hand a running campaign to the configured send engine."""
+    if settings.send_engine == "async":
+        # the async engine picks up running campaigns on its next poll
+        return
+    request_dispatch(campaign_id)
@@ -0,0 +1,112 @@
+"""Merge fields for campaign subjects and bodies.
+
+``{{ to_name }}``, ``{{ first_name }}``, ``{{ to_email }}`` and
+``{{ attributes.<key> }}`` are replaced per recipient. A fallback after a
+pipe is used when the value is empty: ``Hi {{ first_name | there }}``.
+Templates are parsed once into a tuple of literal strings and field
+lookups, so rendering is a single ``str.join``.
+"""
+from __future__ import annotations
+
+import re
+from typing import Any, Mapping, Optional
+
+FIELDS = ("to_email", "to_name", "first_name")
+_ATTRIBUTE_PREFIX = "attributes."
+
+_PLACEHOLDER = re.compile(r"\{\{(.*?)\}\}", re.DOTALL)
+_NAME = re.compile(r"[A-Za-z_][A-Za-z0-9_]*\Z")
+
+
+class TemplateError(ValueError):
+    pass
+
+
+class CompiledTemplate:
+    """A template split into literals and ``(field, fallback)`` lookups.
+
+    ``parts`` alternates literal, lookup, literal, ... and always starts and
+    ends with a literal, so rendering never has to check types.
+    """
+
+    __slots__ = ("source", "parts", "fields", "is_static")
+
+    def __init__(self, source: str, parts: tuple, fields: frozenset[str]) -> None:
+        self.source = source
+        self.parts = parts
+        self.fields = fields
+        self.is_static = not fields
+
+    def render(self, values: Mapping[str, str]) -> str:
+        if self.is_static:
+            return self.source
+        parts = self.parts
+        out = [parts[0]]
+        for i in range(1, len(parts), 2):
+            field, fallback = parts[i]
+            out.append(values.get(field) or fallback)
+            out.append(parts[i + 1])
+        return "".join(out)
+
+
+def _parse_placeholder(expr: str, offset: int) -> tuple[str, str]:
+    name, sep, fallback = expr.partition("|")
+    name = name.strip()
+    if name.startswith(_ATTRIBUTE_PREFIX):
+        if not _NAME.match(name[len(_ATTRIBUTE_PREFIX):]):
+            raise TemplateError(f"Invalid attribute name {name!r} at position {offset}")
+    elif name not in FIELDS:
+        allowed = ", ".join(FIELDS)
+        raise TemplateError(f"Unknown merge field {name!r} at position {offset}; use {allowed} or attributes.<key>")
+    return name, fallback.strip() if sep else ""
+
+
+def compile_template(source: str) -> CompiledTemplate:
+    """Parse ``source``; raises ``TemplateError`` on unknown or malformed fields."""
+    parts: list[Any] = []
+    fields: set[str] = set()
+    pos = 0
+    for m in _PLACEHOLDER.finditer(source):
+        literal = source[pos:m.start()]
+        if "}}" in literal:
+            raise TemplateError(f"Unmatched '}}}}' at position {pos + literal.index('}}')}")
+        parts.append(literal)
+        field = _parse_placeholder(m.group(1), m.start())
+        parts.append(field)
+        fields.add(field[0])
+        pos = m.end()
+    tail = source[pos:]
+    if "{{" in tail or "}}" in tail:
+        raise TemplateError(f"Unmatched braces at position {pos + max(tail.find('{{'), tail.find('}}'))}")
+    parts.append(tail)
+    return CompiledTemplate(source, tuple(parts), frozenset(fields))
+
+
+def compile_lenient(source: str) -> CompiledTemplate:
+    """Like ``compile_template`` but falls back to sending ``source`` verbatim.
+
+    Campaigns created before merge fields existed were never validated and may
+    contain literal braces.
+    """
+    try:
+        return compile_template(source)
+    except TemplateError:
+        return CompiledTemplate(source, (source,), frozenset())
+
+
+def recipient_values(
+    to_email: str,
+    to_name: Optional[str],
+    attributes: Optional[Mapping[str, Any]],
+    fields: frozenset[str],
+) -> dict[str, str]:
+    """The values a template with ``fields`` needs for one recipient."""
+    values = {"to_email": to_email, "to_name": to_name or ""}
+    if "first_name" in fields:
+        values["first_name"] = to_name.split(None, 1)[0] if to_name and to_name.strip() else ""
+    if attributes:
+        for field in fields:
+            if field.startswith(_ATTRIBUTE_PREFIX):
+                value = attributes.get(field[len(_ATTRIBUTE_PREFIX):])
+                values[field] = "" if value is None else str(value)
+    return values
@@ -1,6 +1,9 @@
 from celery import Celery
+from kombu import Queue
 
 from .config import settings
+from .logs import configure_logging
+from .routing import LEGACY_QUEUE, shard_queues
 
 
 def _build_celery() -> Celery:
@@ -17,13 +20,19 @@ def _build_celery() -> Celery:
     celery_app.conf.update(
         task_acks_late=True,
         worker_prefetch_multiplier=1,
+        # the scheduler's fair-share cap assumes this many slots per worker
+        worker_concurrency=settings.worker_concurrency,
         task_serializer="json",
         accept_content=["json"],
         result_serializer="json",
         timezone="UTC",
         enable_utc=True,
+        # a worker without -Q consumes every shard; the scheduler names the queue per task
+        task_queues=[Queue(name) for name in [*shard_queues(), LEGACY_QUEUE]],
+        task_default_queue=shard_queues()[0],
     )
     return celery_app
 
 
+configure_logging()
 celery = _build_celery()
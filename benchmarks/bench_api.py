@@ -0,0 +1,90 @@
+"""Requests per second for the campaign create and status endpoints.
+
+    DATABASE_URL=postgresql://... python -m benchmarks.bench_api [--concurrency 64] [--seconds 5]
+
+The app runs in-process behind httpx's ASGI transport, so the numbers cover
+routing, validation and database work but not HTTP parsing. Without
+DATABASE_URL a throwaway SQLite file is used. The status cache is disabled
+unless STATUS_CACHE_TTL_SECONDS is set, so every status request reaches the
+database.
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+
+if "DATABASE_URL" not in os.environ:
+    os.environ["DATABASE_URL"] = "sqlite:///" + os.path.join(tempfile.mkdtemp(), "bench_api.db")
+os.environ.setdefault("REDIS_URL", "redis://localhost:6379/0")
+os.environ.setdefault("ENCRYPTION_KEY", "TEtIFUS5Q36JjNjR4b4iYe8S0Mh4H4-ZDVWY6_1OC5o=")
+os.environ.setdefault("STATUS_CACHE_TTL_SECONDS", "0")
+
+import httpx  # noqa: E402
+
+from app.db import Base, engine  # noqa: E402
+from app.main import app  # noqa: E402
+
+SMTP = {"smtp_host": "127.0.0.1", "smtp_port": 2525, "smtp_username": "u", "smtp_password": "p", "smtp_tls": False}
+
+
+def _campaign(recipients: int) -> dict:
+    return {
+        "name": "bench",
+        "subject": "Hello {{ first_name | there }}",
+        "body": "Body",
+        "smtp": SMTP,
+        "recipients": [{"to_email": f"user{i}@example.org", "to_name": f"User {i}"} for i in range(recipients)],
+    }
+
+
+async def _hammer(client: httpx.AsyncClient, request, concurrency: int, seconds: float) -> tuple[float, int]:
+    done = 0
+    errors = 0
+    deadline = time.perf_counter() + seconds
+
+    async def worker() -> None:
+        nonlocal done, errors
+        while time.perf_counter() < deadline:
+            r = await request(client)
+            if r.status_code == 200:
+                done += 1
+            else:
+                errors += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return done / (time.perf_counter() - started), errors
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--seconds", type=float, default=5.0)
+    parser.add_argument("--recipients", type=int, default=10, help="recipients per created campaign")
+    args = parser.parse_args()
+
+    Base.metadata.create_all(engine)
+    transport = httpx.ASGITransport(app=app, raise_app_exceptions=False)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        r = await client.post("/campaigns/", json=_campaign(1000))
+        r.raise_for_status()
+        campaign_id = r.json()["id"]
+
+        payload = _campaign(args.recipients)
+        create_rps, create_errors = await _hammer(
+            client, lambda c: c.post("/campaigns/", json=payload), args.concurrency, args.seconds
+        )
+        status_rps, status_errors = await _hammer(
+            client, lambda c: c.get(f"/campaigns/{campaign_id}/status"), args.concurrency, args.seconds
+        )
+
+    print(f"concurrency {args.concurrency}, {args.seconds:.0f}s per endpoint, {engine.dialect.name}")
+    print(f"POST /campaigns/            : {create_rps:8.1f} req/s ({create_errors} errors)")
+    print(f"GET  /campaigns/{{id}}/status : {status_rps:8.1f} req/s ({status_errors} errors)")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,55 @@
+"""Microbenchmark: per-recipient MIME build vs. a pre-rendered MessageTemplate.
+
+    python -m benchmarks.bench_message_template [--body-kb 8] [--number 20000]
+
+Runs without a database, broker or SMTP server.
+"""
+from __future__ import annotations
+
+import argparse
+import os
+import timeit
+from email.mime.text import MIMEText
+from email.utils import formataddr
+
+# app.email_sender does not read settings, but keep imports safe in a bare checkout
+os.environ.setdefault("DATABASE_URL", "sqlite://")
+os.environ.setdefault("REDIS_URL", "redis://localhost:6379/0")
+os.environ.setdefault("ENCRYPTION_KEY", "")
+
+from app.email_sender import MessageTemplate  # noqa: E402
+
+
+def legacy_build(from_email: str, from_name: str, to_email: str, subject: str, body: str) -> bytes:
+    # the per-message path send_email_smtp used before templates
+    msg = MIMEText(body, _charset="utf-8")
+    msg["From"] = formataddr((from_name or "", from_email))
+    msg["To"] = to_email
+    msg["Subject"] = subject
+    return msg.as_string().encode("ascii")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--body-kb", type=int, default=8)
+    parser.add_argument("--number", type=int, default=20000)
+    args = parser.parse_args()
+
+    body = ("Здравствуйте! Monthly newsletter line with some text.\n" * (args.body_kb * 1024 // 56 + 1))
+    subject = "Our October newsletter — news and updates"
+    template = MessageTemplate("news@example.com", "Example News", subject, body)
+
+    legacy = timeit.timeit(
+        lambda: legacy_build("news@example.com", "Example News", "user@example.org", subject, body),
+        number=args.number,
+    )
+    rendered = timeit.timeit(lambda: template.render("user@example.org"), number=args.number)
+
+    print(f"body {args.body_kb} KiB, {args.number} messages")
+    print(f"MIMEText per message : {legacy / args.number * 1e6:8.2f} us/msg")
+    print(f"MessageTemplate      : {rendered / args.number * 1e6:8.2f} us/msg")
+    print(f"speedup              : {legacy / rendered:8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
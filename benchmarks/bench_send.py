@@ -0,0 +1,343 @@
+"""End-to-end throughput of the Celery send path against a local SMTP sink.
+
+    python -m benchmarks.bench_send [--sizes 1000,10000,100000] [--mode eager|worker]
+        [--batch-size 50] [--recipients-per-message 1] [--latency-ms 0] [--tls none|starttls|ssl]
+        [--fail-4xx 0.0] [--fail-5xx 0.0] [--retry-backoff 0.01] [--max-attempts 5]
+        [--output bench_send.json] [--compare old.json]
+
+Each run seeds a running campaign of ``size`` recipients pointed at
+``benchmarks.fake_smtp``, then drives the real scheduler loop until the
+write-behind flush marks the campaign completed. ``--mode eager`` runs
+``send_next_email`` inline (task_always_eager); ``--mode worker`` starts an
+in-process Celery worker on the REDIS_URL broker. Redis is required either
+way: the scheduler's grants, the result journal and progress events live
+there. Without DATABASE_URL a throwaway SQLite file is used; on PostgreSQL
+the tables are created if missing and nothing is dropped.
+
+Reported per run: messages per second (claim to completed campaign), p50/p99
+of claim-to-acceptance latency per message, database statements per message
+and SMTP connections opened per message. Results are written as JSON so two
+runs can be compared with ``--compare``.
+
+Deferred recipients are retried after ``--retry-backoff`` seconds (doubling
+per attempt) instead of the production RETRY_BACKOFF_SECONDS, so runs with
+``--fail-4xx`` finish in benchmark time rather than hours.
+"""
+from __future__ import annotations
+
+import argparse
+import contextlib
+import json
+import os
+import platform
+import subprocess
+import tempfile
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Iterator, Optional
+
+if "DATABASE_URL" not in os.environ:
+    os.environ["DATABASE_URL"] = "sqlite:///" + os.path.join(tempfile.mkdtemp(), "bench_send.db")
+# a database of its own so benchmark keys never mix with real ones
+os.environ.setdefault("REDIS_URL", "redis://localhost:6379/15")
+os.environ.setdefault("ENCRYPTION_KEY", "TEtIFUS5Q36JjNjR4b4iYe8S0Mh4H4-ZDVWY6_1OC5o=")
+os.environ.setdefault("WORKER_METRICS_PORT", "0")
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+
+from sqlalchemy import event, func, insert, select  # noqa: E402
+
+from app.config import settings  # noqa: E402
+from app.crypto import encrypt_str  # noqa: E402
+from app.db import Base, SessionLocal, engine  # noqa: E402
+from app.email_sender import get_ssl_context  # noqa: E402
+from app.models import Campaign, CampaignStatus, Recipient, RecipientStatus, User  # noqa: E402
+from app.redis_client import get_redis  # noqa: E402
+from app.result_sink import make_sink  # noqa: E402
+from app.scheduler import Scheduler, campaign_rate_key, lease_key, request_dispatch  # noqa: E402
+from app.smtp_pool import pool as smtp_pool  # noqa: E402
+from app.tasks import celery  # noqa: E402
+
+from benchmarks.fake_smtp import FakeSMTPServer  # noqa: E402
+
+SEED_BATCH = 10_000
+# no rate limit worth the name: the benchmark measures the send path, not pacing
+UNLIMITED_COUNT = 1_000_000_000
+
+
+class QueryCounter:
+    """Counts statements sent to the sync engine, except the harness's own."""
+
+    def __init__(self) -> None:
+        self.count = 0
+        self._local = threading.local()
+        event.listen(engine, "before_cursor_execute", self._on_execute)
+
+    def _on_execute(self, *_: object) -> None:
+        if not getattr(self._local, "paused", False):
+            self.count += 1
+
+    @contextlib.contextmanager
+    def paused(self) -> Iterator[None]:
+        self._local.paused = True
+        try:
+            yield
+        finally:
+            self._local.paused = False
+
+
+def _seed(size: int, sink: FakeSMTPServer, recipients_per_message: int = 1) -> int:
+    # shared copies need content without merge fields
+    shared = recipients_per_message > 1
+    with SessionLocal() as db:
+        user = db.execute(select(User).where(User.email == "bench@example.com")).scalar_one_or_none()
+        if user is None:
+            user = User(email="bench@example.com", name="Bench", is_active=True)
+            db.add(user)
+            db.flush()
+        campaign = Campaign(
+            name=f"bench-{size}",
+            user_id=user.id,
+            smtp_host=sink.host,
+            smtp_port=sink.port,
+            smtp_username_enc=encrypt_str("bench"),
+            smtp_password_enc=encrypt_str("bench"),
+            smtp_tls=sink.tls == "starttls",
+            smtp_ssl=sink.tls == "ssl",
+            from_email="news@example.com",
+            from_name="Bench",
+            subject="Hello there" if shared else "Hello {{ first_name | there }}",
+            body=("Hi," if shared else "Hi {{ to_name | friend }},") + "\n\n" + "A line of newsletter text.\n" * 40,
+            limit_count=UNLIMITED_COUNT,
+            limit_window_seconds=1,
+            recipients_per_message=recipients_per_message,
+            status=CampaignStatus.draft,
+        )
+        db.add(campaign)
+        db.commit()
+        campaign_id = campaign.id
+
+    for start in range(0, size, SEED_BATCH):
+        with engine.begin() as conn:
+            conn.execute(
+                insert(Recipient.__table__),
+                [
+                    {
+                        "campaign_id": campaign_id,
+                        "to_email": f"user{i}@example.org",
+                        "to_name": f"User {i}",
+                        "status": RecipientStatus.pending.name,
+                    }
+                    for i in range(start, min(size, start + SEED_BATCH))
+                ],
+            )
+    return campaign_id
+
+
+def _campaign_status(campaign_id: int) -> CampaignStatus:
+    with SessionLocal() as db:
+        return db.execute(select(Campaign.status).where(Campaign.id == campaign_id)).scalar_one()
+
+
+def _outcomes(campaign_id: int) -> tuple[dict, list[float]]:
+    with SessionLocal() as db:
+        counts = dict(
+            db.execute(
+                select(Recipient.status, func.count())
+                .where(Recipient.campaign_id == campaign_id)
+                .group_by(Recipient.status)
+            ).all()
+        )
+        latencies = [
+            (sent_at - claimed_at).total_seconds()
+            for claimed_at, sent_at in db.execute(
+                select(Recipient.last_attempt_at, Recipient.sent_at)
+                .where(Recipient.campaign_id == campaign_id, Recipient.status == RecipientStatus.sent)
+                .execution_options(yield_per=SEED_BATCH)
+            )
+        ]
+    return counts, latencies
+
+
+def _percentile(ordered: list[float], q: float) -> Optional[float]:
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def run_one(size: int, args: argparse.Namespace, sink: FakeSMTPServer, queries: QueryCounter) -> dict:
+    with queries.paused():
+        campaign_id = _seed(size, sink, args.recipients_per_message)
+        get_redis().delete(lease_key(campaign_id), campaign_rate_key(campaign_id))
+        with SessionLocal() as db:
+            db.get(Campaign, campaign_id).status = CampaignStatus.running
+            db.commit()
+
+    smtp_pool.close_all()
+    sink.stats.reset()
+    queries.count = 0
+    scheduler = Scheduler(
+        get_redis(),
+        tick_seconds=settings.scheduler_tick_seconds,
+        refresh_seconds=settings.scheduler_refresh_seconds,
+        sink=make_sink(get_redis()),
+    )
+    request_dispatch(campaign_id)
+
+    started = time.perf_counter()
+    deadline = started + args.timeout
+    next_check = 0.0
+    try:
+        while True:
+            dispatched = scheduler.run_once()
+            now = time.perf_counter()
+            if now >= next_check:
+                with queries.paused():
+                    if _campaign_status(campaign_id) == CampaignStatus.completed:
+                        break
+                next_check = now + 0.05
+            if now > deadline:
+                raise TimeoutError(f"campaign of {size} did not complete in {args.timeout:.0f}s")
+            if args.mode == "worker" or not dispatched:
+                time.sleep(settings.scheduler_tick_seconds)
+    finally:
+        scheduler.sink.close()
+    elapsed = time.perf_counter() - started
+    statements = queries.count
+
+    with queries.paused():
+        counts, latencies = _outcomes(campaign_id)
+    latencies.sort()
+    p50 = _percentile(latencies, 0.50)
+    p99 = _percentile(latencies, 0.99)
+    return {
+        "size": size,
+        "seconds": round(elapsed, 3),
+        "messages_per_second": round(size / elapsed, 1),
+        "latency_p50_ms": round(p50 * 1000, 3) if p50 is not None else None,
+        "latency_p99_ms": round(p99 * 1000, 3) if p99 is not None else None,
+        "queries_per_message": round(statements / size, 3),
+        "handshakes_per_message": round(sink.stats.connections / size, 4),
+        "sent": counts.get(RecipientStatus.sent, 0),
+        "failed": counts.get(RecipientStatus.failed, 0),
+        "rejected_4xx": sink.stats.rejected_4xx,
+        "rejected_5xx": sink.stats.rejected_5xx,
+    }
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _print_results(results: list[dict], baseline: Optional[dict]) -> None:
+    before = {r["size"]: r for r in baseline["results"]} if baseline else {}
+    print(f"{'size':>9} {'msg/s':>10} {'p50 ms':>9} {'p99 ms':>9} {'q/msg':>7} {'conn/msg':>9} {'failed':>7}")
+    for r in results:
+        line = (
+            f"{r['size']:>9} {r['messages_per_second']:>10.1f} {r['latency_p50_ms'] or 0:>9.2f}"
+            f" {r['latency_p99_ms'] or 0:>9.2f} {r['queries_per_message']:>7.2f}"
+            f" {r['handshakes_per_message']:>9.4f} {r['failed']:>7}"
+        )
+        old = before.get(r["size"])
+        if old and old["messages_per_second"]:
+            line += f"   {r['messages_per_second'] / old['messages_per_second']:.2f}x vs baseline"
+        print(line)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", default="1000,10000", help="comma-separated campaign sizes, up to 1000000")
+    parser.add_argument("--mode", choices=("eager", "worker"), default="eager")
+    parser.add_argument("--concurrency", type=int, default=4, help="worker threads in --mode worker")
+    parser.add_argument("--senders", type=int, default=settings.scheduler_senders_per_campaign,
+                        help="concurrent send_next_email tasks per campaign")
+    parser.add_argument("--batch-size", type=int, default=settings.send_batch_size)
+    parser.add_argument("--recipients-per-message", type=int, default=1,
+                        help="recipients per SMTP transaction; above 1 the content has no merge fields")
+    parser.add_argument("--no-pool", action="store_true", help="disable the worker SMTP connection pool")
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="sink delay before accepting DATA")
+    parser.add_argument("--tls", choices=("none", "starttls", "ssl"), default="none")
+    parser.add_argument("--fail-4xx", type=float, default=0.0, help="share of recipients rejected with 451")
+    parser.add_argument("--fail-5xx", type=float, default=0.0, help="share of recipients rejected with 550")
+    parser.add_argument("--retry-backoff", type=float, default=0.01,
+                        help="seconds before the first retry of a deferred recipient, doubling per attempt")
+    parser.add_argument("--max-attempts", type=int, default=settings.send_max_attempts,
+                        help="attempts before a deferred recipient is failed")
+    parser.add_argument("--timeout", type=float, default=3600.0, help="seconds allowed per campaign")
+    parser.add_argument("--output", default="bench_send.json")
+    parser.add_argument("--compare", help="a previous --output file to compare messages/s against")
+    args = parser.parse_args()
+
+    settings.send_batch_size = max(1, args.batch_size)
+    settings.scheduler_senders_per_campaign = max(1, args.senders)
+    settings.smtp_pool_enabled = not args.no_pool
+    settings.retry_backoff_seconds = max(0.0, args.retry_backoff)
+    settings.send_max_attempts = max(1, args.max_attempts)
+    celery.conf.task_always_eager = args.mode == "eager"
+    celery.conf.task_eager_propagates = True
+    Base.metadata.create_all(engine)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+
+    sink = FakeSMTPServer(
+        latency=args.latency_ms / 1000.0, tls=args.tls, fail_4xx=args.fail_4xx, fail_5xx=args.fail_5xx, seed=1
+    )
+    queries = QueryCounter()
+    results: list[dict] = []
+    with contextlib.ExitStack() as stack:
+        stack.enter_context(sink)
+        if sink.cert_path is not None:
+            # trust the sink's self-signed certificate in this process's shared context
+            get_ssl_context().load_verify_locations(sink.cert_path)
+        if args.mode == "worker":
+            from celery.contrib.testing.worker import start_worker
+
+            stack.enter_context(
+                start_worker(celery, pool="threads", concurrency=args.concurrency, perform_ping_check=False)
+            )
+        for size in (int(s) for s in args.sizes.split(",") if s.strip()):
+            results.append(run_one(size, args, sink, queries))
+        smtp_pool.close_all()
+
+    report = {
+        "meta": {
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "git_commit": _git_commit(),
+            "python": platform.python_version(),
+            "database": engine.dialect.name,
+            "mode": args.mode,
+            "concurrency": args.concurrency if args.mode == "worker" else 1,
+            "senders_per_campaign": settings.scheduler_senders_per_campaign,
+            "batch_size": settings.send_batch_size,
+            "recipients_per_message": args.recipients_per_message,
+            "smtp_pool": settings.smtp_pool_enabled,
+            "latency_ms": args.latency_ms,
+            "tls": args.tls,
+            "fail_4xx": args.fail_4xx,
+            "fail_5xx": args.fail_5xx,
+            "retry_backoff_seconds": settings.retry_backoff_seconds,
+            "max_attempts": settings.send_max_attempts,
+        },
+        "results": results,
+    }
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+
+    meta = report["meta"]
+    print(
+        f"{meta['mode']} on {meta['database']}, batch {meta['batch_size']}, tls {meta['tls']},"
+        f" sink latency {args.latency_ms:g} ms -> {args.output}"
+    )
+    _print_results(results, baseline)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,171 @@
+"""In-process SMTP sink for benchmarks.
+
+Accepts every message after an optional delay. It can speak STARTTLS or
+implicit TLS with a throwaway self-signed certificate, require AUTH, and
+reject a share of recipients with 4xx or 5xx replies. Counts connections,
+messages and rejections. Needs aiosmtpd, from requirements-dev.txt
+(``make bench`` installs it).
+"""
+from __future__ import annotations
+
+import asyncio
+import datetime
+import ipaddress
+import os
+import random
+import socket
+import ssl
+import tempfile
+from dataclasses import dataclass
+from typing import Optional
+
+from aiosmtpd.controller import Controller
+from aiosmtpd.smtp import SMTP, AuthResult
+
+
+@dataclass
+class SinkStats:
+    connections: int = 0
+    messages: int = 0
+    rejected_4xx: int = 0
+    rejected_5xx: int = 0
+
+    def reset(self) -> None:
+        self.connections = self.messages = self.rejected_4xx = self.rejected_5xx = 0
+
+
+def make_self_signed_cert(directory: str) -> tuple[str, str]:
+    """Write a localhost/127.0.0.1 certificate and key; returns their paths."""
+    from cryptography import x509
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import ec
+    from cryptography.x509.oid import NameOID
+
+    key = ec.generate_private_key(ec.SECP256R1())
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "localhost")])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    cert = (
+        x509.CertificateBuilder()
+        .subject_name(name)
+        .issuer_name(name)
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now - datetime.timedelta(minutes=5))
+        .not_valid_after(now + datetime.timedelta(days=1))
+        .add_extension(
+            x509.SubjectAlternativeName(
+                [x509.DNSName("localhost"), x509.IPAddress(ipaddress.ip_address("127.0.0.1"))]
+            ),
+            critical=False,
+        )
+        .add_extension(x509.BasicConstraints(ca=True, path_length=None), critical=True)
+        .sign(key, hashes.SHA256())
+    )
+    cert_path = os.path.join(directory, "sink-cert.pem")
+    key_path = os.path.join(directory, "sink-key.pem")
+    with open(cert_path, "wb") as f:
+        f.write(cert.public_bytes(serialization.Encoding.PEM))
+    with open(key_path, "wb") as f:
+        f.write(
+            key.private_bytes(
+                serialization.Encoding.PEM,
+                serialization.PrivateFormat.PKCS8,
+                serialization.NoEncryption(),
+            )
+        )
+    return cert_path, key_path
+
+
+class _Handler:
+    def __init__(self, sink: FakeSMTPServer) -> None:
+        self.sink = sink
+
+    async def handle_RCPT(self, server, session, envelope, address, rcpt_options):  # noqa: ANN001
+        roll = self.sink.random.random()
+        if roll < self.sink.fail_5xx:
+            self.sink.stats.rejected_5xx += 1
+            return "550 5.1.1 Mailbox unavailable"
+        if roll < self.sink.fail_5xx + self.sink.fail_4xx:
+            self.sink.stats.rejected_4xx += 1
+            return "451 4.3.0 Try again later"
+        envelope.rcpt_tos.append(address)
+        return "250 OK"
+
+    async def handle_DATA(self, server, session, envelope):  # noqa: ANN001
+        if self.sink.latency:
+            await asyncio.sleep(self.sink.latency)
+        self.sink.stats.messages += len(envelope.rcpt_tos)
+        return "250 2.0.0 Queued"
+
+
+class _Controller(Controller):
+    def __init__(self, sink: FakeSMTPServer, **kwargs) -> None:  # noqa: ANN003
+        self.sink = sink
+        super().__init__(_Handler(sink), **kwargs)
+
+    def factory(self) -> SMTP:
+        # aiosmtpd builds one SMTP instance per client connection
+        self.sink.stats.connections += 1
+        return super().factory()
+
+
+class FakeSMTPServer:
+    """A local SMTP server on 127.0.0.1; ``tls`` is "none", "starttls" or "ssl"."""
+
+    def __init__(
+        self,
+        latency: float = 0.0,
+        tls: str = "none",
+        auth: bool = True,
+        fail_4xx: float = 0.0,
+        fail_5xx: float = 0.0,
+        seed: Optional[int] = None,
+    ) -> None:
+        self.latency = latency
+        self.tls = tls
+        self.auth = auth
+        self.fail_4xx = fail_4xx
+        self.fail_5xx = fail_5xx
+        self.random = random.Random(seed)
+        self.stats = SinkStats()
+        self.host = "127.0.0.1"
+        self.port = _free_port()
+        self.cert_path: Optional[str] = None
+        self._controller: Optional[_Controller] = None
+
+    def start(self) -> None:
+        # implicit TLS is encrypted from the first byte; only STARTTLS has a plaintext phase
+        kwargs: dict = {"hostname": self.host, "port": self.port, "auth_require_tls": self.tls == "starttls"}
+        if self.auth:
+            kwargs["authenticator"] = lambda *_: AuthResult(success=True)
+        if self.tls != "none":
+            self.cert_path, key_path = make_self_signed_cert(tempfile.mkdtemp(prefix="fake-smtp-"))
+            context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+            context.load_cert_chain(self.cert_path, key_path)
+            if self.tls == "ssl":
+                kwargs["ssl_context"] = context
+                kwargs["server_hostname"] = "localhost"
+            else:
+                kwargs["tls_context"] = context
+        self._controller = _Controller(self, **kwargs)
+        self._controller.start()
+        # the controller's readiness probe is not a client connection
+        self.stats.reset()
+
+    def __enter__(self) -> FakeSMTPServer:
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info: object) -> None:
+        self.stop()
+
+    def stop(self) -> None:
+        if self._controller is not None:
+            self._controller.stop()
+            self._controller = None
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
@@ -0,0 +1,89 @@
+"""Fixtures for tests against SQLite and an in-memory Redis (fakeredis with Lua)."""
+from __future__ import annotations
+
+import os
+import tempfile
+
+from cryptography.fernet import Fernet
+
+# settings are read at import time; point them at throwaway stores first
+_DB_PATH = os.path.join(tempfile.mkdtemp(prefix="email-agent-tests-"), "test.db")
+os.environ["DATABASE_URL"] = f"sqlite:///{_DB_PATH}"
+os.environ["REDIS_URL"] = "redis://localhost:6379/15"
+os.environ["ENCRYPTION_KEY"] = Fernet.generate_key().decode()
+
+import fakeredis  # noqa: E402
+import pytest  # noqa: E402
+import redis  # noqa: E402
+import redis.asyncio  # noqa: E402
+
+from app import circuit, redis_client, scheduler, tasks  # noqa: E402
+from app.db import Base, SessionLocal, engine  # noqa: E402
+from app.models import Campaign, CampaignStatus, Recipient, RecipientStatus, User  # noqa: E402
+
+
+@pytest.fixture
+def db():
+    Base.metadata.create_all(engine)
+    session = SessionLocal(expire_on_commit=False)
+    try:
+        yield session
+    finally:
+        session.close()
+        Base.metadata.drop_all(engine)
+
+
+@pytest.fixture
+def fake_redis(monkeypatch):
+    server = fakeredis.FakeServer()
+    client = fakeredis.FakeRedis(server=server)
+    monkeypatch.setattr(redis.Redis, "from_url", classmethod(lambda cls, *a, **kw: client))
+    # the async client sees the same data
+    monkeypatch.setattr(
+        redis.asyncio.Redis, "from_url", classmethod(lambda cls, *a, **kw: fakeredis.FakeAsyncRedis(server=server))
+    )
+    # everything memoized around the previous test's client
+    cached = (
+        circuit._scripts,
+        circuit._scripts_async,
+        redis_client.get_redis,
+        redis_client.get_async_redis,
+        scheduler._pacing_script,
+        scheduler._pacing_script_async,
+        tasks._result_sink,
+    )
+    for fn in cached:
+        fn.cache_clear()
+    yield client
+    for fn in cached:
+        fn.cache_clear()
+
+
+@pytest.fixture
+def campaign(db):
+    """A running campaign with three pending recipients."""
+    user = User(email="owner@example.com", name="Owner")
+    db.add(user)
+    db.flush()
+    c = Campaign(
+        name="test",
+        user_id=user.id,
+        smtp_host="smtp.example.com",
+        smtp_port=587,
+        smtp_username_enc="u",
+        smtp_password_enc="p",
+        smtp_tls=True,
+        smtp_ssl=False,
+        subject="Hi",
+        body="Hello",
+        limit_count=10,
+        limit_window_seconds=60,
+        status=CampaignStatus.running,
+    )
+    db.add(c)
+    db.flush()
+    db.add_all(
+        Recipient(campaign_id=c.id, to_email=f"r{i}@example.com", status=RecipientStatus.pending) for i in range(3)
+    )
+    db.commit()
+    return c
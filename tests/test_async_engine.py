@@ -0,0 +1,149 @@
+from __future__ import annotations
+
+import asyncio
+
+import pytest
+from sqlalchemy import select
+
+from app import async_engine, scheduler
+from app.config import settings
+from app.models import Campaign, CampaignStatus, Recipient, RecipientStatus
+from app.result_sink import make_sink
+
+
+@pytest.fixture
+def sent(monkeypatch):
+    """SMTP transactions the engine made, as lists of envelope recipients."""
+    transactions: list[list[str]] = []
+
+    class FakeSession:
+        def __init__(self, **_: object) -> None:
+            self.retries = 0
+
+        async def send_template(self, template, to_email, to_name=None, attributes=None):
+            transactions.append([to_email])
+            return "<id@example.com>", "250 OK"
+
+        async def send_shared(self, template, to_emails):
+            transactions.append(list(to_emails))
+            return "<id@example.com>", {}
+
+        async def close(self) -> None:
+            pass
+
+    monkeypatch.setattr(async_engine, "AsyncSMTPSession", FakeSession)
+    monkeypatch.setattr(async_engine, "get_smtp_credentials", lambda *_: ("user", "secret"))
+    return transactions
+
+
+def _engine(fake_redis, poll_interval=0.05):
+    return async_engine.AsyncEngine(
+        max_connections=10, connections_per_campaign=2, poll_interval=poll_interval, sink=make_sink(fake_redis)
+    )
+
+
+def _fast(db, campaign, recipients=0, per_message=1):
+    """Ten sends a second, with ``recipients`` more pending."""
+    campaign.limit_count, campaign.limit_window_seconds = 600, 60
+    campaign.recipients_per_message = per_message
+    db.add_all(
+        Recipient(campaign_id=campaign.id, to_email=f"x{i}@example.com", status=RecipientStatus.pending)
+        for i in range(recipients)
+    )
+    db.commit()
+
+
+def test_batch_is_claimed_at_once_and_shares_transactions(db, campaign, fake_redis, sent, monkeypatch):
+    _fast(db, campaign, per_message=2)
+    claims = []
+    claim = async_engine.claim_recipients
+    monkeypatch.setattr(
+        async_engine, "claim_recipients", lambda *a, **kw: claims.append(a[2]) or claim(*a, **kw)
+    )
+
+    asyncio.run(_engine(fake_redis, poll_interval=1.0)._run_campaign(campaign.id))
+
+    assert claims[0] >= 3
+    assert sent == [["r0@example.com", "r1@example.com"], ["r2@example.com"]]
+    db.expire_all()
+    assert set(db.scalars(select(Recipient.status))) == {RecipientStatus.sent}
+    assert db.get(Campaign, campaign.id).status == CampaignStatus.completed
+
+
+def test_circuit_open_hands_the_batch_back_untried(db, campaign, fake_redis, sent, monkeypatch):
+    _fast(db, campaign)
+
+    async def refuse(self, *_: object) -> None:
+        raise async_engine.CircuitOpenError("smtp.example.com:587", 30.0)
+
+    monkeypatch.setattr(async_engine.AsyncSMTPSession, "send_template", refuse)
+
+    async def scenario(engine):
+        task = asyncio.create_task(engine._run_campaign(campaign.id))
+        await asyncio.sleep(0.3)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+    asyncio.run(scenario(_engine(fake_redis, poll_interval=1.0)))
+    make_sink(fake_redis).flush()
+
+    db.expire_all()
+    assert set(db.scalars(select(Recipient.status))) == {RecipientStatus.pending}
+    assert set(db.scalars(select(Recipient.attempts))) == {0}
+
+
+@pytest.mark.parametrize("engine_name", ["celery", "async"])
+def test_only_the_selected_engine_runs(engine_name, fake_redis, monkeypatch):
+    monkeypatch.setattr(settings, "send_engine", engine_name)
+    started = []
+    monkeypatch.setattr(async_engine, "serve_metrics", lambda port: None)
+    monkeypatch.setattr(scheduler, "serve_metrics", lambda port: None)
+    monkeypatch.setattr(scheduler.Scheduler, "run_forever", lambda self: started.append("celery"))
+
+    async def run(self) -> None:
+        started.append("async")
+
+    monkeypatch.setattr(async_engine.AsyncEngine, "run", run)
+
+    scheduler.main()
+    asyncio.run(async_engine.main())
+
+    assert started == [engine_name]
+
+
+def test_one_engine_holds_the_lock_at_a_time(fake_redis):
+    first, second = _engine(fake_redis), _engine(fake_redis)
+
+    assert first._hold_lock()
+    assert first._hold_lock()
+    assert not second._hold_lock()
+
+    second._release_lock()
+    assert not second._hold_lock()
+    first._release_lock()
+    assert second._hold_lock()
+
+
+def test_losing_the_lock_stops_sending(db, campaign, fake_redis, sent):
+    _fast(db, campaign, recipients=17)
+    engine = _engine(fake_redis)
+
+    async def scenario():
+        task = asyncio.create_task(engine.run())
+        while len(sent) < 3:
+            await asyncio.sleep(0.01)
+        fake_redis.set(async_engine._LOCK_KEY, "another-engine")
+        await task
+
+    with pytest.raises(SystemExit):
+        asyncio.run(scenario())
+    stopped_at = len(sent)
+    make_sink(fake_redis).flush()
+
+    assert stopped_at < 20
+    assert fake_redis.get(async_engine._LOCK_KEY) == b"another-engine"
+    db.expire_all()
+    statuses = list(db.scalars(select(Recipient.status)))
+    # every recipient it sent is recorded; the rest wait for the engine holding the lock
+    assert statuses.count(RecipientStatus.sent) == stopped_at
+    assert statuses.count(RecipientStatus.pending) == 20 - stopped_at
@@ -0,0 +1,137 @@
+from __future__ import annotations
+
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import select, update
+
+from app import auth
+from app.config import settings
+from app.main import app
+from app.models import ApiKey, User
+
+
+@pytest.fixture
+def client(db, fake_redis):
+    auth._keys.clear()
+    auth._misses.clear()
+    auth._default_user.clear()
+    yield TestClient(app)
+    auth._keys.clear()
+    auth._misses.clear()
+    auth._default_user.clear()
+    auth._last_used.clear()
+
+
+def _issue(db, email, name="deploy", expires_at=None):
+    """A new key for ``email``'s user (created if needed); returns the key and its id."""
+    user = db.scalar(select(User).where(User.email == email))
+    if user is None:
+        user = User(email=email)
+        db.add(user)
+        db.flush()
+    key, key_hash = auth.generate_key()
+    api_key = ApiKey(user_id=user.id, key_name=name, key_hash=key_hash, expires_at=expires_at)
+    db.add(api_key)
+    db.commit()
+    return key, api_key.id
+
+
+def test_key_acts_for_its_user(client, db):
+    key, key_id = _issue(db, "owner@example.com")
+    _issue(db, "other@example.com")
+
+    response = client.get("/api-keys/", headers={"Authorization": f"Bearer {key}"})
+
+    assert response.status_code == 200
+    assert [k["id"] for k in response.json()] == [key_id]
+
+
+@pytest.mark.parametrize("header", [{"X-API-Key": "eak_unknown"}, {"Authorization": "Bearer eak_unknown"}])
+def test_unknown_key_is_refused(client, header):
+    assert client.get("/api-keys/", headers=header).status_code == 401
+
+
+def test_expired_key_is_refused(client, db):
+    key, _ = _issue(db, "owner@example.com", expires_at=datetime.now(timezone.utc) - timedelta(minutes=1))
+
+    assert client.get("/api-keys/", headers={"X-API-Key": key}).status_code == 401
+
+
+def test_revoked_key_stops_working_despite_the_cache(client, db, fake_redis):
+    revoked, revoked_id = _issue(db, "owner@example.com", name="old")
+    kept, _ = _issue(db, "owner@example.com", name="new")
+    # both lookups are cached now
+    assert client.get("/api-keys/", headers={"X-API-Key": revoked}).status_code == 200
+    pubsub = fake_redis.pubsub()
+    pubsub.subscribe(auth._REVOKED_CHANNEL)
+    pubsub.get_message()
+
+    assert client.delete(f"/api-keys/{revoked_id}", headers={"X-API-Key": kept}).status_code == 200
+
+    assert client.get("/api-keys/", headers={"X-API-Key": revoked}).status_code == 401
+    assert client.get("/api-keys/", headers={"X-API-Key": kept}).status_code == 200
+    # other API processes are told to drop it as well
+    assert pubsub.get_message(ignore_subscribe_messages=True) is not None
+
+
+def test_unknown_keys_are_cached_apart_from_valid_ones(client, db):
+    key, _ = _issue(db, "owner@example.com")
+    client.get("/api-keys/", headers={"X-API-Key": key})
+
+    for i in range(5):
+        assert client.get("/api-keys/", headers={"X-API-Key": f"eak_made_up_{i}"}).status_code == 401
+
+    assert len(auth._keys._entries) == 1
+    assert len(auth._misses._entries) == 5
+
+
+def test_keys_cannot_be_created_without_a_key(client, db, monkeypatch):
+    monkeypatch.setattr(settings, "api_auth_required", False)
+
+    assert client.post("/api-keys/", json={"name": "stolen"}).status_code == 401
+    assert db.scalar(select(ApiKey.id)) is None
+
+    key, _ = _issue(db, "owner@example.com")
+    assert client.post("/api-keys/", json={"name": "ci"}, headers={"X-API-Key": key}).status_code == 200
+
+
+def test_keyless_requests_need_a_key_when_required(client, monkeypatch):
+    monkeypatch.setattr(settings, "api_auth_required", True)
+
+    assert client.get("/api-keys/").status_code == 401
+
+
+def test_last_used_is_written_in_one_flush(client, db):
+    key, key_id = _issue(db, "owner@example.com")
+    client.get("/api-keys/", headers={"X-API-Key": key})
+
+    assert list(auth._last_used) == [key_id]
+    assert asyncio.run(auth.flush_last_used()) == 1
+    assert not auth._last_used
+    db.expire_all()
+    assert db.get(ApiKey, key_id).last_used_at is not None
+
+
+def test_queue_backlog_is_for_admins_only(client, db, monkeypatch):
+    monkeypatch.setattr("app.routers.queues.backlog", lambda: {"generated_at": "2025-01-15T10:30:00Z", "queues": []})
+    user_key, _ = _issue(db, "owner@example.com")
+    admin_key, _ = _issue(db, "ops@example.com")
+    db.execute(update(User).where(User.email == "ops@example.com").values(is_admin=True))
+    db.commit()
+
+    assert client.get("/queues/", headers={"X-API-Key": user_key}).status_code == 403
+    assert client.get("/queues/", headers={"X-API-Key": admin_key}).status_code == 200
+
+
+def test_keyless_requests_are_never_admin(client, db, monkeypatch):
+    monkeypatch.setattr(settings, "api_auth_required", False)
+    client.get("/api-keys/")
+    # even with the default user's flag set, no key means no operator access
+    db.execute(update(User).where(User.email == auth.DEFAULT_USER_EMAIL).values(is_admin=True))
+    db.commit()
+    auth._default_user.clear()
+
+    assert client.get("/queues/").status_code == 403
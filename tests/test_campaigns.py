@@ -0,0 +1,165 @@
+from __future__ import annotations
+
+import asyncio
+import base64
+
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import select
+
+from app import auth
+from app.email_sender import MessageTemplate
+from app.main import app
+from app.models import ApiKey, Campaign, CampaignStatus, Recipient, RecipientStatus, SentEmail
+from app.routers import campaigns
+
+
+@pytest.fixture
+def api(db, fake_redis, campaign):
+    """A client authenticated as the campaign's owner."""
+    for cache in (auth._keys, auth._misses, campaigns._status_cache, campaigns._owners):
+        cache.clear()
+    key, key_hash = auth.generate_key()
+    db.add(ApiKey(user_id=campaign.user_id, key_name="test", key_hash=key_hash))
+    db.commit()
+    yield TestClient(app, headers={"X-API-Key": key})
+    for cache in (auth._keys, auth._misses, campaigns._status_cache, campaigns._owners):
+        cache.clear()
+
+
+def _payload(**overrides):
+    payload = {
+        "name": "Launch",
+        "from_email": "news@example.com",
+        "subject": "Hi {{ first_name | there }}",
+        "body": "Your plan: {{ attributes.plan | free }}",
+        "limits_count": 10,
+        "limits_window_seconds": 60,
+        "smtp": {"smtp_host": "smtp.example.com", "smtp_port": 587, "smtp_username": "u", "smtp_password": "p"},
+        "recipients": [
+            {"to_email": "ann@example.com", "to_name": "Ann Lee", "attributes": {"plan": "pro"}},
+            {"to_email": "bob@example.com"},
+        ],
+    }
+    payload.update(overrides)
+    return payload
+
+
+def _set_statuses(db, *statuses):
+    for recipient, status in zip(db.scalars(select(Recipient).order_by(Recipient.id)), statuses):
+        recipient.status = status
+    db.commit()
+
+
+def test_status_counts_every_state_in_one_response(api, db, campaign):
+    _set_statuses(db, RecipientStatus.sent, RecipientStatus.failed, RecipientStatus.in_flight)
+
+    body = api.get(f"/campaigns/{campaign.id}/status").json()
+
+    assert (body["total"], body["sent"], body["failed"], body["pending"]) == (3, 1, 1, 1)
+    assert body["progress_pct"] == 33.33
+    assert body["status"] == "running"
+
+
+def test_status_is_cached_until_the_campaign_changes(api, db, campaign, monkeypatch):
+    monkeypatch.setattr(campaigns._status_cache, "ttl_seconds", 60.0)
+    assert api.get(f"/campaigns/{campaign.id}/status").json()["sent"] == 0
+    _set_statuses(db, RecipientStatus.sent)
+
+    assert api.get(f"/campaigns/{campaign.id}/status").json()["sent"] == 0
+
+    assert api.post(f"/campaigns/{campaign.id}/pause").status_code == 200
+    body = api.get(f"/campaigns/{campaign.id}/status").json()
+    assert (body["status"], body["sent"]) == ("paused", 1)
+
+
+def test_concurrent_pollers_share_one_query():
+    cache = campaigns.TTLCache(ttl_seconds=60.0)
+    queries = []
+
+    async def load():
+        queries.append(1)
+        await asyncio.sleep(0.01)
+        return "snapshot"
+
+    async def poll():
+        results = await asyncio.gather(*(cache.get_or_compute_async(1, load) for _ in range(20)))
+        return results + [await cache.get_or_compute_async(1, load)]
+
+    assert asyncio.run(poll()) == ["snapshot"] * 21
+    assert len(queries) == 1
+
+
+def test_create_stores_the_campaign_and_its_recipients(api, db):
+    response = api.post("/campaigns/", json=_payload())
+
+    assert response.status_code == 200
+    created = db.get(Campaign, response.json()["id"])
+    assert (created.name, created.status) == ("Launch", CampaignStatus.draft)
+    recipients = db.scalars(select(Recipient).where(Recipient.campaign_id == created.id).order_by(Recipient.id)).all()
+    assert [(r.to_email, r.attributes) for r in recipients] == [
+        ("ann@example.com", {"plan": "pro"}), ("bob@example.com", None)
+    ]
+
+
+def test_created_template_renders_fallbacks_for_missing_merge_fields(api, db):
+    created = db.get(Campaign, api.post("/campaigns/", json=_payload()).json()["id"])
+    template = MessageTemplate(created.from_email, created.from_name, created.subject, created.body)
+
+    _, wire = template.render("bob@example.com")
+
+    assert b"Subject: Hi there\r\n" in wire
+    assert base64.b64decode(wire.partition(b"\r\n\r\n")[2]).decode() == "Your plan: free"
+
+
+@pytest.mark.parametrize(
+    "overrides",
+    [
+        {"subject": "Hi {{ name }}"},
+        {"body": "Hi {{ first_name"},
+        {"recipients_per_message": 5},
+    ],
+)
+def test_create_rejects_templates_it_cannot_send(api, db, overrides):
+    response = api.post("/campaigns/", json=_payload(**overrides))
+
+    assert response.status_code == 400
+    assert db.scalars(select(Campaign).where(Campaign.name == "Launch")).first() is None
+
+
+def test_recipients_are_paged_by_id(api, campaign):
+    url = f"/campaigns/{campaign.id}/recipients"
+    first = api.get(url, params={"limit": 2}).json()
+    rest = api.get(url, params={"limit": 2, "after": first["next_after"]}).json()
+
+    assert [r["to_email"] for r in first["items"]] == ["r0@example.com", "r1@example.com"]
+    assert first["next_after"] == first["items"][-1]["id"]
+    assert [r["to_email"] for r in rest["items"]] == ["r2@example.com"]
+    assert rest["next_after"] is None
+
+
+def test_recipient_pages_filter_by_status(api, db, campaign):
+    _set_statuses(db, RecipientStatus.sent, RecipientStatus.failed, RecipientStatus.sent)
+
+    page = api.get(f"/campaigns/{campaign.id}/recipients", params={"status": "sent"}).json()
+
+    assert [r["to_email"] for r in page["items"]] == ["r0@example.com", "r2@example.com"]
+    assert page["next_after"] is None
+
+
+def test_deliveries_are_paged_and_filtered(api, db, campaign):
+    recipient = db.scalars(select(Recipient).order_by(Recipient.id)).first()
+    db.add_all(
+        SentEmail(campaign_id=campaign.id, recipient_id=recipient.id, subject="Hi", status=status, attempts=attempt)
+        for attempt, status in enumerate(("deferred", "deferred", "sent"), start=1)
+    )
+    db.commit()
+    url = f"/campaigns/{campaign.id}/deliveries"
+
+    first = api.get(url, params={"limit": 1, "status": "deferred"}).json()
+    second = api.get(url, params={"limit": 1, "status": "deferred", "after": first["next_after"]}).json()
+
+    deferred = [(d["status"], d["attempts"]) for d in first["items"] + second["items"]]
+    assert deferred == [("deferred", 1), ("deferred", 2)]
+    assert second["next_after"] is None
+    assert [d["attempts"] for d in api.get(url).json()["items"]] == [1, 2, 3]
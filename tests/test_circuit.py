@@ -0,0 +1,106 @@
+from __future__ import annotations
+
+import asyncio
+import smtplib
+import time
+
+import pytest
+
+from app.circuit import CircuitOpenError, _probe_key, circuit_key, guard, guard_async
+from app.config import settings
+
+_HOST, _PORT = "smtp.example.com", 587
+
+
+@pytest.fixture(autouse=True)
+def fast_circuit(fake_redis, monkeypatch):
+    monkeypatch.setattr(settings, "circuit_failure_threshold", 2)
+    monkeypatch.setattr(settings, "circuit_open_seconds", 0.05)
+    monkeypatch.setattr(settings, "circuit_open_max_seconds", 10.0)
+
+
+def _fail(exc, username="user"):
+    with pytest.raises(type(exc)):
+        with guard(_HOST, _PORT, username):
+            raise exc
+
+
+def _connects(username="user"):
+    with guard(_HOST, _PORT, username):
+        return True
+
+
+def test_failures_open_the_circuit_without_connecting():
+    _fail(OSError("connection refused"))
+    assert _connects(), "one failure stays under the threshold"
+    _fail(OSError("connection refused"))
+    _fail(OSError("connection refused"))
+
+    with pytest.raises(CircuitOpenError) as e:
+        _connects()
+    assert 0 < e.value.retry_after <= 0.05
+
+
+def test_one_probe_after_the_open_period_and_success_closes(fake_redis):
+    _fail(OSError("refused"))
+    _fail(OSError("refused"))
+    time.sleep(0.06)
+
+    with guard(_HOST, _PORT, "user"):
+        # half open: everyone else waits for this probe
+        with pytest.raises(CircuitOpenError):
+            _connects("other")
+
+    assert _connects("other")
+    assert not fake_redis.exists(circuit_key(_HOST, _PORT))
+
+
+def test_failed_probe_reopens_for_longer(fake_redis):
+    _fail(OSError("refused"))
+    _fail(OSError("refused"))
+    time.sleep(0.06)
+    _fail(OSError("still refused"))
+
+    with pytest.raises(CircuitOpenError) as e:
+        _connects()
+    assert 0.05 < e.value.retry_after <= 0.1
+
+
+def test_open_auth_circuit_gives_back_the_host_probe(fake_redis):
+    now_ms = int(time.time() * 1000)
+    # the host is due a probe, but this account's wrong password is still shut out
+    fake_redis.hset(circuit_key(_HOST, _PORT), mapping={"failures": 0, "opened_until": now_ms - 1, "opens": 1})
+    fake_redis.hset(circuit_key(_HOST, _PORT, "user"), mapping={"failures": 0, "opened_until": now_ms + 60_000})
+
+    with pytest.raises(CircuitOpenError):
+        _connects()
+
+    assert not fake_redis.exists(_probe_key(circuit_key(_HOST, _PORT)))
+    assert _connects("other")
+    assert not fake_redis.exists(circuit_key(_HOST, _PORT))
+
+
+def test_auth_failure_on_a_probe_gives_back_the_host_probe(fake_redis):
+    _fail(OSError("refused"))
+    _fail(OSError("refused"))
+    time.sleep(0.06)
+
+    _fail(smtplib.SMTPAuthenticationError(535, b"bad credentials"))
+
+    assert not fake_redis.exists(_probe_key(circuit_key(_HOST, _PORT)))
+    assert _connects("other")
+
+
+def test_cancelled_async_probe_gives_back_the_lock(fake_redis):
+    _fail(OSError("refused"))
+    _fail(OSError("refused"))
+    time.sleep(0.06)
+
+    async def cancelled_probe():
+        async with guard_async(_HOST, _PORT, "user"):
+            raise asyncio.CancelledError
+
+    with pytest.raises(asyncio.CancelledError):
+        asyncio.run(cancelled_probe())
+
+    assert not fake_redis.exists(_probe_key(circuit_key(_HOST, _PORT)))
@@ -0,0 +1,72 @@
+from __future__ import annotations
+
+import pytest
+from cryptography.fernet import Fernet, InvalidToken
+
+from app import crypto
+from app.config import settings
+from app.models import Campaign
+
+
+@pytest.fixture(autouse=True)
+def fresh_caches():
+    crypto._get_fernet.cache_clear()
+    crypto._credentials.clear()
+    yield
+    crypto._get_fernet.cache_clear()
+    crypto._credentials.clear()
+
+
+def _use_keys(monkeypatch, *keys):
+    monkeypatch.setattr(settings, "encryption_key", ",".join(keys))
+    crypto._get_fernet.cache_clear()
+
+
+def test_fernet_is_built_once():
+    assert crypto._get_fernet() is crypto._get_fernet()
+
+
+def test_credentials_are_decrypted_once_per_ciphertext(monkeypatch):
+    username, password = crypto.encrypt_str("user"), crypto.encrypt_str("secret")
+    calls = []
+    decrypt = crypto.decrypt_str
+    monkeypatch.setattr(crypto, "decrypt_str", lambda token: calls.append(token) or decrypt(token))
+
+    for _ in range(3):
+        assert crypto.get_smtp_credentials(7, username, password) == ("user", "secret")
+    assert len(calls) == 2
+
+    # new settings for the same campaign are never answered from the cache
+    changed = crypto.encrypt_str("new-secret")
+    assert crypto.get_smtp_credentials(7, username, changed) == ("user", "new-secret")
+
+
+def test_old_key_still_decrypts_and_rotation_moves_to_the_new_one(monkeypatch):
+    old, new = Fernet.generate_key().decode(), Fernet.generate_key().decode()
+    _use_keys(monkeypatch, old)
+    token = crypto.encrypt_str("secret")
+
+    _use_keys(monkeypatch, new, old)
+    assert crypto.decrypt_str(token) == "secret"
+    rotated = crypto.rotate_str(token)
+
+    _use_keys(monkeypatch, new)
+    assert crypto.decrypt_str(rotated) == "secret"
+    with pytest.raises(InvalidToken):
+        crypto.decrypt_str(token)
+
+
+def test_rotate_re_encrypts_every_campaign(db, campaign, monkeypatch):
+    old, new = Fernet.generate_key().decode(), Fernet.generate_key().decode()
+    _use_keys(monkeypatch, old)
+    campaign.smtp_username_enc, campaign.smtp_password_enc = crypto.encrypt_str("user"), crypto.encrypt_str("pw")
+    db.commit()
+
+    _use_keys(monkeypatch, new, old)
+    assert crypto.rotate_campaign_credentials(batch_size=1) == 1
+
+    _use_keys(monkeypatch, new)
+    db.expire_all()
+    stored = db.get(Campaign, campaign.id)
+    assert crypto.decrypt_str(stored.smtp_username_enc) == "user"
+    assert crypto.decrypt_str(stored.smtp_password_enc) == "pw"
@@ -0,0 +1,100 @@
+from __future__ import annotations
+
+from sqlalchemy import func, select
+
+from app.delivery import DEFERRED, RELEASED, DeliveryResult, apply_results, claim_recipients
+from app.models import Recipient, RecipientStatus, SentEmail
+
+
+def _claim(db, campaign_id, limit, lease_seconds=600):
+    # every sender claims in a session of its own; start from an empty identity map like they do
+    db.expunge_all()
+    return claim_recipients(db, campaign_id, limit=limit, lease_seconds=lease_seconds)
+
+
+def _statuses(db, campaign_id):
+    rows = db.scalars(select(Recipient.status).where(Recipient.campaign_id == campaign_id).order_by(Recipient.id))
+    return list(rows)
+
+
+def test_claim_takes_pending_rows_in_id_order(db, campaign):
+    claimed = _claim(db, campaign.id, 2)
+
+    assert [r.to_email for r in claimed] == ["r0@example.com", "r1@example.com"]
+    assert all(r.status == RecipientStatus.in_flight for r in claimed)
+    assert _statuses(db, campaign.id) == [RecipientStatus.in_flight, RecipientStatus.in_flight, RecipientStatus.pending]
+
+
+def test_claim_skips_live_leases(db, campaign):
+    _claim(db, campaign.id, 3)
+
+    assert _claim(db, campaign.id, 3) == []
+
+
+def test_expired_lease_is_claimed_again(db, campaign):
+    first = _claim(db, campaign.id, 1)[0]
+    fence = first.last_attempt_at
+
+    # a lease of zero seconds has always expired
+    again = _claim(db, campaign.id, 1, lease_seconds=0)
+
+    assert [r.id for r in again] == [first.id]
+    assert again[0].last_attempt_at != fence
+
+
+def test_apply_results_writes_status_and_log(db, campaign):
+    recipient = _claim(db, campaign.id, 1)[0]
+
+    applied = apply_results(db, [DeliveryResult.sent(recipient, "<id@example.com>", "250 OK")])
+    db.commit()
+
+    assert len(applied) == 1
+    db.refresh(recipient)
+    assert recipient.status == RecipientStatus.sent
+    assert recipient.attempts == 1
+    assert db.scalar(select(func.count()).select_from(SentEmail)) == 1
+
+
+def test_result_of_a_superseded_claim_is_dropped(db, campaign):
+    stale = _claim(db, campaign.id, 1)[0]
+    stale_result = DeliveryResult.sent(stale, "<old@example.com>", "250 OK")
+    current = _claim(db, campaign.id, 1, lease_seconds=0)[0]
+
+    assert apply_results(db, [stale_result]) == []
+    assert apply_results(db, [DeliveryResult.failed(current, "550 no such user")]) != []
+    db.commit()
+
+    db.refresh(current)
+    assert current.status == RecipientStatus.failed
+    assert db.scalar(select(func.count()).select_from(SentEmail)) == 1
+
+
+def test_replayed_result_is_a_no_op(db, campaign):
+    recipient = _claim(db, campaign.id, 1)[0]
+    result = DeliveryResult.sent(recipient, None, "250 OK")
+
+    assert apply_results(db, [result]) == [result]
+    assert apply_results(db, [result]) == []
+    db.commit()
+
+    db.refresh(recipient)
+    assert recipient.attempts == 1
+
+
+def test_deferred_and_released_results_return_to_pending(db, campaign):
+    deferred, released = _claim(db, campaign.id, 2)
+
+    apply_results(
+        db, [DeliveryResult.deferred(deferred, "451 try later"), DeliveryResult.released(released, "throttled")]
+    )
+    db.commit()
+
+    db.refresh(deferred)
+    db.refresh(released)
+    assert deferred.status == released.status == RecipientStatus.pending
+    assert deferred.retry_at is not None and released.retry_at is not None
+    # only an attempt that reached the server counts
+    assert (deferred.attempts, released.attempts) == (1, 0)
+    logged = db.scalars(select(SentEmail.status)).all()
+    assert logged == [DEFERRED]
+    assert RELEASED not in logged
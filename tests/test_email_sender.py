@@ -0,0 +1,200 @@
+from __future__ import annotations
+
+import email
+import email.policy
+import smtplib
+
+import pytest
+
+from app import email_sender
+from app.email_sender import MessageTemplate, SMTPSession, is_hard_bounce, is_transient, pipelined_sendmail
+
+
+class PipelinedServer:
+    """Replays canned replies the way a PIPELINING server answers a batch of commands."""
+
+    def __init__(self, mail, rcpts, data=(250, b"2.0.0 Queued")):
+        self.replies = [mail, *rcpts]
+        self.data_reply = data
+        self.sent = []
+        self.data_sent = None
+        self.reset = False
+
+    def ehlo_or_helo_if_needed(self):
+        pass
+
+    def has_extn(self, name):
+        return name == "pipelining"
+
+    def send(self, text):
+        self.sent.append(text)
+
+    def getreply(self):
+        return self.replies.pop(0)
+
+    def data(self, msg):
+        self.data_sent = msg
+        return self.data_reply
+
+    def _rset(self):
+        self.reset = True
+
+
+_TO = ["a@example.com", "b@example.com", "c@example.com"]
+_OK = (250, b"2.1.5 OK")
+
+
+def test_commands_go_out_in_one_write():
+    server = PipelinedServer(_OK, [_OK, _OK, _OK])
+
+    assert pipelined_sendmail(server, "news@example.com", _TO, b"msg") == {}
+    assert len(server.sent) == 1
+    assert server.sent[0].count("RCPT TO:") == 3
+    assert server.data_sent == b"msg"
+
+
+def test_refused_recipients_are_mapped_to_their_replies():
+    server = PipelinedServer(_OK, [_OK, (550, b"5.1.1 No such user"), (451, b"4.3.0 Try again later")])
+
+    refused = pipelined_sendmail(server, "news@example.com", _TO, b"msg")
+
+    assert refused == {"b@example.com": (550, b"5.1.1 No such user"), "c@example.com": (451, b"4.3.0 Try again later")}
+    assert server.data_sent == b"msg"
+    assert is_hard_bounce(smtplib.SMTPRecipientsRefused({"b@example.com": refused["b@example.com"]}))
+    assert is_transient(smtplib.SMTPRecipientsRefused({"c@example.com": refused["c@example.com"]}))
+
+
+def test_every_recipient_refused_raises_without_data():
+    server = PipelinedServer(_OK, [(550, b"no")] * 3)
+
+    with pytest.raises(smtplib.SMTPRecipientsRefused) as e:
+        pipelined_sendmail(server, "news@example.com", _TO, b"msg")
+
+    assert set(e.value.recipients) == set(_TO)
+    assert server.data_sent is None and server.reset
+
+
+def test_sender_refusal_reads_every_reply_first():
+    server = PipelinedServer((451, b"4.7.1 Slow down"), [(503, b"need MAIL")] * 3)
+
+    with pytest.raises(smtplib.SMTPSenderRefused):
+        pipelined_sendmail(server, "news@example.com", _TO, b"msg")
+
+    # the connection is left in step for the next transaction
+    assert server.replies == [] and server.reset
+
+
+def test_data_refusal_raises():
+    server = PipelinedServer(_OK, [_OK] * 3, data=(554, b"5.6.0 Rejected"))
+
+    with pytest.raises(smtplib.SMTPDataError):
+        pipelined_sendmail(server, "news@example.com", _TO, b"msg")
+    assert server.reset
+
+
+class SessionServer:
+    """An authenticated connection: each send takes the next outcome, 250 once they run out."""
+
+    def __init__(self, *outcomes, rset=(250, b"2.0.0 Reset")):
+        self.outcomes = list(outcomes)
+        self.rset_reply = rset
+        self.sock = object()
+        self.delivered = []
+        self.closed = False
+
+    def has_extn(self, name):
+        return False
+
+    def sendmail(self, from_addr, to_addrs, msg):
+        if self.outcomes:
+            raise self.outcomes.pop(0)
+        self.delivered.append(to_addrs)
+        return {}
+
+    def rset(self):
+        if isinstance(self.rset_reply, Exception):
+            raise self.rset_reply
+        return self.rset_reply
+
+    def quit(self):
+        self.closed = True
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.fixture
+def connections(fake_redis, monkeypatch):
+    """Servers handed out by each new connection, in order."""
+    servers = []
+    monkeypatch.setattr(email_sender, "open_smtp_connection", lambda **_: servers.pop(0))
+    return servers
+
+
+def _session():
+    return SMTPSession("smtp.example.com", 587, "user", "secret", use_starttls=True)
+
+
+_TEMPLATE = MessageTemplate("news@example.com", None, "Hi", "Hello")
+_DATA_REFUSED = smtplib.SMTPDataError(554, b"5.6.0 Rejected")
+
+
+def test_connection_is_kept_after_a_refused_message_once_reset(connections):
+    first = SessionServer(_DATA_REFUSED, smtplib.SMTPServerDisconnected("idle timeout"))
+    second = SessionServer()
+    connections.extend([first, second])
+    session = _session()
+
+    with pytest.raises(smtplib.SMTPDataError):
+        session.send_template(_TEMPLATE, "a@example.com")
+    # no longer fresh: the dead socket is found on reuse and the message resent
+    session.send_template(_TEMPLATE, "b@example.com")
+
+    assert first.outcomes == []
+    assert second.delivered == [["b@example.com"]]
+    assert session.retries == 1
+
+
+def test_connection_is_dropped_when_reset_fails(connections):
+    first = SessionServer(_DATA_REFUSED, rset=smtplib.SMTPServerDisconnected("closed"))
+    second = SessionServer()
+    connections.extend([first, second])
+    session = _session()
+
+    with pytest.raises(smtplib.SMTPDataError):
+        session.send_template(_TEMPLATE, "a@example.com")
+    session.send_template(_TEMPLATE, "b@example.com")
+
+    assert first.closed and first.delivered == []
+    assert second.delivered == [["b@example.com"]]
+    assert session.retries == 0
+
+
+def _parse(wire: bytes):
+    return email.message_from_bytes(wire, policy=email.policy.default)
+
+
+def test_template_splices_per_recipient_headers_onto_shared_bytes():
+    template = MessageTemplate("news@example.com", "Newsroom", "Grüße", "Hello there")
+
+    first_id, first = template.render("a@example.com")
+    second_id, second = template.render("b@example.com")
+
+    one, two = _parse(first), _parse(second)
+    assert (one["To"], two["To"]) == ("a@example.com", "b@example.com")
+    assert (one["Message-ID"], two["Message-ID"]) == (first_id, second_id)
+    assert first_id != second_id and first_id.endswith("@example.com>")
+    assert one["Date"] and one["From"] == "Newsroom <news@example.com>"
+    assert one["Subject"] == "Grüße"
+    assert one.get_content().strip() == "Hello there"
+    # everything after the spliced headers is the same encoded bytes
+    def shared(wire):
+        return wire.partition(b"\r\nDate: ")[2].partition(b"\r\n")[2]
+
+    assert shared(first) == shared(second)
+    assert b"\n" not in first.replace(b"\r\n", b"")
+
+
+def test_template_refuses_addresses_that_would_break_headers():
+    with pytest.raises(ValueError):
+        MessageTemplate("news@example.com", None, "Hi", "Hello").render("a@example.com\r\nBcc: b@example.com")
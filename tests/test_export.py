@@ -0,0 +1,53 @@
+from __future__ import annotations
+
+import asyncio
+import csv
+import gzip
+import io
+from datetime import datetime, timezone
+
+from sqlalchemy import select
+
+from app.export import COLUMNS, export_rows
+from app.models import Recipient, RecipientStatus, SentEmail
+
+
+def _export(campaign_id, **kw) -> bytes:
+    async def collect():
+        return b"".join([chunk async for chunk in export_rows(campaign_id, "csv", **kw)])
+
+    return asyncio.run(collect())
+
+
+def test_csv_rows_carry_the_latest_delivery(db, campaign):
+    first, second, _ = db.scalars(select(Recipient).order_by(Recipient.id)).all()
+    delivered_at = datetime(2026, 1, 2, 3, 4, 5, tzinfo=timezone.utc)
+    first.status, first.sent_at = RecipientStatus.sent, delivered_at
+    second.status, second.last_error = RecipientStatus.pending, "451 4.3.0 Try again later"
+    db.add_all([
+        SentEmail(
+            campaign_id=campaign.id, recipient_id=first.id, subject="Hi", status="deferred",
+            attempts=1, error="451 4.3.0 Try again later",
+        ),
+        SentEmail(
+            campaign_id=campaign.id, recipient_id=first.id, subject="Hi", status="sent", attempts=2,
+            message_id="<m1@example.com>", smtp_response="250 OK", delivered_at=delivered_at,
+        ),
+    ])
+    db.commit()
+
+    body = _export(campaign.id)
+    rows = list(csv.DictReader(io.StringIO(body.decode("utf-8"))))
+
+    assert tuple(rows[0]) == COLUMNS
+    assert [r["to_email"] for r in rows] == ["r0@example.com", "r1@example.com", "r2@example.com"]
+    assert rows[0]["status"] == "sent"
+    assert rows[0]["message_id"] == "<m1@example.com>"
+    assert rows[0]["smtp_response"] == "250 OK"
+    assert rows[0]["attempts"] == "2"
+    assert datetime.fromisoformat(rows[0]["delivered_at"]).replace(tzinfo=timezone.utc) == delivered_at
+    # no delivery yet: the delivery columns are empty
+    assert rows[1]["error"] == "451 4.3.0 Try again later"
+    assert (rows[1]["message_id"], rows[1]["delivered_at"], rows[1]["attempts"]) == ("", "", "")
+
+    assert gzip.decompress(_export(campaign.id, gzip=True)) == body
@@ -0,0 +1,135 @@
+from __future__ import annotations
+
+import asyncio
+
+import pytest
+
+from app import suppression
+from app.db import AsyncSessionLocal
+from app.ingest import MAX_RECORD_CHARS, ImportResult, RecipientFilter, RecipientWriter, iter_records, parse_row
+from app.models import SuppressionReason
+
+
+@pytest.fixture(autouse=True)
+def _fresh_indexes():
+    suppression._indexes.clear()
+    yield
+    suppression._indexes.clear()
+
+
+async def _chunks(*parts):
+    for part in parts:
+        yield part
+
+
+def _records(fmt, *parts):
+    async def collect():
+        return [record async for record in iter_records(_chunks(*parts), fmt)]
+
+    return asyncio.run(collect())
+
+
+def test_records_follow_line_breaks_split_across_chunks():
+    assert _records("csv", b"a@example.com,A\r\nb@exa", b"mple.com,B\n") == [
+        (1, "a@example.com,A"),
+        (2, "b@example.com,B"),
+    ]
+
+
+def test_quoted_csv_field_may_span_lines():
+    body = b'to_email,to_name\n"c@example.com","Line one\nline ""two"""\nd@example.com,D\n'
+
+    records = _records("csv", body)
+
+    assert records == [
+        (1, "to_email,to_name"),
+        (2, '"c@example.com","Line one\nline ""two"""'),
+        (4, "d@example.com,D"),
+    ]
+    result = ImportResult()
+    assert parse_row(records[1][1], 2, "csv", result) == ("c@example.com", 'Line one\nline "two"', None)
+
+
+def test_unbalanced_quote_is_cut_off():
+    filler = (b"x" * 99 + b"\n") * (MAX_RECORD_CHARS // 100 + 1)
+
+    records = _records("csv", b'"open@example.com,never closed\n' + filler, b"after@example.com,A\n")
+
+    assert records[0][0] == 1
+    assert records[-1][1] == "after@example.com,A"
+
+
+def test_ndjson_lines_are_not_joined():
+    # an odd number of quotes means nothing outside CSV
+    assert _records("ndjson", b'{"to_name": "5\\" tall"}\n{}\n') == [(1, '{"to_name": "5\\" tall"}'), (2, "{}")]
+
+
+def test_parse_row_rejects_and_reports_line():
+    result = ImportResult()
+
+    assert parse_row("email\r", 1, "csv", result) is None
+    assert parse_row("not-an-address,X", 2, "csv", result) is None
+    assert parse_row('{"to_email": "a@example.com", "attributes": []}', 3, "ndjson", result) is None
+    assert parse_row('{"to_email": "a@example.com", "attributes": {"k": 1}}', 4, "ndjson", result) == (
+        "a@example.com",
+        None,
+        {"k": 1},
+    )
+    assert [line for line, _ in result.errors] == [2, 3]
+
+
+def _rows(*addresses):
+    return [(a, None, None) for a in addresses]
+
+
+def _import(campaign, batches):
+    """Screen and write ``batches`` in one transaction, as the bulk upload does."""
+
+    async def run():
+        result = ImportResult()
+        screen = RecipientFilter(campaign.user_id, campaign.id)
+        async with AsyncSessionLocal() as db:
+            writer = RecipientWriter(db, campaign.id)
+            written = []
+            for batch in batches:
+                rows = await screen.drop_existing(db, batch, result)
+                kept = screen.apply(rows, result)
+                await writer.write(kept)
+                written += [row[0] for row in kept]
+            await db.commit()
+        return written, result
+
+    return asyncio.run(run())
+
+
+def test_existing_and_repeated_addresses_are_dropped(campaign):
+    # the campaign already has r0..r2@example.com
+    written, result = _import(
+        campaign,
+        [
+            _rows("R0@example.com", "new@example.com", "NEW@example.com"),
+            _rows("new@example.com", "r2@example.com", "later@example.com"),
+        ],
+    )
+
+    assert written == ["new@example.com", "later@example.com"]
+    assert result.duplicates == 4
+
+
+def test_suppressed_addresses_are_counted_apart(db, campaign):
+    suppression.add_suppressions(db, [(campaign.user_id, "blocked@example.com")], SuppressionReason.complained)
+    db.commit()
+
+    written, result = _import(campaign, [_rows("Blocked@example.com", "fine@example.com")])
+
+    assert written == ["fine@example.com"]
+    assert (result.suppressed, result.duplicates) == (1, 0)
+
+
+def test_without_a_campaign_only_the_batch_is_deduplicated(campaign):
+    result = ImportResult()
+
+    kept = RecipientFilter(campaign.user_id).apply(_rows("r0@example.com", "R0@example.com"), result)
+
+    assert [row[0] for row in kept] == ["r0@example.com"]
+    assert result.duplicates == 1
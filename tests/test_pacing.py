@@ -0,0 +1,111 @@
+from __future__ import annotations
+
+import smtplib
+import time
+from datetime import datetime, timezone
+
+import aiosmtplib
+import pytest
+
+from app import async_sender
+from app.config import settings
+from app.delivery import DEFERRED
+from app.email_sender import is_throttle
+from app.models import Recipient, RecipientStatus
+from app.scheduler import account_pacing_key, record_pacing
+from app.tasks import _BatchOutcome
+
+_ACCOUNT = ("smtp.example.com", 587, "user")
+
+
+@pytest.fixture
+def pacing(fake_redis, monkeypatch):
+    monkeypatch.setattr(settings, "adaptive_rate_enabled", True)
+    monkeypatch.setattr(settings, "adaptive_rate_decrease", 0.5)
+    monkeypatch.setattr(settings, "adaptive_rate_floor", 0.2)
+    monkeypatch.setattr(settings, "adaptive_rate_increase_per_second", 0.01)
+    monkeypatch.setattr(settings, "adaptive_rate_cooldown_seconds", 5.0)
+    return fake_redis
+
+
+def test_throttle_halves_the_rate_once_per_cooldown(pacing):
+    assert record_pacing(*_ACCOUNT, throttled=True) == 0.5
+    # a burst of throttled replies from one slowdown counts once
+    assert record_pacing(*_ACCOUNT, throttled=True) == 0.5
+
+
+def test_rate_never_drops_below_the_floor(pacing, monkeypatch):
+    monkeypatch.setattr(settings, "adaptive_rate_cooldown_seconds", 0.0)
+
+    factors = [record_pacing(*_ACCOUNT, throttled=True) for _ in range(4)]
+
+    assert factors == [0.5, 0.25, 0.2, 0.2]
+
+
+def test_rate_recovers_linearly_and_the_key_is_dropped(pacing):
+    key = account_pacing_key(*_ACCOUNT)
+    record_pacing(*_ACCOUNT, throttled=True)
+    # as if the last report was ten seconds ago
+    pacing.hset(key, "t", int(time.time() * 1000) - 10_000)
+
+    assert record_pacing(*_ACCOUNT, throttled=False) == pytest.approx(0.6, abs=0.01)
+
+    pacing.hset(key, mapping={"f": "0.999", "t": int(time.time() * 1000) - 1000})
+    assert record_pacing(*_ACCOUNT, throttled=False) == 1.0
+    assert not pacing.exists(key)
+
+
+@pytest.mark.parametrize(
+    "exc, throttle",
+    [
+        (smtplib.SMTPRecipientsRefused({"a@example.com": (451, b"4.3.0 Try again later")}), False),
+        (smtplib.SMTPRecipientsRefused({"a@example.com": (450, b"Greylisted, see you soon")}), False),
+        (smtplib.SMTPRecipientsRefused({"a@example.com": (450, b"4.7.1 Too many messages")}), True),
+        (smtplib.SMTPRecipientsRefused({"a@example.com": (421, b"Closing connection")}), True),
+        (smtplib.SMTPRecipientsRefused({"a@example.com": (550, b"5.1.1 No such user")}), False),
+        (smtplib.SMTPSenderRefused(451, b"Try later", "news@example.com"), True),
+        (smtplib.SMTPDataError(452, b"Insufficient storage"), True),
+        (smtplib.SMTPServerDisconnected("gone"), False),
+    ],
+)
+def test_only_slow_down_replies_are_throttling(exc, throttle):
+    assert is_throttle(exc) is throttle
+
+
+def test_async_classification_matches():
+    greylisted = aiosmtplib.SMTPRecipientRefused(451, "4.3.0 Try again later", "a@example.com")
+    limited = aiosmtplib.SMTPRecipientRefused(450, "4.7.0 Slow down", "a@example.com")
+
+    assert not async_sender.is_throttle(aiosmtplib.SMTPRecipientsRefused([greylisted]))
+    assert async_sender.is_throttle(limited)
+    assert async_sender.is_throttle(aiosmtplib.SMTPSenderRefused(421, "Bye", "news@example.com"))
+
+
+def _recipient(recipient_id):
+    return Recipient(
+        id=recipient_id,
+        campaign_id=1,
+        to_email=f"r{recipient_id}@example.com",
+        status=RecipientStatus.in_flight,
+        attempts=0,
+        last_attempt_at=datetime.now(timezone.utc),
+    )
+
+
+def test_greylisted_recipient_is_deferred_without_stopping_the_batch():
+    out = _BatchOutcome(1)
+
+    out.error(_recipient(1), smtplib.SMTPRecipientsRefused({"r1@example.com": (451, b"Greylisted")}))
+
+    assert out.results[0].status == DEFERRED
+    assert (out.throttled, out.stop_reason) == (False, None)
+
+
+def test_throttle_stops_the_batch():
+    out = _BatchOutcome(1)
+
+    out.error(_recipient(1), smtplib.SMTPRecipientsRefused({"r1@example.com": (421, b"4.7.0 Slow down")}))
+
+    assert out.throttled
+    assert out.stop_reason is not None
+    assert out.deferred == 1
@@ -0,0 +1,71 @@
+from __future__ import annotations
+
+import asyncio
+import json
+
+import pytest
+
+from app import progress
+from app.progress import progress_events, publish_progress
+from app.schemas import CampaignStatusOut
+
+
+def _data(frame):
+    assert frame.startswith("event: progress\n")
+    return json.loads(frame.split("data: ", 1)[1])
+
+
+def test_stream_coalesces_deltas_until_the_campaign_completes(fake_redis):
+    snapshot = CampaignStatusOut(id=1, status="running", total=10, sent=0, failed=0, pending=10, progress_pct=0.0)
+
+    async def load():
+        return snapshot
+
+    async def stream():
+        events = progress_events(1, load, interval=0.2)
+        frames = [await events.__anext__()]
+        for _ in range(5):
+            publish_progress(1, sent=1)
+        frames.append(await events.__anext__())
+        publish_progress(1, sent=4, failed=1, status="completed")
+        frames.append(await events.__anext__())
+        with pytest.raises(StopAsyncIteration):
+            await events.__anext__()
+        return frames
+
+    first, burst, last = (_data(f) for f in asyncio.run(stream()))
+
+    assert (first["sent"], first["pending"]) == (0, 10)
+    # five deltas inside one interval arrive as one update
+    assert (burst["sent"], burst["pending"], burst["progress_pct"]) == (5, 5, 50.0)
+    assert (last["status"], last["sent"], last["failed"], last["pending"]) == ("completed", 9, 1, 0)
+
+
+def test_finished_campaign_gets_one_snapshot(fake_redis):
+    done = CampaignStatusOut(id=2, status="completed", total=1, sent=1, failed=0, pending=0, progress_pct=100.0)
+
+    async def load():
+        return done
+
+    async def stream():
+        return [frame async for frame in progress_events(2, load, interval=0.2)]
+
+    frames = asyncio.run(stream())
+
+    assert len(frames) == 1 and _data(frames[0])["status"] == "completed"
+
+
+def test_quiet_stream_sends_keepalives(fake_redis, monkeypatch):
+    monkeypatch.setattr(progress, "_KEEPALIVE_SECONDS", 0.05)
+    snapshot = CampaignStatusOut(id=3, status="running", total=1, sent=0, failed=0, pending=1, progress_pct=0.0)
+
+    async def load():
+        return snapshot
+
+    async def stream():
+        events = progress_events(3, load, interval=0.2)
+        frames = [await events.__anext__(), await events.__anext__()]
+        await events.aclose()
+        return frames
+
+    assert asyncio.run(stream())[1] == ": keepalive\n\n"
@@ -0,0 +1,49 @@
+from __future__ import annotations
+
+from sqlalchemy import select
+
+from app.delivery import DeliveryResult, claim_recipients
+from app.models import Campaign, CampaignStatus, Recipient, RecipientStatus
+from app.result_sink import claims_key, journaled_claims, make_sink, push_results
+
+
+def _claim(db, campaign_id, limit, lease_seconds=600):
+    db.expunge_all()
+    return claim_recipients(db, campaign_id, limit=limit, lease_seconds=lease_seconds, journaled=journaled_claims)
+
+
+def test_flush_applies_journaled_results_and_completes_campaign(db, campaign, fake_redis):
+    claimed = _claim(db, campaign.id, 3)
+    push_results([DeliveryResult.sent(r, None, "250 OK") for r in claimed])
+
+    assert make_sink(fake_redis).flush() == 3
+
+    db.expire_all()
+    assert set(db.scalars(select(Recipient.status))) == {RecipientStatus.sent}
+    assert db.get(Campaign, campaign.id).status == CampaignStatus.completed
+    assert not fake_redis.exists(claims_key(campaign.id))
+
+
+def test_expired_claim_with_journaled_result_is_not_sent_again(db, campaign, fake_redis):
+    first = _claim(db, campaign.id, 1)[0]
+    push_results([DeliveryResult.sent(first, None, "250 OK")])
+
+    # the lease has run out before any flush: the result is still only in Redis
+    again = _claim(db, campaign.id, 3, lease_seconds=0)
+
+    assert first.id not in {r.id for r in again}
+    assert make_sink(fake_redis).flush() == 1
+    db.expire_all()
+    assert db.get(Recipient, first.id).status == RecipientStatus.sent
+
+
+def test_claims_of_superseded_results_are_forgotten(db, campaign, fake_redis):
+    stale = _claim(db, campaign.id, 1)[0]
+    stale_result = DeliveryResult.sent(stale, None, "250 OK")
+    # reclaimed before the result was journaled, so nothing fenced it
+    current = _claim(db, campaign.id, 1, lease_seconds=0)[0]
+    push_results([stale_result])
+
+    assert make_sink(fake_redis).flush() == 0
+    assert journaled_claims(campaign.id, [current.id]) == {}
+    assert [r.id for r in _claim(db, campaign.id, 1, lease_seconds=0)] == [current.id]
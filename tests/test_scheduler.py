@@ -0,0 +1,164 @@
+from __future__ import annotations
+
+import pytest
+
+from app import scheduler as scheduler_module
+from app.scheduler import (
+    Scheduler,
+    account_pacing_key,
+    campaign_hold_key,
+    campaign_rate_key,
+    gcra_params,
+    hold_dispatch,
+    lease_key,
+    user_in_flight_key,
+)
+
+
+@pytest.fixture
+def grant(fake_redis):
+    script = fake_redis.register_script(scheduler_module._GRANT_SCRIPT)
+
+    def call(token="t1", wanted=50, senders=10, campaign_id=1, user_id=1, limit=(10, 60)):
+        return script(
+            keys=[
+                lease_key(campaign_id),
+                campaign_hold_key(campaign_id),
+                account_pacing_key("smtp.example.com", 587, "u"),
+                user_in_flight_key(user_id),
+                campaign_rate_key(campaign_id),
+            ],
+            args=[token, 300_000, wanted, senders, *gcra_params(*limit)],
+        )
+
+    return call
+
+
+def test_gcra_params_allow_a_full_window_as_burst():
+    interval, tolerance = gcra_params(10, 60)
+
+    assert interval == 6_000_000
+    assert tolerance == 9 * interval
+
+
+def test_grant_spends_the_burst_then_waits(grant):
+    assert grant(token="a") == [10, 0]
+
+    granted, retry_after_ms = grant(token="b")
+    assert granted == 0
+    assert 5_000 < retry_after_ms <= 6_000
+
+
+def test_grant_is_capped_by_what_the_sender_asked_for(grant):
+    assert grant(wanted=3) == [3, 0]
+    assert grant(token="t2", wanted=50) == [7, 0]
+
+
+def test_sender_slots_are_limited_per_campaign(grant, fake_redis):
+    assert grant(token="a", wanted=1, senders=1) == [1, 0]
+    assert grant(token="b", wanted=1, senders=1) == [0, -1]
+
+    fake_redis.zrem(lease_key(1), "a")
+    assert grant(token="b", wanted=1, senders=1) == [1, 0]
+    assert set(fake_redis.zrange(user_in_flight_key(1), 0, -1)) == {b"a", b"b"}
+
+
+def test_held_campaign_is_granted_nothing(grant, fake_redis):
+    hold_dispatch(1, 30)
+
+    granted, retry_after_ms = grant()
+    assert granted == 0
+    assert 29_000 < retry_after_ms <= 30_000
+
+
+def test_throttled_account_stretches_the_interval(grant, fake_redis):
+    fake_redis.hset(account_pacing_key("smtp.example.com", 587, "u"), "f", "0.5")
+
+    # the burst window keeps its length, so half as many sends fit in it
+    assert grant() == [5, 0]
+
+
+def test_failed_tick_backs_off_and_still_flushes(fake_redis, monkeypatch):
+    flushed = []
+
+    class Sink:
+        def flush_due(self):
+            flushed.append(1)
+
+    s = Scheduler(fake_redis, tick_seconds=0.05, refresh_seconds=2.0, sink=Sink())
+    monkeypatch.setattr(s, "_tick", lambda: 1 / 0)
+
+    assert s.run_once() == 0
+    assert s.run_once() == 0
+    assert s.failures == 2
+    assert s._sleep_seconds() == pytest.approx(0.4)
+    assert len(flushed) == 2
+
+    monkeypatch.setattr(s, "_tick", lambda: 3)
+    assert s.run_once() == 3
+    assert s._sleep_seconds() == 0.05
+
+
+def _fair_scheduler(fake_redis, monkeypatch, weights, campaigns_per_user, max_in_flight, share=0.5, grant=10):
+    """A scheduler whose grants always succeed and only record who was served."""
+    s = Scheduler(
+        fake_redis, tick_seconds=0.05, refresh_seconds=2.0, max_in_flight=max_in_flight, tenant_max_share=share
+    )
+    s._weights = dict(weights)
+    served = []
+
+    def dispatch(campaign, now):
+        served.append(campaign.user_id)
+        fake_redis.zadd(user_in_flight_key(campaign.user_id), {f"{campaign.id}:{len(served)}": 2**50})
+        return grant
+
+    monkeypatch.setattr(s, "_dispatch", dispatch)
+    due = {
+        user_id: [
+            scheduler_module._ScheduledCampaign(
+                id=user_id * 100 + i, user_id=user_id, queue="send.0", pacing_key="p", rate_keys=[], rate_args=[]
+            )
+            for i in range(count)
+        ]
+        for user_id, count in campaigns_per_user.items()
+    }
+    return s, due, served
+
+
+def test_users_take_turns_whatever_their_campaign_count(fake_redis, monkeypatch):
+    s, due, served = _fair_scheduler(fake_redis, monkeypatch, {1: 1, 2: 1}, {1: 6, 2: 2}, max_in_flight=0)
+
+    s._dispatch_fairly(due, now=0.0)
+
+    # without a cap every due campaign is served, alternating while both users have some
+    assert served[:4] == [1, 2, 1, 2]
+    assert served.count(1) == 6 and served.count(2) == 2
+
+
+def test_weight_sets_the_share_of_capped_slots(fake_redis, monkeypatch):
+    s, due, served = _fair_scheduler(fake_redis, monkeypatch, {1: 3, 2: 1}, {1: 10, 2: 10}, max_in_flight=8)
+
+    s._dispatch_fairly(due, now=0.0)
+
+    assert (served.count(1), served.count(2)) == (6, 2)
+
+
+def test_idle_capacity_is_borrowed_up_to_the_cap(fake_redis, monkeypatch):
+    s, due, served = _fair_scheduler(fake_redis, monkeypatch, {1: 1, 2: 1}, {1: 10}, max_in_flight=8, share=0.5)
+
+    s._dispatch_fairly(due, now=0.0)
+
+    # user 2 runs campaigns but has none due; user 1 may hold half of all slots
+    assert served == [1] * 4
+
+
+def test_user_back_from_idle_gets_no_banked_credit(fake_redis, monkeypatch):
+    s, due, served = _fair_scheduler(fake_redis, monkeypatch, {1: 1, 2: 1}, {1: 3, 2: 3}, max_in_flight=0)
+    s._vtime = {1: 100.0, 2: 0.0}
+    s._clock = 100.0
+
+    s._dispatch_fairly(due, now=0.0)
+
+    # user 2's old virtual time is lifted to the clock instead of buying a run of grants
+    assert served[:2] in ([1, 2], [2, 1])
+    assert served[2:4] in ([1, 2], [2, 1])
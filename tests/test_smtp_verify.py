@@ -0,0 +1,70 @@
+from __future__ import annotations
+
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+
+from app.config import settings
+from app.routers import smtp
+from app.schemas import SMTPVerifyIn
+
+
+@pytest.fixture
+def connections(monkeypatch):
+    """Passwords of the SMTP connections the checks opened."""
+    opened: list[str] = []
+
+    async def connect(**kw: object) -> object:
+        opened.append(kw["smtp_password"])
+        await asyncio.sleep(0.01)
+        if kw["smtp_password"] == "wrong":
+            raise RuntimeError("535 Authentication failed")
+        return object()
+
+    async def close(client: object) -> None:
+        pass
+
+    monkeypatch.setattr(smtp, "open_smtp_connection_async", connect)
+    monkeypatch.setattr(smtp, "close_quietly_async", close)
+    monkeypatch.setattr(smtp, "_slots", asyncio.Semaphore(settings.smtp_verify_concurrency))
+    smtp._results.clear()
+    yield opened
+    smtp._results.clear()
+
+
+def _payload(password="secret"):
+    return SMTPVerifyIn(smtp_host="smtp.example.com", smtp_port=587, smtp_username="u", smtp_password=password)
+
+
+def test_identical_checks_in_flight_share_one_connection(connections):
+    async def verify():
+        return await asyncio.gather(*(smtp.smtp_verify(_payload()) for _ in range(10)))
+
+    results = asyncio.run(verify())
+
+    assert all(r.ok for r in results)
+    assert connections == ["secret"]
+
+
+def test_repeat_is_answered_from_the_cache_until_the_settings_change(connections):
+    assert asyncio.run(smtp.smtp_verify(_payload())).ok
+    assert asyncio.run(smtp.smtp_verify(_payload())).ok
+    failed = asyncio.run(smtp.smtp_verify(_payload("wrong")))
+
+    assert connections == ["secret", "wrong"]
+    assert not failed.ok and "535" in failed.detail
+
+
+def test_full_queue_answers_503(connections, monkeypatch):
+    monkeypatch.setattr(smtp, "_slots", asyncio.Semaphore(0))
+    monkeypatch.setattr(settings, "smtp_verify_queue_seconds", 0.01)
+
+    with pytest.raises(HTTPException) as e:
+        asyncio.run(smtp.smtp_verify(_payload()))
+
+    assert e.value.status_code == 503
+    assert connections == []
+    # a refused check is not remembered
+    monkeypatch.setattr(smtp, "_slots", asyncio.Semaphore(1))
+    assert asyncio.run(smtp.smtp_verify(_payload())).ok
@@ -0,0 +1,112 @@
+from __future__ import annotations
+
+import pytest
+from sqlalchemy import func, select
+
+from app import suppression
+from app.models import Suppression, SuppressionReason, User
+from app.suppression import (
+    SuppressionIndex,
+    add_suppressions,
+    email_hash,
+    email_key,
+    get_index,
+    remove_suppression,
+    suppressed,
+)
+
+
+@pytest.fixture(autouse=True)
+def _fresh_indexes():
+    suppression._indexes.clear()
+    yield
+    suppression._indexes.clear()
+
+
+@pytest.fixture
+def users(db):
+    owner, other = User(email="owner@example.com"), User(email="other@example.com")
+    db.add_all([owner, other])
+    db.commit()
+    return owner.id, other.id
+
+
+def _suppress(db, user_id, *addresses):
+    added = add_suppressions(db, [(user_id, a) for a in addresses], SuppressionReason.unsubscribed)
+    db.commit()
+    return added
+
+
+def test_index_holds_sorted_hashes(db, users):
+    owner, _ = users
+    _suppress(db, owner, "b@example.com", "a@example.com", "c@example.com")
+
+    index = SuppressionIndex(owner).load()
+
+    assert list(index._sorted) == sorted(email_hash(f"{c}@example.com") for c in "abc")
+    assert index.might_contain(email_hash("a@example.com"))
+    assert not index.might_contain(email_hash("d@example.com"))
+
+
+def test_suppressed_matches_case_insensitively_per_user(db, users):
+    owner, other = users
+    _suppress(db, owner, "Blocked@Example.com")
+
+    assert suppressed(owner, ["blocked@example.com ", "BLOCKED@EXAMPLE.COM", "ok@example.com"]) == {
+        "blocked@example.com"
+    }
+    assert suppressed(other, ["blocked@example.com"]) == set()
+
+
+def test_hash_hits_are_confirmed_against_the_table(db, users):
+    owner, _ = users
+    index = get_index(owner)
+    # as if another address collided with this one's hash
+    index.add(email_key("innocent@example.com"))
+
+    assert index.might_contain(email_hash("innocent@example.com"))
+    assert suppressed(owner, ["innocent@example.com"]) == set()
+
+
+def test_additions_reach_a_loaded_index_at_once(db, users):
+    owner, _ = users
+    get_index(owner)
+
+    _suppress(db, owner, "late@example.com")
+
+    assert get_index(owner).might_contain(email_hash("late@example.com"))
+    assert suppressed(owner, ["late@example.com"]) == {"late@example.com"}
+
+
+def test_add_suppressions_skips_listed_pairs(db, users):
+    owner, _ = users
+
+    assert _suppress(db, owner, "x@example.com", "X@example.com") == 1
+    assert _suppress(db, owner, "x@example.com", "y@example.com") == 1
+    assert db.scalar(select(func.count()).select_from(Suppression)) == 2
+
+
+def test_portable_insert_skips_listed_pairs(db, users):
+    owner, other = users
+    _suppress(db, owner, "x@example.com")
+    rows = [
+        {"user_id": owner, "email": "x@example.com", "reason": "bounced"},
+        {"user_id": owner, "email": "y@example.com", "reason": "bounced"},
+        {"user_id": other, "email": "x@example.com", "reason": "bounced"},
+    ]
+
+    assert suppression._insert_missing(db, rows) == 2
+    db.commit()
+    assert db.scalar(select(func.count()).select_from(Suppression)) == 3
+
+
+def test_removed_suppression_no_longer_blocks(db, users):
+    owner, _ = users
+    _suppress(db, owner, "gone@example.com")
+    get_index(owner)
+
+    assert remove_suppression(db, owner, "GONE@example.com")
+    db.commit()
+
+    # the index still has the hash; the exact check lets the address through
+    assert suppressed(owner, ["gone@example.com"]) == set()
@@ -0,0 +1,80 @@
+from __future__ import annotations
+
+import pytest
+from sqlalchemy import select
+
+from app import email_sender, tasks
+from app.config import settings
+from app.models import Campaign, CampaignStatus, Recipient, RecipientStatus
+from app.result_sink import make_sink
+from app.smtp_pool import PoolExhausted
+
+
+class Server:
+    def __init__(self) -> None:
+        self.sock = object()
+        self.transactions: list[list[str]] = []
+
+    def has_extn(self, name):
+        return False
+
+    def sendmail(self, from_addr, to_addrs, msg):
+        self.transactions.append(list(to_addrs))
+        return {}
+
+    def quit(self):
+        pass
+
+
+@pytest.fixture
+def connections(fake_redis, monkeypatch):
+    """Every SMTP connection a task opens, without the pool."""
+    opened: list[Server] = []
+
+    def connect(**_: object) -> Server:
+        opened.append(Server())
+        return opened[-1]
+
+    monkeypatch.setattr(email_sender, "open_smtp_connection", connect)
+    monkeypatch.setattr(tasks, "get_smtp_credentials", lambda *_: ("user", "secret"))
+    monkeypatch.setattr(settings, "smtp_pool_enabled", False)
+    return opened
+
+
+def test_batch_is_sent_over_one_connection(db, campaign, connections, fake_redis):
+    tasks.send_next_email(campaign.id, budget=3)
+    make_sink(fake_redis).flush()
+
+    assert len(connections) == 1
+    assert connections[0].transactions == [["r0@example.com"], ["r1@example.com"], ["r2@example.com"]]
+    db.expire_all()
+    assert set(db.scalars(select(Recipient.status))) == {RecipientStatus.sent}
+    assert db.get(Campaign, campaign.id).status == CampaignStatus.completed
+
+
+def test_task_sends_no_more_than_its_budget(db, campaign, connections, fake_redis):
+    tasks.send_next_email(campaign.id, budget=2)
+    make_sink(fake_redis).flush()
+
+    assert connections[0].transactions == [["r0@example.com"], ["r1@example.com"]]
+    db.expire_all()
+    statuses = {r.to_email: r.status for r in db.scalars(select(Recipient))}
+    assert statuses["r2@example.com"] == RecipientStatus.pending
+
+
+def test_exhausted_pool_hands_recipients_back_untried(db, campaign, fake_redis, monkeypatch):
+    monkeypatch.setattr(tasks, "get_smtp_credentials", lambda *_: ("user", "secret"))
+    monkeypatch.setattr(settings, "smtp_pool_enabled", True)
+
+    def acquire(**_: object):
+        raise PoolExhausted("No free SMTP connection for smtp.example.com:587")
+
+    monkeypatch.setattr(tasks.smtp_pool, "acquire", acquire)
+
+    tasks.send_next_email(campaign.id, budget=3)
+
+    db.expire_all()
+    recipients = db.scalars(select(Recipient)).all()
+    assert {r.status for r in recipients} == {RecipientStatus.pending}
+    assert {r.attempts for r in recipients} == {0}
+    assert all(r.retry_at is not None for r in recipients)
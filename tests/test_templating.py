@@ -0,0 +1,62 @@
+from __future__ import annotations
+
+import pytest
+
+from app.templating import TemplateError, compile_lenient, compile_template, recipient_values
+
+
+def _render(source, to_email="ann@example.com", to_name="Ann Lee", attributes=None):
+    template = compile_template(source)
+    return template.render(recipient_values(to_email, to_name, attributes, template.fields))
+
+
+def test_static_template_renders_verbatim():
+    template = compile_template("Hello everyone")
+
+    assert template.is_static
+    assert template.render({}) == "Hello everyone"
+
+
+def test_fields_are_substituted():
+    assert _render("Hi {{ first_name }} <{{to_email}}>, {{ to_name }}") == "Hi Ann <ann@example.com>, Ann Lee"
+
+
+def test_fallback_is_used_for_empty_values():
+    assert _render("Hi {{ first_name | there }}!", to_name=None) == "Hi there!"
+    assert _render("Hi {{ first_name | there }}!", to_name="  ") == "Hi there!"
+
+
+def test_attributes_are_looked_up_and_stringified():
+    source = "{{ attributes.plan }} x{{ attributes.seats }} {{ attributes.missing | n/a }}"
+
+    assert _render(source, attributes={"plan": "pro", "seats": 3}) == "pro x3 n/a"
+    assert _render(source, attributes=None) == " x n/a"
+
+
+def test_parts_alternate_literals_and_lookups():
+    template = compile_template("{{ to_name }}")
+
+    assert template.parts == ("", ("to_name", ""), "")
+    assert template.fields == frozenset({"to_name"})
+
+
+@pytest.mark.parametrize(
+    "source",
+    [
+        "Hi {{ name }}",
+        "Hi {{ attributes.bad-key }}",
+        "Hi {{ first_name",
+        "Hi first_name }}",
+        "{{ to_name }} }}",
+    ],
+)
+def test_malformed_templates_are_rejected(source):
+    with pytest.raises(TemplateError):
+        compile_template(source)
+
+
+def test_lenient_compile_falls_back_to_the_source():
+    template = compile_lenient("Use {{ braces }} freely")
+
+    assert template.is_static
+    assert template.render({"to_name": "Ann"}) == "Use {{ braces }} freely"